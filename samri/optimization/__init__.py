@@ -1 +1 @@
-__all__ = ["newreg", "registration"]
+__all__ = ["benchmark", "newreg", "registration"]
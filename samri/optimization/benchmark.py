@@ -0,0 +1,542 @@
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+try:
+	from queue import Empty
+except ImportError:
+	from Queue import Empty
+try:
+	from shutil import which
+except ImportError:
+	from distutils.spawn import find_executable as which
+
+import nibabel as nib
+import numpy as np
+
+try:
+	from ..pipelines.bruker import bruker_to_nifti
+	from ..pipelines.extra_functions import force_dummy_scans
+	from ..pipelines.nodes import DSURQEc_structural_registration, real_size_nodes
+except (SystemError, ValueError, ImportError):
+	from samri.pipelines.bruker import bruker_to_nifti
+	from samri.pipelines.extra_functions import force_dummy_scans
+	from samri.pipelines.nodes import DSURQEc_structural_registration, real_size_nodes
+
+STAGES = ["conversion", "dummy_scans", "slice_timing", "biascorrect", "registration", "warping", "native_bandpass", "bandpass"]
+
+#external executables required by the individual stages
+STAGE_EXECUTABLES = {
+	"slice_timing":"slicetimer",
+	"biascorrect":"N4BiasFieldCorrection",
+	"registration":"antsRegistration",
+	"warping":"antsApplyTransforms",
+	"bandpass":"fslmaths",
+	}
+
+def _brain(shape, center_shift=(0,0,0), seed=0):
+	"""Return an ellipsoid "brain" with smooth tissue contrast, filling roughly half of each dimension of the given shape."""
+	grid = np.meshgrid(*[np.linspace(-1,1,i) for i in shape], indexing="ij")
+	radius = np.sqrt(sum([((g-s)/0.6)**2 for g, s in zip(grid, center_shift)]))
+	brain = np.clip(1.2-radius, 0, 1)
+	#two tissue classes
+	brain += 0.3*(radius < 0.5)
+	random_state = np.random.RandomState(seed)
+	brain *= 1 + 0.02*random_state.randn(*shape)
+	return brain*(radius < 1)
+
+def _write_parameters(file_path, parameters):
+	"""Write a dictionary of (already formatted) values as a JCAMP-DX parameter file."""
+	with open(file_path, "w") as parameter_file:
+		parameter_file.write("##TITLE=Parameter List\n")
+		for key, value in parameters.items():
+			parameter_file.write("##${}={}\n".format(key, value))
+		parameter_file.write("##END=\n")
+
+def _jcamp_array(values, shape=None):
+	if shape is None:
+		shape = [len(values)]
+	values = " ".join([str(i) for i in values])
+	return "( {} )\n{}".format(", ".join([str(i) for i in shape]), values)
+
+def synthetic_bruker_scan(scan_dir,
+	matrix=(64,64,16),
+	volumes=100,
+	dummy_scans=0,
+	repetition_time=1000,
+	resolution=0.3,
+	scan_type="EPI_CBV_jb_long",
+	seed=0,
+	):
+	"""Write a synthetic 2D multi-slice Bruker scan directory (`acqp`, `method`, and `pdata/1/{2dseq,visu_pars}`), readable by `samri.pipelines.bruker.load_2dseq()`.
+
+	Parameters
+	----------
+
+	scan_dir : str
+	Path of the scan directory to write.
+
+	matrix : tuple of int, optional
+	In-plane matrix size and number of slices.
+
+	volumes : int, optional
+	Number of volumes. A value of 1 gives a (3D) structural scan.
+
+	dummy_scans : int, optional
+	Number of dummy scans to record in the `method` file.
+
+	repetition_time : int, optional
+	Repetition time in milliseconds.
+
+	resolution : float, optional
+	Voxel size in mm.
+
+	scan_type : str, optional
+	Protocol name to record in the `acqp` file.
+
+	seed : int, optional
+	Random seed for the noise and the position of the "brain".
+	"""
+	reconstruction_dir = os.path.join(scan_dir,"pdata","1")
+	if not os.path.isdir(reconstruction_dir):
+		os.makedirs(reconstruction_dir)
+
+	random_state = np.random.RandomState(seed)
+	brain = _brain(matrix, center_shift=random_state.uniform(-0.05,0.05,3), seed=seed)
+	data = np.empty(tuple(matrix)+(volumes,), dtype=np.int16)
+	#block design signal with 20 volume blocks
+	signal = 1 + 0.02*(np.arange(volumes)//20 % 2)
+	for volume in range(volumes):
+		data[...,volume] = np.clip(brain*10000*signal[volume] + random_state.randn(*matrix)*100, 0, 32767)
+	data.reshape(-1, order="F").astype("<i2").tofile(os.path.join(reconstruction_dir,"2dseq"))
+
+	frames = matrix[2]*volumes
+	positions = []
+	for volume in range(volumes):
+		for slice_index in range(matrix[2]):
+			positions.extend([-matrix[0]*resolution/2, -matrix[1]*resolution/2, (slice_index-matrix[2]/2.)*resolution])
+	frame_groups = "(2)\n({}, <FG_SLICE>, <>, 0, 2) ({}, <FG_CYCLE>, <>, 2, 1)".format(matrix[2], volumes)
+	visu_pars = {
+		"VisuCoreFrameCount":frames,
+		"VisuCoreDim":2,
+		"VisuCoreSize":_jcamp_array(matrix[:2]),
+		"VisuCoreExtent":_jcamp_array([matrix[0]*resolution, matrix[1]*resolution]),
+		"VisuCoreFrameThickness":_jcamp_array([resolution]),
+		"VisuCoreWordType":"_16BIT_SGN_INT",
+		"VisuCoreByteOrder":"littleEndian",
+		"VisuCoreDataSlope":_jcamp_array(["@{}*(1)".format(frames)], [frames]),
+		"VisuCoreDataOffs":_jcamp_array(["@{}*(0)".format(frames)], [frames]),
+		"VisuCoreOrientation":_jcamp_array([1,0,0,0,1,0,0,0,1]*frames, [frames,9]),
+		"VisuCorePosition":_jcamp_array(positions, [frames,3]),
+		"VisuFGOrderDescDim":2,
+		"VisuFGOrderDesc":frame_groups,
+		"VisuAcqRepetitionTime":_jcamp_array([repetition_time]),
+		}
+	if volumes == 1:
+		visu_pars["VisuFGOrderDescDim"] = 1
+		visu_pars["VisuFGOrderDesc"] = "(1)\n({}, <FG_SLICE>, <>, 0, 2)".format(matrix[2])
+	_write_parameters(os.path.join(reconstruction_dir,"visu_pars"), visu_pars)
+	_write_parameters(os.path.join(scan_dir,"method"), {
+		"PVM_DummyScans":dummy_scans,
+		"PVM_DummyScansDur":dummy_scans*repetition_time,
+		"PVM_RepetitionTime":repetition_time,
+		})
+	_write_parameters(os.path.join(scan_dir,"acqp"), {"ACQ_protocol_name":"( 64 )\n<{}>".format(scan_type)})
+	return scan_dir
+
+def synthetic_dataset(base_dir,
+	subjects=2,
+	sessions=["ofM"],
+	matrix=(64,64,16),
+	structural_matrix=(128,128,32),
+	volumes=100,
+	dummy_scans=0,
+	):
+	"""Write a synthetic dataset of Bruker measurement directories (one per subject and session, each with a functional and a structural scan), as well as a matching template image.
+
+	Parameters
+	----------
+
+	base_dir : str
+	Directory in which to write the dataset.
+
+	subjects : int, optional
+	Number of subjects.
+
+	sessions : list of str, optional
+	Session names.
+
+	matrix : tuple of int, optional
+	Matrix size of the functional scans.
+
+	structural_matrix : tuple of int, optional
+	Matrix size of the structural scans and the template.
+
+	volumes : int, optional
+	Number of volumes of the functional scans.
+
+	dummy_scans : int, optional
+	Number of dummy scans recorded for the functional scans.
+
+	Returns
+	-------
+
+	dict
+	With the keys "measurements" (list of measurement directories), "functional" and "structural" (lists of scan directories), and "template" (path to the template image).
+	"""
+	base_dir = os.path.abspath(os.path.expanduser(base_dir))
+	dataset = {"measurements":[], "functional":[], "structural":[]}
+	seed = 0
+	for subject in range(subjects):
+		for session in sessions:
+			subject_name = str(5000+subject)
+			measurement_dir = os.path.join(base_dir,"20170101_000000_{}_1_{}".format(subject_name, session))
+			if not os.path.isdir(measurement_dir):
+				os.makedirs(measurement_dir)
+			_write_parameters(os.path.join(measurement_dir,"subject"), {
+				"SUBJECT_name_string":"( 64 )\n<{}>".format(subject_name),
+				"SUBJECT_study_name":"( 64 )\n<{}>".format(session),
+				})
+			with open(os.path.join(measurement_dir,"ScanProgram.scanProgram"), "w") as scan_program_file:
+				scan_program_file.write("<displayName>T2_TurboRARE (E3)</displayName>\n<displayName>EPI_CBV_jb_long (E5)</displayName>\n")
+			seed += 1
+			dataset["structural"].append(synthetic_bruker_scan(os.path.join(measurement_dir,"3"), structural_matrix, 1, resolution=0.15, scan_type="T2_TurboRARE", seed=seed))
+			dataset["functional"].append(synthetic_bruker_scan(os.path.join(measurement_dir,"5"), matrix, volumes, dummy_scans=dummy_scans, seed=seed))
+			dataset["measurements"].append(measurement_dir)
+
+	template_path = os.path.join(base_dir,"template.nii.gz")
+	affine = np.diag([1.5,1.5,1.5,1])
+	affine[:3,3] = -np.array(structural_matrix)*1.5/2
+	nib.save(nib.Nifti1Image((_brain(structural_matrix)*10000).astype(np.float32), affine), template_path)
+	dataset["template"] = template_path
+	return dataset
+
+def _run_node(node, work_dir):
+	node.base_dir = work_dir
+	return node.run()
+
+def stage_conversion(context):
+	context["functional"] = bruker_to_nifti(context["functional_scan"], os.path.join(context["work_dir"],"functional.nii"))
+	context["structural"] = bruker_to_nifti(context["structural_scan"], os.path.join(context["work_dir"],"structural.nii"))
+	return context
+
+def stage_dummy_scans(context):
+	context["functional"] = force_dummy_scans(context["functional"], context["functional_scan"],
+		desired_dummy_scans=context["desired_dummy_scans"],
+		out_file=os.path.join(context["work_dir"],"functional_cropped.nii"),
+		)
+	return context
+
+def stage_slice_timing(context):
+	import nipype.pipeline.engine as pe
+	from nipype.interfaces import fsl
+	slicetimer = pe.Node(interface=fsl.SliceTimer(), name="slicetimer")
+	slicetimer.inputs.in_file = context["functional"]
+	slicetimer.inputs.time_repetition = 1
+	context["functional"] = _run_node(slicetimer, context["work_dir"]).outputs.slice_time_corrected_file
+	return context
+
+def stage_biascorrect(context):
+	import nipype.pipeline.engine as pe
+	from nipype.interfaces import fsl
+	s_biascorrect, f_biascorrect = real_size_nodes(num_threads=context["n_procs"])
+	temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
+	temporal_mean.inputs.in_file = context["functional"]
+	f_biascorrect.inputs.input_image = _run_node(temporal_mean, context["work_dir"]).outputs.out_file
+	s_biascorrect.inputs.input_image = context["structural"]
+	context["functional_mean"] = _run_node(f_biascorrect, context["work_dir"]).outputs.output_image
+	context["structural"] = _run_node(s_biascorrect, context["work_dir"]).outputs.output_image
+	return context
+
+def stage_registration(context):
+	s_register, _, f_register, _ = DSURQEc_structural_registration(context["template"], mask=False, num_threads=context["n_procs"])
+	s_register.inputs.moving_image = context["structural"]
+	f_register.inputs.moving_image = context.get("functional_mean", context["functional"])
+	f_register.inputs.fixed_image = context["structural"]
+	context["s_transform"] = _run_node(s_register, context["work_dir"]).outputs.composite_transform
+	context["f_transform"] = _run_node(f_register, context["work_dir"]).outputs.composite_transform
+	return context
+
+def stage_warping(context):
+	_, _, _, f_warp = DSURQEc_structural_registration(context["template"], mask=False, num_threads=context["n_procs"])
+	f_warp.inputs.input_image = context["functional"]
+	f_warp.inputs.transforms = [context["f_transform"], context["s_transform"]]
+	context["functional"] = _run_node(f_warp, context["work_dir"]).outputs.output_image
+	return context
+
+def stage_bandpass(context):
+	import nipype.pipeline.engine as pe
+	from nipype.interfaces import fsl
+	bandpass = pe.Node(interface=fsl.maths.TemporalFilter(), name="bandpass")
+	bandpass.inputs.highpass_sigma = 225
+	bandpass.inputs.lowpass_sigma = 1
+	bandpass.inputs.in_file = context["functional"]
+	context["functional"] = _run_node(bandpass, context["work_dir"]).outputs.out_file
+	return context
+
+def stage_native_bandpass(context):
+	#filters the same input as the `bandpass` stage, for comparison, without passing its output on
+	import nipype.pipeline.engine as pe
+	from samri.pipelines.extra_interfaces import Bandpass
+	bandpass = pe.Node(interface=Bandpass(), name="native_bandpass")
+	bandpass.inputs.highpass_sigma = 225
+	bandpass.inputs.lowpass_sigma = 1
+	bandpass.inputs.num_threads = context["n_procs"]
+	bandpass.inputs.in_file = context["functional"]
+	_run_node(bandpass, context["work_dir"])
+	return context
+
+STAGE_FUNCTIONS = {
+	"conversion":stage_conversion,
+	"dummy_scans":stage_dummy_scans,
+	"slice_timing":stage_slice_timing,
+	"biascorrect":stage_biascorrect,
+	"registration":stage_registration,
+	"warping":stage_warping,
+	"native_bandpass":stage_native_bandpass,
+	"bandpass":stage_bandpass,
+	}
+
+def _peak_rss_mb(who):
+	#`ru_maxrss` is reported in kilobytes on Linux, but in bytes on macOS
+	peak = resource.getrusage(who).ru_maxrss
+	if sys.platform == "darwin":
+		return peak/1024.**2
+	return peak/1024.
+
+def _stage_process(stage_function, context, queue):
+	start = time.time()
+	try:
+		context = stage_function(context)
+		status = "ok"
+	except Exception as e:
+		status = "failed: {}".format(e)
+	queue.put({
+		"status":status,
+		"context":context,
+		"wall_time":time.time()-start,
+		"peak_rss_mb":_peak_rss_mb(resource.RUSAGE_SELF),
+		"peak_child_rss_mb":_peak_rss_mb(resource.RUSAGE_CHILDREN),
+		})
+
+def time_stage(stage_function, context,
+	timeout=None,
+	):
+	"""Run a benchmark stage in a separate process, and measure its wall time and peak resident set size (RSS).
+
+	Running each stage in its own process makes the peak RSS measurements independent of the preceding stages.
+	The peak RSS of external programs (e.g. ANTs or FSL) is reported separately, as "peak_child_rss_mb".
+
+	Parameters
+	----------
+
+	stage_function : function
+	Function taking and returning a context dictionary of input and output paths.
+
+	context : dict
+	Context dictionary to pass to the stage function.
+
+	timeout : float, optional
+	Time in seconds after which the stage process is terminated, and the stage recorded as failed.
+
+	Returns
+	-------
+
+	dict
+	Timing and memory measurements, the stage status, and the updated context.
+	If the stage process dies without a result (e.g. if it is killed for running out of memory), only the failed status, the wall time, and the unchanged context are returned.
+	"""
+	start = time.time()
+	queue = multiprocessing.Queue()
+	process = multiprocessing.Process(target=_stage_process, args=(stage_function, context, queue))
+	process.start()
+	result = None
+	status = ""
+	while result is None:
+		try:
+			result = queue.get(timeout=1)
+		except Empty:
+			if timeout and time.time()-start > timeout:
+				process.terminate()
+				status = "failed: timed out after {} s".format(timeout)
+				break
+			if process.exitcode is not None:
+				#the result may have arrived just before the process exited
+				try:
+					result = queue.get(timeout=1)
+				except Empty:
+					status = "failed: the stage process exited with code {}".format(process.exitcode)
+					break
+	process.join()
+	if result is None:
+		result = {
+			"status":status,
+			"context":context,
+			"wall_time":time.time()-start,
+			}
+	return result
+
+def benchmark(base_dir="~/.samri/benchmark",
+	stages=STAGES,
+	subjects=1,
+	matrix=(64,64,16),
+	structural_matrix=(128,128,32),
+	volumes=100,
+	desired_dummy_scans=10,
+	n_procs=1,
+	report_path="",
+	stage_timeout=None,
+	):
+	"""Benchmark the stages of the preprocessing hot path on synthetic small-animal data, and write a JSON report.
+
+	Stages requiring external programs which are not installed are reported as skipped.
+	The same synthetic data is produced for the same parameters, so that reports can be compared across versions via `compare_reports()`.
+
+	Parameters
+	----------
+
+	base_dir : str, optional
+	Directory in which to write the synthetic data and the stage outputs.
+
+	stages : list of str, optional
+	Stages to benchmark, a subset of `STAGES`.
+	Stages depend on the outputs of the preceding ones, so subsets should be contiguous and start with "conversion".
+
+	subjects : int, optional
+	Number of subjects to process.
+
+	matrix : tuple of int, optional
+	Matrix size of the synthetic functional scans.
+
+	structural_matrix : tuple of int, optional
+	Matrix size of the synthetic structural scans and template.
+
+	volumes : int, optional
+	Number of volumes of the synthetic functional scans.
+
+	desired_dummy_scans : int, optional
+	Number of initial volumes to crop in the "dummy_scans" stage.
+
+	n_procs : int, optional
+	Number of threads for multithreaded stages.
+
+	report_path : str, optional
+	Path of the JSON report. Defaults to "report.json" in `base_dir`.
+
+	stage_timeout : float, optional
+	Time in seconds after which a stage is terminated and recorded as failed (see `time_stage()`).
+
+	Returns
+	-------
+
+	dict
+	The report.
+	"""
+	base_dir = os.path.abspath(os.path.expanduser(base_dir))
+	if not report_path:
+		report_path = os.path.join(base_dir,"report.json")
+	report_path = os.path.abspath(os.path.expanduser(report_path))
+
+	start = time.time()
+	dataset = synthetic_dataset(os.path.join(base_dir,"data"), subjects=subjects, matrix=matrix, structural_matrix=structural_matrix, volumes=volumes)
+	data_time = time.time()-start
+
+	results = []
+	for ix, (functional_scan, structural_scan) in enumerate(zip(dataset["functional"], dataset["structural"])):
+		work_dir = os.path.join(base_dir,"work",str(ix))
+		if not os.path.isdir(work_dir):
+			os.makedirs(work_dir)
+		context = {
+			"functional_scan":functional_scan,
+			"structural_scan":structural_scan,
+			"template":dataset["template"],
+			"work_dir":work_dir,
+			"desired_dummy_scans":desired_dummy_scans,
+			"n_procs":n_procs,
+			}
+		for stage in stages:
+			executable = STAGE_EXECUTABLES.get(stage)
+			if executable and not which(executable):
+				results.append({"stage":stage, "subject":ix, "status":"skipped: {} not found".format(executable)})
+				continue
+			result = time_stage(STAGE_FUNCTIONS[stage], context, timeout=stage_timeout)
+			context = result.pop("context")
+			result.update({"stage":stage, "subject":ix})
+			results.append(result)
+
+	report = {
+		"parameters":{
+			"subjects":subjects,
+			"matrix":list(matrix),
+			"structural_matrix":list(structural_matrix),
+			"volumes":volumes,
+			"desired_dummy_scans":desired_dummy_scans,
+			"n_procs":n_procs,
+			},
+		"platform":{
+			"python":platform.python_version(),
+			"machine":platform.machine(),
+			"node":platform.node(),
+			"cpu_count":multiprocessing.cpu_count(),
+			},
+		"data_generation_time":data_time,
+		"stages":results,
+		"total_wall_time":time.time()-start,
+		}
+	with open(report_path, "w") as report_file:
+		json.dump(report, report_file, indent=1)
+	return report
+
+def compare_reports(report, baseline,
+	tolerance=0.2,
+	):
+	"""Compare two benchmark reports (or paths to them), and return the stages whose wall time or peak RSS regressed.
+
+	Parameters
+	----------
+
+	report : dict or str
+	Benchmark report, or path to a JSON benchmark report.
+
+	baseline : dict or str
+	Baseline benchmark report, or path to a JSON benchmark report.
+
+	tolerance : float, optional
+	Relative increase beyond which a measurement is considered a regression.
+
+	Returns
+	-------
+
+	list of dict
+	One entry per regressed measurement, with the keys "stage", "subject", "measure", "baseline", and "value".
+	"""
+	reports = []
+	for i in [report, baseline]:
+		if not isinstance(i, dict):
+			with open(os.path.abspath(os.path.expanduser(i)), "r") as report_file:
+				i = json.load(report_file)
+		reports.append(i)
+	report, baseline = reports
+
+	baseline_results = {(i["stage"], i["subject"]):i for i in baseline["stages"] if i["status"] == "ok"}
+	regressions = []
+	for result in report["stages"]:
+		try:
+			baseline_result = baseline_results[(result["stage"], result["subject"])]
+		except KeyError:
+			continue
+		if result["status"] != "ok":
+			continue
+		for measure in ["wall_time", "peak_rss_mb", "peak_child_rss_mb"]:
+			if result[measure] > baseline_result[measure]*(1+tolerance):
+				regressions.append({
+					"stage":result["stage"],
+					"subject":result["subject"],
+					"measure":measure,
+					"baseline":baseline_result[measure],
+					"value":result[measure],
+					})
+	return regressions
@@ -150,6 +150,133 @@ def structural(substitutions, parameters,
 			print("Running registration:\n{}".format(struct_registration.cmdline))
 			struct_registration_run = struct_registration.run()
 
+def similarity(image, reference,
+	mask=None,
+	bins=32,
+	):
+	"""Return the Pearson correlation and the normalized mutual information between two images of the same shape, optionally within a mask.
+
+	Parameters
+	----------
+
+	image : str
+	Path to a NIfTI image.
+
+	reference : str
+	Path to a NIfTI image of the same shape.
+
+	mask : str, optional
+	Path to a NIfTI mask of the same shape.
+
+	bins : int, optional
+	Number of histogram bins per image for the mutual information estimate.
+
+	Returns
+	-------
+
+	correlation : float
+
+	normalized_mutual_information : float
+	Calculated as (H(image)+H(reference))/H(image,reference), ranging from 1 (independent) to 2 (identical).
+	"""
+	import nibabel as nib
+	import numpy as np
+
+	image = nib.load(os.path.abspath(os.path.expanduser(image))).get_fdata()
+	reference = nib.load(os.path.abspath(os.path.expanduser(reference))).get_fdata()
+	if mask:
+		selection = np.asanyarray(nib.load(os.path.abspath(os.path.expanduser(mask))).dataobj).astype(bool)
+	else:
+		selection = np.ones(reference.shape, dtype=bool)
+	image = image[selection].astype(float)
+	reference = reference[selection].astype(float)
+
+	correlation = np.corrcoef(image, reference)[0,1]
+
+	joint_histogram, _, _ = np.histogram2d(image, reference, bins=bins)
+	joint = joint_histogram/joint_histogram.sum()
+	def entropy(p):
+		p = p[p > 0]
+		return -np.sum(p*np.log(p))
+	normalized_mutual_information = (entropy(joint.sum(axis=0))+entropy(joint.sum(axis=1)))/entropy(joint)
+
+	return correlation, normalized_mutual_information
+
+def preset_tradeoff(moving_images,
+	reference="~/ni_data/templates/DSURQEc_200micron_average.nii",
+	mask="~/ni_data/templates/DSURQEc_200micron_mask.nii",
+	presets=["default","fast"],
+	workdir="~/samri_optimize/presets",
+	threads=6,
+	save_as="",
+	):
+	"""Register structural images to a reference with each of a number of registration presets, and report the resulting similarity and the time taken.
+
+	This allows picking a speed/quality tradeoff (see the `registration_preset` parameter of `samri.pipelines.preprocessing.bruker()`) for a given study.
+
+	Parameters
+	----------
+
+	moving_images : list of str
+	Paths to (bias field corrected) structural images.
+
+	reference : str, optional
+	Path to the registration template.
+
+	mask : str, optional
+	Path to the template mask, used for the registration and for the similarity calculation.
+
+	presets : list of str, optional
+	Keys of `samri.pipelines.nodes.REGISTRATION_PRESETS` to compare.
+
+	workdir : str, optional
+	Directory in which to perform the registrations.
+
+	threads : int, optional
+	Number of threads for each registration.
+
+	save_as : str, optional
+	Path to which to save the results as CSV.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+	With one row per image and preset, and the wall time, correlation and normalized mutual information (see `similarity()`) as columns.
+	"""
+	import time
+	import pandas as pd
+	from samri.pipelines.nodes import DSURQEc_structural_registration, REGISTRATION_PRESETS
+
+	reference = os.path.abspath(os.path.expanduser(reference))
+	if mask:
+		mask = os.path.abspath(os.path.expanduser(mask))
+	workdir = os.path.abspath(os.path.expanduser(workdir))
+
+	results = []
+	for preset in presets:
+		for ix, moving_image in enumerate(moving_images):
+			s_register, _, _, _ = DSURQEc_structural_registration(reference, mask, num_threads=threads, **REGISTRATION_PRESETS[preset])
+			s_register.base_dir = os.path.join(workdir, preset, str(ix))
+			s_register.inputs.moving_image = os.path.abspath(os.path.expanduser(moving_image))
+			s_register.inputs.output_warped_image = True
+			start = time.time()
+			s_register_run = s_register.run()
+			wall_time = time.time()-start
+			correlation, normalized_mutual_information = similarity(s_register_run.outputs.warped_image, reference, mask=mask)
+			results.append({
+				"preset":preset,
+				"image":moving_image,
+				"wall_time":wall_time,
+				"correlation":correlation,
+				"normalized_mutual_information":normalized_mutual_information,
+				})
+
+	df = pd.DataFrame(results, columns=["preset","image","wall_time","correlation","normalized_mutual_information"])
+	if save_as:
+		df.to_csv(os.path.abspath(os.path.expanduser(save_as)), index=False)
+	return df
+
 if __name__ == '__main__':
 	# substitutions = bids_substitution_iterator(
 	# 	["ofM","ofM_aF","ofM_cF1","ofM_cF2","ofM_pF"],
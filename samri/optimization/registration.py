@@ -448,7 +448,7 @@ def structural_to_functional_per_participant_test(subjects_sessions,
 			warp.inputs.input_image_type = 3
 			warp.inputs.interpolation = 'Linear'
 			warp.inputs.invert_transform_flags = [False]
-			warp.inputs.terminal_output = 'file'
+			warp.interface.terminal_output = 'file'
 			warp.inputs.output_image = '{}_{}_5_functionalWarp.nii.gz'.format(*subject_session.values())
 			warp.num_threads = num_threads
 
@@ -603,7 +603,7 @@ def canonical_(subjects_participants,
 			warp.inputs.input_image_type = 3
 			warp.inputs.interpolation = 'Linear'
 			warp.inputs.invert_transform_flags = [False, False]
-			warp.inputs.terminal_output = 'file'
+			warp.interface.terminal_output = 'file'
 			warp.inputs.output_image = '{}_ofM{}.nii.gz'.format(participant,i)
 			warp.num_threads = 6
 
@@ -758,7 +758,7 @@ def canonical(subjects_participants, regdir, f2s,
 			warp.inputs.input_image_type = 3
 			warp.inputs.interpolation = 'Linear'
 			warp.inputs.invert_transform_flags = [False, False]
-			warp.inputs.terminal_output = 'file'
+			warp.interface.terminal_output = 'file'
 			warp.inputs.output_image = '{}/{}_ofM{}.nii.gz'.format(regdir,participant,i)
 			warp.num_threads = 6
 
@@ -1 +1 @@
-__all__ = ["diagnostics", "examples", "extra_functions", "fc", "glm", "nodes", "preprocessing", "utils"]
+__all__ = ["bruker", "catalog", "diagnostics", "examples", "execution", "extra_functions", "fc", "glm", "nodes", "preprocessing", "utils"]
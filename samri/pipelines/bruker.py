@@ -0,0 +1,289 @@
+import mmap
+import os
+import re
+
+try:
+	from utils import write_volumes
+except ImportError:
+	from .utils import write_volumes
+
+#parsed parameter files, keyed by (path, modification time, requested keys)
+_PARAMETER_CACHE = {}
+_PARAMETER_CACHE_SIZE = 512
+
+ARRAY_VALUE = re.compile(r"^\(\s*(?P<shape>[0-9,\s]+)\)\s*\n(?P<data>.*)$", re.DOTALL)
+STRING_VALUE = re.compile(r"<([^>]*)>")
+STRUCTURE_VALUE = re.compile(r"\(([^()]*)\)")
+RUN_LENGTH_VALUE = re.compile(r"^@(?P<count>[0-9]+)\*\((?P<value>[^)]*)\)$")
+
+def _typed(value):
+	"""Convert a JCAMP-DX scalar token to `int` or `float` if possible."""
+	for converter in [int, float]:
+		try:
+			return converter(value)
+		except ValueError:
+			pass
+	return value
+
+def _parse_value(raw_value):
+	"""Parse the raw text of a JCAMP-DX parameter value into a Python object.
+
+	Scalars are returned as `int`, `float`, or `str` (with enclosing angle brackets removed), arrays as lists.
+	"""
+	#drop comment lines and line continuations
+	raw_value = "\n".join([i for i in raw_value.splitlines() if not i.startswith("$$")]).strip()
+	array_match = ARRAY_VALUE.match(raw_value)
+	if array_match:
+		data = array_match.group("data").strip()
+		if data.startswith("<"):
+			strings = STRING_VALUE.findall(data)
+			if len(strings) == 1:
+				return strings[0]
+			return strings
+		if data.startswith("("):
+			#arrays of structures, e.g. `(20, <FG_SLICE>, <>, 0, 2) (300, <FG_CYCLE>, <>, 2, 1)`
+			return [_parse_value("("+i+")") for i in STRUCTURE_VALUE.findall(data)]
+		values = []
+		for token in data.split():
+			run_length_match = RUN_LENGTH_VALUE.match(token)
+			if run_length_match:
+				values.extend([_typed(run_length_match.group("value"))]*int(run_length_match.group("count")))
+			else:
+				values.append(_typed(token))
+		return values
+	if raw_value.startswith("<") and raw_value.endswith(">"):
+		return raw_value[1:-1]
+	if raw_value.startswith("(") and raw_value.endswith(")"):
+		#structures, e.g. `(3, <FG_SLICE>, <>, 0, 2)`
+		return [_parse_value(i.strip()) for i in raw_value[1:-1].split(",")]
+	return _typed(raw_value)
+
+def _read_parameters(file_path, keys=None):
+	parameters = {}
+	with open(file_path, "rb") as parameter_file:
+		try:
+			data = mmap.mmap(parameter_file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			#empty files cannot be memory-mapped
+			return parameters
+		try:
+			position = 0 if data[:2] == b"##" else data.find(b"\n##")
+			while position != -1:
+				if data[position:position+1] == b"\n":
+					position += 1
+				next_position = data.find(b"\n##", position)
+				end = next_position if next_position != -1 else len(data)
+				record = data[position+2:end].decode("latin-1")
+				key, _, raw_value = record.partition("=")
+				#`##$$` records are comments
+				if key.startswith("$$"):
+					key = None
+				else:
+					key = key.lstrip("$")
+				if key is not None and (keys is None or key in keys):
+					parameters[key] = _parse_value(raw_value)
+					#stop reading as soon as all requested keys have been found
+					if keys is not None and len(parameters) == len(keys):
+						break
+				position = next_position
+		finally:
+			data.close()
+	return parameters
+
+def read_parameters(file_path,
+	keys=None,
+	):
+	"""Read a Bruker JCAMP-DX parameter file (e.g. `method`, `acqp`, `subject`, `visu_pars`, or `AdjStatePerScan`) in a single pass.
+
+	Results are memoized per file path and modification time, so that repeated queries for the same file (e.g. from different pipeline nodes running in the same process) do not re-read it.
+
+	Parameters
+	----------
+
+	file_path : str
+	Path to the parameter file.
+
+	keys : list of str, optional
+	Parameter names (without the leading "##$") to read.
+	If specified, reading stops as soon as all of these have been found.
+	If unspecified, all parameters are read.
+
+	Returns
+	-------
+
+	dict
+	Parameter names as keys and the typed (`int`, `float`, `str`, or list) parameter values as values.
+	Requested keys which are not present in the file are omitted.
+	"""
+	file_path = os.path.abspath(os.path.expanduser(file_path))
+	if keys is not None:
+		keys = tuple(sorted(set(keys)))
+	cache_key = (file_path, os.stat(file_path).st_mtime, keys)
+	try:
+		parameters = _PARAMETER_CACHE[cache_key]
+	except KeyError:
+		parameters = _read_parameters(file_path, keys)
+		if len(_PARAMETER_CACHE) >= _PARAMETER_CACHE_SIZE:
+			_PARAMETER_CACHE.clear()
+		_PARAMETER_CACHE[cache_key] = parameters
+	return dict(parameters)
+
+WORD_TYPES = {
+	"_8BIT_UNSGN_INT":"u1",
+	"_16BIT_SGN_INT":"i2",
+	"_32BIT_SGN_INT":"i4",
+	"_32BIT_FLOAT":"f4",
+	}
+BYTE_ORDERS = {
+	"littleEndian":"<",
+	"bigEndian":">",
+	}
+
+def _as_list(value):
+	if isinstance(value, list):
+		return value
+	return [value]
+
+def load_2dseq(scan_dir,
+	actual_size=False,
+	reconstruction="1",
+	):
+	"""Memory-map the reconstructed image data of a Bruker scan, and compute the corresponding NIfTI header.
+
+	Parameters
+	----------
+
+	scan_dir : str
+	Path to the Bruker scan directory (containing the `pdata` directory).
+
+	actual_size : bool, optional
+	Whether to keep the actual voxel size. Otherwise voxel sizes are multiplied by 10 (as done by Bru2), so that the animal brain dimensions resemble those of a human brain.
+
+	reconstruction : str, optional
+	Reconstruction (subdirectory of `pdata`) to load.
+
+	Returns
+	-------
+
+	data : numpy.memmap or numpy.ndarray
+	Image data, 3D or 4D (with frame groups beyond the third spatial dimension flattened into the fourth dimension).
+	If the data scaling is identical for all frames, this is an unscaled view of the memory-mapped `2dseq` file, with the scaling recorded in the header.
+	Otherwise it is a scaled floating point array.
+
+	header : nibabel.Nifti1Header
+	NIfTI header with the data type, voxel size, repetition time, scaling, and (RAS+) affine of the image.
+	"""
+	import nibabel as nib
+	import numpy as np
+
+	reconstruction_dir = os.path.join(os.path.abspath(os.path.expanduser(scan_dir)),"pdata",reconstruction)
+	visu_pars = read_parameters(os.path.join(reconstruction_dir,"visu_pars"))
+
+	dimensions = int(visu_pars["VisuCoreDim"])
+	size = [int(i) for i in _as_list(visu_pars["VisuCoreSize"])]
+	frame_count = int(visu_pars.get("VisuCoreFrameCount", 1))
+	dtype = np.dtype(BYTE_ORDERS[visu_pars.get("VisuCoreByteOrder","littleEndian")]+WORD_TYPES[visu_pars["VisuCoreWordType"]])
+
+	raw_data = np.memmap(os.path.join(reconstruction_dir,"2dseq"), dtype=dtype, mode="r", shape=tuple(size)+(frame_count,), order="F")
+
+	#frame groups are stored with the first group varying fastest
+	frame_group_descriptions = visu_pars.get("VisuFGOrderDesc", [])
+	frame_groups = [int(i[0]) for i in frame_group_descriptions] or [frame_count]
+	if np.prod(frame_groups) != frame_count:
+		raise ValueError("The frame groups of \"{}\" do not account for all {} frames.".format(reconstruction_dir, frame_count))
+	shape = size + frame_groups
+	#single-slice 2D scans have no slice frame group
+	if dimensions == 2 and not (frame_group_descriptions and frame_group_descriptions[0][1] == "FG_SLICE"):
+		shape = size + [1] + frame_groups
+	#NIfTI readers generally handle up to 4 dimensions, so further frame groups (e.g. echoes and repetitions) are flattened
+	shape = shape[:3] + [int(np.prod(shape[3:]))]
+	if shape[3] == 1:
+		shape = shape[:3]
+	data = raw_data.reshape(shape, order="F")
+
+	orientations = np.array(_as_list(visu_pars["VisuCoreOrientation"]), dtype=float).reshape(-1,3,3)
+	if not np.allclose(orientations, orientations[0]):
+		raise ValueError("The frames of \"{}\" have differing orientations (e.g. a localizer), which is not supported; please use Bru2 instead.".format(reconstruction_dir))
+	orientation = orientations[0]
+	positions = np.array(_as_list(visu_pars["VisuCorePosition"]), dtype=float).reshape(-1,3)
+	extent = np.array(_as_list(visu_pars["VisuCoreExtent"]), dtype=float)
+	resolution = extent / np.array(size, dtype=float)
+
+	#the rows of the orientation matrix give the directions of the image axes in the subject coordinate system
+	affine = np.eye(4)
+	affine[:3,0] = orientation[0] * resolution[0]
+	affine[:3,1] = orientation[1] * resolution[1]
+	if dimensions == 2:
+		if len(positions) > 1 and shape[2] > 1:
+			affine[:3,2] = positions[1] - positions[0]
+		else:
+			affine[:3,2] = orientation[2] * float(_as_list(visu_pars.get("VisuCoreFrameThickness", 1))[0])
+	else:
+		affine[:3,2] = orientation[2] * resolution[2]
+	affine[:3,3] = positions[0]
+	#the subject coordinate system is LPS+, NIfTI uses RAS+
+	affine = np.diag([-1,-1,1,1]).dot(affine)
+	if not actual_size:
+		affine[:3,:] *= 10
+
+	slopes = np.array(_as_list(visu_pars.get("VisuCoreDataSlope", 1)), dtype=float)
+	offsets = np.array(_as_list(visu_pars.get("VisuCoreDataOffs", 0)), dtype=float)
+
+	header = nib.Nifti1Header()
+	header.set_data_shape(data.shape)
+	if np.allclose(slopes, slopes[0]) and np.allclose(offsets, offsets[0]):
+		header.set_data_dtype(dtype.newbyteorder("="))
+		header.set_slope_inter(slopes[0], offsets[0])
+	else:
+		data = np.asarray(raw_data, dtype=np.float32) * np.resize(slopes, frame_count) + np.resize(offsets, frame_count)
+		data = data.astype(np.float32).reshape(shape, order="F")
+		header.set_data_dtype(np.float32)
+	zooms = list(np.sqrt(np.sum(affine[:3,:3]**2, axis=0)))
+	if len(data.shape) == 4:
+		zooms.append(float(_as_list(visu_pars.get("VisuAcqRepetitionTime", 1000))[0])/1000.)
+	header.set_zooms(zooms)
+	header.set_xyzt_units("mm","sec")
+	header.set_qform(affine, code=1)
+	header.set_sform(affine, code=1)
+
+	return data, header
+
+def bruker_to_nifti(scan_dir, out_file,
+	actual_size=False,
+	desired_dummy_scans=None,
+	reconstruction="1",
+	compresslevel=1,
+	):
+	"""Convert a Bruker scan to NIfTI in a single read and write pass, optionally cropping initial volumes.
+
+	Parameters
+	----------
+
+	scan_dir : str
+	Path to the Bruker scan directory.
+
+	out_file : str
+	Path to the output NIfTI file (compressed if this ends in ".gz").
+
+	actual_size : bool, optional
+	Whether to keep the actual voxel size, rather than scaling it by 10 (see `load_2dseq()`).
+
+	desired_dummy_scans : int, optional
+	Number of initial timepoints which should be discarded, including the dummy scans already discarded by the scanner (read from the `method` file).
+	If unspecified, no timepoints are cropped.
+
+	reconstruction : str, optional
+	Reconstruction (subdirectory of `pdata`) to convert.
+
+	compresslevel : int, optional
+	Gzip compression level, if `out_file` is compressed.
+	"""
+	data, header = load_2dseq(scan_dir, actual_size=actual_size, reconstruction=reconstruction)
+
+	if desired_dummy_scans is not None and len(data.shape) == 4:
+		dummy_scans = read_parameters(os.path.join(scan_dir,"method"), ["PVM_DummyScans"]).get("PVM_DummyScans", 0)
+		delete_scans = desired_dummy_scans - dummy_scans
+		if delete_scans > 0:
+			data = data[...,delete_scans:]
+
+	return write_volumes(data, header, out_file, compresslevel=compresslevel)
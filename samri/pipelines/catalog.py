@@ -0,0 +1,190 @@
+import os
+import re
+import sqlite3
+from joblib import Parallel, delayed
+
+try:
+	from bruker import read_parameters
+except ImportError:
+	from .bruker import read_parameters
+
+CATALOG_PATH = "~/.samri/bruker_catalog.sqlite"
+
+#directory scanning is dominated by file system latency (particularly on network storage), so we use more threads than cores
+N_JOBS = 8
+
+#ParaVision occasionally fails to write the full scan program, in which case the file is very small and we fall back to the per-scan `acqp` files
+SCAN_PROGRAM_MIN_SIZE = 700
+
+SCAN_PROGRAM_ENTRY = re.compile(r">(?P<scan_type>[^<>]+?) \(E(?P<scan>[^()<>]+)\)</displayName>")
+ACQP_STRING = re.compile(r"<([^<>\n]*)>")
+
+SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS measurements (path TEXT PRIMARY KEY, mtime REAL, subject TEXT, session TEXT, scan_program_size INTEGER)",
+	"CREATE TABLE IF NOT EXISTS scans (path TEXT, position INTEGER, scan_type TEXT, scan TEXT, source TEXT)",
+	"CREATE INDEX IF NOT EXISTS scans_path ON scans (path)",
+	]
+
+def measurement_mtime(measurement_dir):
+	"""Return the most recent modification time of a Bruker measurement directory and the metadata files parsed from it, or `None` if the directory does not exist.
+
+	Parameters
+	----------
+
+	measurement_dir : str
+	Path to a Bruker measurement directory.
+	"""
+	try:
+		mtime = os.stat(measurement_dir).st_mtime
+	except OSError:
+		return None
+	for metadata_file in ["subject", "ScanProgram.scanProgram"]:
+		try:
+			mtime = max(mtime, os.stat(os.path.join(measurement_dir, metadata_file)).st_mtime)
+		except OSError:
+			pass
+	return mtime
+
+def parse_measurement(measurement_dir):
+	"""Parse the subject, session, and scan program information from a Bruker measurement directory.
+
+	The `subject` file is read via `samri.pipelines.bruker.read_parameters()`; the scan program is XML rather than JCAMP-DX, and is matched line by line.
+
+	Parameters
+	----------
+
+	measurement_dir : str
+	Path to a Bruker measurement directory.
+
+	Returns
+	-------
+
+	dict
+	With the keys "subject", "session" (`None` if the directory contains no Bruker `subject` file), "scan_program_size" (`None` if there is no scan program), and "scans".
+	The latter is a list of (scan_type, scan, source) tuples, in file order, where source is either "program" (parsed from `ScanProgram.scanProgram`) or "acqp" (parsed from the acquisition protocols, if the scan program is incomplete).
+	"""
+	record = {"subject":None, "session":None, "scan_program_size":None, "scans":[]}
+	try:
+		subject_parameters = read_parameters(os.path.join(measurement_dir,"subject"), ["SUBJECT_name_string", "SUBJECT_study_name"])
+	except (IOError, OSError):
+		return record
+	record["subject"] = subject_parameters.get("SUBJECT_name_string")
+	record["session"] = subject_parameters.get("SUBJECT_study_name")
+
+	scan_program_file_path = os.path.join(measurement_dir,"ScanProgram.scanProgram")
+	try:
+		record["scan_program_size"] = os.stat(scan_program_file_path).st_size
+		with open(scan_program_file_path, "r") as scan_program_file:
+			for current_line in scan_program_file:
+				for match in SCAN_PROGRAM_ENTRY.finditer(current_line):
+					record["scans"].append((match.group("scan_type"), match.group("scan"), "program"))
+	except (IOError, OSError):
+		return record
+
+	#If the ScanProgram.scanProgram file is small in size, that may be because ParaVision failed to write all the information into the file. This happens occasionally.
+	#Thus we record the strings from the individual acquisition protocols as well. These are a suboptimal and second choice, because acqp scans **also**
+	#keep the original names the sequences had on import (and may thus be misleading, if the name was changed by the user after import).
+	if record["scan_program_size"] <= SCAN_PROGRAM_MIN_SIZE:
+		for sub_sub_dir in sorted(os.listdir(measurement_dir)):
+			try:
+				with open(os.path.join(measurement_dir,sub_sub_dir,"acqp")) as acqp_file:
+					acqp_strings = set(ACQP_STRING.findall(acqp_file.read()))
+			except IOError:
+				continue
+			for acqp_string in sorted(acqp_strings):
+				record["scans"].append((acqp_string, sub_sub_dir, "acqp"))
+
+	return record
+
+def _connect(catalog_path):
+	catalog_path = os.path.abspath(os.path.expanduser(catalog_path))
+	catalog_dir = os.path.dirname(catalog_path)
+	if not os.path.isdir(catalog_dir):
+		os.makedirs(catalog_dir)
+	connection = sqlite3.connect(catalog_path, timeout=60)
+	for statement in SCHEMA:
+		connection.execute(statement)
+	return connection
+
+def _read_record(connection, measurement_dir):
+	row = connection.execute("SELECT mtime, subject, session, scan_program_size FROM measurements WHERE path=?", (measurement_dir,)).fetchone()
+	if row is None:
+		return None, None
+	mtime, subject, session, scan_program_size = row
+	scans = connection.execute("SELECT scan_type, scan, source FROM scans WHERE path=? ORDER BY position", (measurement_dir,)).fetchall()
+	record = {"subject":subject, "session":session, "scan_program_size":scan_program_size, "scans":[tuple(i) for i in scans]}
+	return mtime, record
+
+def _write_record(connection, measurement_dir, mtime, record):
+	connection.execute("DELETE FROM scans WHERE path=?", (measurement_dir,))
+	connection.execute("INSERT OR REPLACE INTO measurements VALUES (?,?,?,?,?)",
+		(measurement_dir, mtime, record["subject"], record["session"], record["scan_program_size"]))
+	connection.executemany("INSERT INTO scans VALUES (?,?,?,?,?)",
+		[(measurement_dir, ix, scan_type, scan, source) for ix, (scan_type, scan, source) in enumerate(record["scans"])])
+
+def _scan_measurement(measurement_dir, cached_mtime, cached_record):
+	"""Return the modification time and record of a measurement directory, parsing it only if the cached record is out of date."""
+	mtime = measurement_mtime(measurement_dir)
+	if mtime is None:
+		return None, None, False
+	if cached_mtime == mtime:
+		return mtime, cached_record, False
+	return mtime, parse_measurement(measurement_dir), True
+
+def catalog_measurements(measurement_dirs,
+	catalog_path=CATALOG_PATH,
+	n_jobs=N_JOBS,
+	):
+	"""Return parsed metadata for a list of Bruker measurement directories, using and incrementally updating an on-disk SQLite catalog.
+
+	Directories are only re-parsed if they are new to the catalog or if their modification time (or that of the `subject` or `ScanProgram.scanProgram` files therein) has changed.
+
+	Parameters
+	----------
+
+	measurement_dirs : list of str
+	Absolute paths to Bruker measurement directories.
+
+	catalog_path : str or bool, optional
+	Path to the SQLite catalog file.
+	If this evaluates to False (or the catalog cannot be opened) all directories are parsed anew, and nothing is recorded.
+
+	n_jobs : int, optional
+	Number of threads with which to check and parse the measurement directories concurrently.
+	Catalog reads and writes are always performed from the calling thread.
+
+	Returns
+	-------
+
+	dict
+	With the measurement directories as keys and the records returned by `parse_measurement()` as values (`None` for directories which do not exist).
+	"""
+	connection = None
+	if catalog_path:
+		try:
+			connection = _connect(catalog_path)
+		except (OSError, sqlite3.Error):
+			print("WARNING: The Bruker catalog at \"{}\" could not be opened, parsing all measurement directories.".format(catalog_path))
+
+	if connection:
+		cached = [_read_record(connection, measurement_dir) for measurement_dir in measurement_dirs]
+	else:
+		cached = [(None, None)]*len(measurement_dirs)
+
+	scanned = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(_scan_measurement),
+		measurement_dirs,
+		[i[0] for i in cached],
+		[i[1] for i in cached],
+		))
+
+	records = {}
+	for measurement_dir, (mtime, record, changed) in zip(measurement_dirs, scanned):
+		records[measurement_dir] = record
+		if connection and changed:
+			_write_record(connection, measurement_dir, mtime, record)
+
+	if connection:
+		connection.commit()
+		connection.close()
+
+	return records
@@ -1,8 +1,8 @@
 from os import path, listdir, getcwd, remove
 try:
-	from extra_functions import get_data_selection, get_scan, write_events_file, force_dummy_scans
+	from extra_functions import get_data_selection, get_scan, session_scans, scan_lookup, write_events_file, force_dummy_scans
 except ImportError:
-	from .extra_functions import get_data_selection, get_scan, write_events_file, force_dummy_scans
+	from .extra_functions import get_data_selection, get_scan, session_scans, scan_lookup, write_events_file, force_dummy_scans
 
 import inspect
 import re
@@ -19,20 +19,20 @@ import pandas as pd
 from nipype.interfaces import afni, fsl, nipy, bru2nii
 
 try:
-	from nodes import functional_registration, structural_registration, composite_registration
-	from utils import ss_to_path, sss_filename, fslmaths_invert_values
-	from utils import STIM_PROTOCOL_DICTIONARY
+	from extra_interfaces import BrukerToNifti
+	from execution import multiproc_arguments, run_workflow
+	from nodes import functional_registration, structural_registration, structural_workflow, composite_registration, estimate_mem_gb, set_resources, DEFAULT_FUNCTIONAL_VOXELS, DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL
+	from utils import ss_to_path, sss_filename, fslmaths_invert_values, set_intermediate_format
+	from utils import INTERMEDIATE_EXTENSIONS, INTERMEDIATE_FORMAT, STIM_PROTOCOL_DICTIONARY
 except ImportError:
-	from .nodes import functional_registration, structural_registration, composite_registration
-	from .utils import ss_to_path, sss_filename, fslmaths_invert_values
-	from .utils import STIM_PROTOCOL_DICTIONARY
+	from .extra_interfaces import BrukerToNifti
+	from .execution import multiproc_arguments, run_workflow
+	from .nodes import functional_registration, structural_registration, structural_workflow, composite_registration, estimate_mem_gb, set_resources, DEFAULT_FUNCTIONAL_VOXELS, DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL
+	from .utils import ss_to_path, sss_filename, fslmaths_invert_values, set_intermediate_format
+	from .utils import INTERMEDIATE_EXTENSIONS, INTERMEDIATE_FORMAT, STIM_PROTOCOL_DICTIONARY
 
 from samri.utilities import N_PROCS
 
-#set all outputs to compressed NIfTI
-afni.base.AFNICommand.set_default_output_type('NIFTI_GZ')
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
-
 #relative paths
 thisscriptspath = path.dirname(path.realpath(__file__))
 scan_classification_file_path = path.join(thisscriptspath,"scan_type_classification.csv")
@@ -54,21 +54,38 @@ def diagnose(measurements_base,
 	exclude_measurements=[],
 	actual_size=False,
 	components=None,
+	intermediate_format=INTERMEDIATE_FORMAT,
 	keep_work=False,
 	loud=False,
+	memory_gb=None,
 	n_procs=N_PROCS,
+	native_conversion=False,
+	profile=False,
 	realign="time",
 	tr=1,
 	workflow_name="diagnostic",
 	):
 	'''
 
+	intermediate_format: {"NIFTI","NIFTI_GZ"}
+		Format of the intermediate images written to the work directory. The MELODIC outputs are always compressed.
+
+	memory_gb: float
+		Memory available to the workflow, in GB. Nodes are scheduled according to their estimated CPU and memory requirements within this limit, and that of `n_procs`. If unspecified, nipype uses 90% of the system memory.
+
+	native_conversion: bool
+		Whether to convert the Bruker data in-process (via `samri.pipelines.extra_interfaces.BrukerToNifti`) rather than via the Bru2 command line tool. This also crops the dummy scans during conversion.
+
+	profile: bool
+		Whether to record the wall time, CPU time, peak memory usage, and thread count of every node run, and write them to "profile.csv" and "profile.json" next to the workflow outputs. These can be summarized via `samri.report.profiling.summarize_profiles()`.
+
 	realign: {"space","time","spacetime",""}
 		Parameter that dictates slictiming correction and realignment of slices. "time" (FSL.SliceTimer) is default, since it works safely. Use others only with caution!
 
 	'''
 	
 	measurements_base = path.abspath(path.expanduser(measurements_base))
+	intermediate_extension = INTERMEDIATE_EXTENSIONS[intermediate_format]
 
 	#select all functional/sturctural scan types unless specified
 	if not functional_scan_types or not structural_scan_types:
@@ -93,20 +110,28 @@ def diagnose(measurements_base,
 
 	# here we start to define the nipype workflow elements (nodes, connectons, meta)
 	subjects_sessions = data_selection[["subject","session"]].drop_duplicates().values.tolist()
+	data_lookup = scan_lookup(data_selection)
 	infosource = pe.Node(interface=util.IdentityInterface(fields=['subject_session']), name="infosource")
 	infosource.iterables = [('subject_session', subjects_sessions)]
 
 	get_f_scan = pe.Node(name='get_f_scan', interface=util.Function(function=get_scan,input_names=inspect.getargspec(get_scan)[0], output_names=['scan_path','scan_type']))
-	get_f_scan.inputs.data_selection = data_selection
 	get_f_scan.inputs.measurements_base = measurements_base
 	get_f_scan.iterables = ("scan_type", functional_scan_types)
 
-	f_bru2nii = pe.Node(interface=bru2nii.Bru2(), name="f_bru2nii")
+	if native_conversion:
+		#the in-process converter also crops the dummy scans, and thus takes the place of the `dummy_scans` node
+		f_bru2nii = pe.Node(interface=BrukerToNifti(), name="f_bru2nii")
+		f_bru2nii.inputs.desired_dummy_scans = 10
+		dummy_scans = f_bru2nii
+		dummy_scans_output = 'nii_file'
+	else:
+		f_bru2nii = pe.Node(interface=bru2nii.Bru2(), name="f_bru2nii")
+		dummy_scans = pe.Node(name='dummy_scans', interface=util.Function(function=force_dummy_scans,input_names=inspect.getargspec(force_dummy_scans)[0], output_names=['out_file']))
+		dummy_scans.inputs.desired_dummy_scans = 10
+		dummy_scans.inputs.out_file = "forced_dummy_scans_file"+intermediate_extension
+		dummy_scans_output = 'out_file'
 	f_bru2nii.inputs.actual_size=actual_size
 
-	dummy_scans = pe.Node(name='dummy_scans', interface=util.Function(function=force_dummy_scans,input_names=inspect.getargspec(force_dummy_scans)[0], output_names=['out_file']))
-	dummy_scans.inputs.desired_dummy_scans = 10
-
 	bids_filename = pe.Node(name='bids_filename', interface=util.Function(function=sss_filename,input_names=inspect.getargspec(sss_filename)[0], output_names=['filename']))
 	bids_filename.inputs.suffix = "MELODIC"
 	bids_filename.inputs.extension = ""
@@ -118,50 +143,57 @@ def diagnose(measurements_base,
 	melodic = pe.Node(interface=fsl.model.MELODIC(), name="melodic")
 	melodic.inputs.tr_sec = tr
 	melodic.inputs.report = True
+	melodic.inputs.output_type = "NIFTI_GZ"
+	set_resources(melodic, 1, estimate_mem_gb(DEFAULT_FUNCTIONAL_VOXELS*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
 	if components:
 		melodic.inputs.dim = int(components)
 
 	workflow_connections = [
-		(infosource, get_f_scan, [('subject_session', 'selector')]),
+		(infosource, get_f_scan, [(('subject_session',session_scans,data_lookup), 'data_selection')]),
 		(get_f_scan, f_bru2nii, [('scan_path', 'input_dir')]),
-		(f_bru2nii, dummy_scans, [('nii_file', 'in_file')]),
-		(get_f_scan, dummy_scans, [('scan_path', 'scan_dir')]),
 		(infosource, datasink, [(('subject_session',ss_to_path), 'container')]),
 		(infosource, bids_filename, [('subject_session', 'subject_session')]),
 		(get_f_scan, bids_filename, [('scan_type', 'scan')]),
 		(bids_filename, melodic, [('filename', 'out_dir')]),
 		(melodic, datasink, [('out_dir', 'func')]),
 		]
+	if not native_conversion:
+		workflow_connections.extend([
+			(f_bru2nii, dummy_scans, [('nii_file', 'in_file')]),
+			(get_f_scan, dummy_scans, [('scan_path', 'scan_dir')]),
+			])
 
 	#ADDING SELECTABLE NODES AND EXTENDING WORKFLOW AS APPROPRIATE:
 	if structural_scan_types:
 		get_s_scan = pe.Node(name='get_s_scan', interface=util.Function(function=get_scan,input_names=inspect.getargspec(get_scan)[0], output_names=['scan_path','scan_type']))
-		get_s_scan.inputs.data_selection = data_selection
 		get_s_scan.inputs.measurements_base = measurements_base
 		get_s_scan.iterables = ("scan_type", structural_scan_types)
 
-		s_bru2nii = pe.Node(interface=bru2nii.Bru2(), name="s_bru2nii")
-		s_bru2nii.inputs.force_conversion=True
-		s_bru2nii.inputs.actual_size=actual_size
+		#only the conversion of the shared structural workflow is needed for diagnostics
+		structural = structural_workflow(None,
+			actual_size=actual_size,
+			native_conversion=native_conversion,
+			register=False,
+			)
 
 		s_bids_filename = pe.Node(name='s_bids_filename', interface=util.Function(function=sss_filename,input_names=inspect.getargspec(sss_filename)[0], output_names=['filename']))
 		s_bids_filename.inputs.extension = ""
 		s_bids_filename.inputs.scan_prefix = False
 
 		workflow_connections.extend([
-			(infosource, get_s_scan, [('subject_session', 'selector')]),
+			(infosource, get_s_scan, [(('subject_session',session_scans,data_lookup), 'data_selection')]),
 			(infosource, s_bids_filename, [('subject_session', 'subject_session')]),
-			(get_s_scan, s_bru2nii, [('scan_path','input_dir')]),
+			(get_s_scan, structural, [('scan_path','inputnode.scan_path')]),
 			(get_s_scan, s_bids_filename, [('scan_type', 'scan')]),
-			(s_bids_filename, s_bru2nii, [('filename','output_filename')]),
-			(s_bru2nii, datasink, [('nii_file', 'anat')]),
+			(s_bids_filename, structural, [('filename','s_bru2nii.output_filename')]),
+			(structural, datasink, [('outputnode.nii_file', 'anat')]),
 			])
 
 	if realign == "space":
 		realigner = pe.Node(interface=spm.Realign(), name="realigner")
 		realigner.inputs.register_to_mean = True
 		workflow_connections.extend([
-			(dummy_scans, realigner, [('out_file', 'in_file')]),
+			(dummy_scans, realigner, [(dummy_scans_output, 'in_file')]),
 			(realigner, melodic, [('out_file', 'in_files')]),
 			])
 
@@ -171,7 +203,7 @@ def diagnose(measurements_base,
 		realigner.inputs.tr = tr
 		realigner.inputs.slice_info = 3 #3 for coronal slices (2 for horizontal, 1 for sagittal)
 		workflow_connections.extend([
-			(dummy_scans, realigner, [('out_file', 'in_file')]),
+			(dummy_scans, realigner, [(dummy_scans_output, 'in_file')]),
 			(realigner, melodic, [('out_file', 'in_files')]),
 			])
 	
@@ -179,28 +211,31 @@ def diagnose(measurements_base,
 		realigner = pe.Node(interface=fsl.SliceTimer(), name="slicetimer")
 		realigner.inputs.time_repetition = tr
 		workflow_connections.extend([
-			(dummy_scans, realigner, [('out_file', 'in_file')]),
+			(dummy_scans, realigner, [(dummy_scans_output, 'in_file')]),
 			(realigner, melodic, [('slice_time_corrected_file', 'in_files')]),
 			])
 	else:
 		workflow_connections.extend([
-			(dummy_scans, melodic, [('out_file', 'in_files')]),
+			(dummy_scans, melodic, [(dummy_scans_output, 'in_files')]),
 			])
 
 	workdir_name = workflow_name+"_work"
 	workflow = pe.Workflow(name=workdir_name)
 	workflow.connect(workflow_connections)
+	#the MELODIC report is a final output, and keeps its compressed format
+	set_intermediate_format(workflow, intermediate_format, exclude=["melodic"])
 	workflow.base_dir = path.join(measurements_base)
 	workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph.dot"), graph2use="hierarchical", format="png")
+	profile_dir = datasink.inputs.base_directory if profile else None
 	if not loud:
 		try:
-			workflow.run(plugin="MultiProc",  plugin_args={'n_procs' : n_procs})
+			run_workflow(workflow, plugin="MultiProc", plugin_args=multiproc_arguments(n_procs, memory_gb), keep_work=keep_work, profile_dir=profile_dir)
 		except RuntimeError:
 			print("WARNING: Some expected scans have not been found (or another TypeError has occured).")
+			if not keep_work:
+				shutil.rmtree(path.join(workflow.base_dir,workdir_name))
 		for f in listdir(getcwd()):
 			if re.search("crash.*?get_s_scan|get_f_scan.*?pklz", f):
 				remove(path.join(getcwd(), f))
 	else:
-		workflow.run(plugin="MultiProc",  plugin_args={'n_procs' : n_procs})
-	if not keep_work:
-		shutil.rmtree(path.join(workflow.base_dir,workdir_name))
+		run_workflow(workflow, plugin="MultiProc", plugin_args=multiproc_arguments(n_procs, memory_gb), keep_work=keep_work, profile_dir=profile_dir)
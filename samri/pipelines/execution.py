@@ -0,0 +1,328 @@
+import json
+import os
+import shutil
+import time
+
+NODE_CACHE = "~/.samri/node_cache"
+NODE_CACHE_SIZE_GB = 50
+
+#nodes whose results are expensive enough to be worth keeping across runs
+PREPROCESSING_CACHED_NODES = ["s_register", "f_register", "s_biascorrect", "f_biascorrect", "bandpass"]
+L1_CACHED_NODES = ["glm"]
+L2_CACHED_NODES = ["flameo"]
+#sub-workflows whose node paths do not depend on the enclosing workflow, so that their cached results can be shared across workflows (see `samri.pipelines.nodes.structural_workflow()`)
+SHARED_WORKFLOWS = ["structural"]
+
+def _node_hash(node_dir):
+	"""Return the nipype input hash of a node directory (from its `_0x<hash>.json` file), or `None` if the node has not completed."""
+	hash_files = [i for i in os.listdir(node_dir) if i.startswith("_0x") and i.endswith(".json")]
+	result_files = [i for i in os.listdir(node_dir) if i.startswith("result_") and i.endswith(".pklz")]
+	if len(hash_files) != 1 or not result_files:
+		return None
+	return hash_files[0][3:-5]
+
+def _directory_size(directory):
+	size = 0
+	for root, _, files in os.walk(directory):
+		for name in files:
+			try:
+				size += os.lstat(os.path.join(root, name)).st_size
+			except OSError:
+				pass
+	return size
+
+def restore_cached_nodes(work_dir,
+	node_cache=NODE_CACHE,
+	shared_workflows=SHARED_WORKFLOWS,
+	):
+	"""Restore cached node directories into a (fresh) nipype work directory, so that nipype can reuse their results.
+
+	Nipype only reuses a restored node if the hash of its inputs still matches, so stale entries are simply re-run.
+	Workflows should thus use the "content" `hash_method`, as the file timestamps of regenerated upstream outputs will differ from those of the previous run.
+
+	Parameters
+	----------
+
+	work_dir : str
+	Path to the nipype work directory (i.e. the `base_dir` of the workflow, joined with its name).
+
+	node_cache : str, optional
+	Path to the node cache directory.
+
+	shared_workflows : list of str, optional
+	Names of sub-workflows whose cached nodes are restored regardless of the work directory they were stored from, so that e.g. the structural preprocessing of a session is shared by all workflows processing it.
+
+	Returns
+	-------
+
+	list of str
+	The node directories which were restored.
+	"""
+	work_dir = os.path.abspath(os.path.expanduser(work_dir))
+	node_cache = os.path.abspath(os.path.expanduser(node_cache))
+	if not os.path.isdir(node_cache):
+		return []
+
+	#the most recently stored entry for each location takes precedence
+	entries = {}
+	for node_hash in os.listdir(node_cache):
+		entry_dir = os.path.join(node_cache, node_hash)
+		try:
+			with open(os.path.join(entry_dir, "entry.json"), "r") as entry_file:
+				entry = json.load(entry_file)
+		except (IOError, OSError, ValueError):
+			continue
+		if entry["work_dir"] != work_dir and entry["relpath"].split(os.sep)[0] not in shared_workflows:
+			continue
+		mtime = os.stat(entry_dir).st_mtime
+		if entry["relpath"] not in entries or entries[entry["relpath"]][0] < mtime:
+			entries[entry["relpath"]] = (mtime, entry_dir)
+
+	restored = []
+	for relpath, (_, entry_dir) in entries.items():
+		node_dir = os.path.join(work_dir, relpath)
+		if os.path.exists(node_dir):
+			continue
+		shutil.copytree(os.path.join(entry_dir, "node"), node_dir, symlinks=True)
+		#mark the entry as recently used
+		os.utime(entry_dir, None)
+		restored.append(node_dir)
+	return restored
+
+def store_cached_nodes(work_dir,
+	node_names=PREPROCESSING_CACHED_NODES,
+	node_cache=NODE_CACHE,
+	node_cache_size_gb=NODE_CACHE_SIZE_GB,
+	move=False,
+	):
+	"""Store completed node directories from a nipype work directory in a content-addressed cache, keyed by the hash of their inputs.
+
+	Parameters
+	----------
+
+	work_dir : str
+	Path to the nipype work directory (i.e. the `base_dir` of the workflow, joined with its name).
+
+	node_names : list of str, optional
+	Names of the nodes to store.
+
+	node_cache : str, optional
+	Path to the node cache directory.
+
+	node_cache_size_gb : float, optional
+	Maximal size of the node cache; least recently used entries are evicted beyond this size.
+
+	move : bool, optional
+	Whether to move rather than copy the node directories (e.g. if the work directory is deleted afterwards).
+
+	Returns
+	-------
+
+	list of str
+	The hashes of the stored entries.
+	"""
+	work_dir = os.path.abspath(os.path.expanduser(work_dir))
+	node_cache = os.path.abspath(os.path.expanduser(node_cache))
+
+	stored = []
+	for root, dirs, _ in os.walk(work_dir):
+		for node_name in [i for i in dirs if i in node_names]:
+			node_dir = os.path.join(root, node_name)
+			node_hash = _node_hash(node_dir)
+			if not node_hash:
+				continue
+			entry_dir = os.path.join(node_cache, node_hash)
+			if not os.path.isdir(entry_dir):
+				if not os.path.isdir(node_cache):
+					os.makedirs(node_cache)
+				#write to a temporary location first, so that interrupted writes do not leave incomplete entries
+				temporary_dir = "{}.{}.tmp".format(entry_dir, os.getpid())
+				os.makedirs(temporary_dir)
+				if move:
+					shutil.move(node_dir, os.path.join(temporary_dir, "node"))
+				else:
+					shutil.copytree(node_dir, os.path.join(temporary_dir, "node"), symlinks=True)
+				with open(os.path.join(temporary_dir, "entry.json"), "w") as entry_file:
+					json.dump({"work_dir":work_dir, "relpath":os.path.relpath(node_dir, work_dir), "time":time.time()}, entry_file)
+				os.rename(temporary_dir, entry_dir)
+			os.utime(entry_dir, None)
+			stored.append(node_hash)
+		#do not descend into node directories which have been moved to the cache
+		dirs[:] = [i for i in dirs if os.path.isdir(os.path.join(root, i))]
+
+	evict_cached_nodes(node_cache, node_cache_size_gb)
+	return stored
+
+def evict_cached_nodes(node_cache=NODE_CACHE,
+	node_cache_size_gb=NODE_CACHE_SIZE_GB,
+	):
+	"""Delete the least recently used node cache entries until the cache is no larger than the given size.
+
+	Parameters
+	----------
+
+	node_cache : str, optional
+	Path to the node cache directory.
+
+	node_cache_size_gb : float, optional
+	Maximal size of the node cache.
+	"""
+	node_cache = os.path.abspath(os.path.expanduser(node_cache))
+	if not os.path.isdir(node_cache):
+		return
+	entries = []
+	for node_hash in os.listdir(node_cache):
+		entry_dir = os.path.join(node_cache, node_hash)
+		if node_hash.endswith(".tmp") or not os.path.isdir(entry_dir):
+			continue
+		entries.append((os.stat(entry_dir).st_mtime, _directory_size(entry_dir), entry_dir))
+	entries.sort()
+	total_size = sum([i[1] for i in entries])
+	max_size = node_cache_size_gb * 1024**3
+	for _, size, entry_dir in entries:
+		if total_size <= max_size:
+			break
+		shutil.rmtree(entry_dir, ignore_errors=True)
+		total_size -= size
+
+PROFILE_FIELDS = ["workflow", "node", "iterables", "status", "start", "end", "wall_time", "cpu_time", "cpu_percent", "peak_rss_gb", "threads", "output_dir"]
+
+class NodeProfiler(object):
+	"""Nipype status callback recording the wall time, CPU time, peak resident set size (RSS), and thread count of each node run.
+
+	The CPU time, peak RSS, and thread count are only available if the nipype resource monitor is enabled.
+	"""
+	def __init__(self):
+		self.records = []
+
+	def __call__(self, node, status):
+		if status not in ("end", "exception"):
+			return
+		record = dict.fromkeys(PROFILE_FIELDS)
+		record["workflow"] = node.fullname.split(".")[0]
+		record["node"] = node.name
+		record["iterables"] = "/".join([i.lstrip("_") for i in node.parameterization])
+		record["status"] = status
+		try:
+			record["output_dir"] = node.output_dir()
+			runtime = node.result.runtime
+		except Exception:
+			runtime = None
+		if isinstance(runtime, list):
+			#MapNodes report one runtime per subnode
+			runtime = runtime[0] if len(runtime) == 1 else None
+		if runtime is not None:
+			record["start"] = getattr(runtime, "startTime", None)
+			record["end"] = getattr(runtime, "endTime", None)
+			record["wall_time"] = getattr(runtime, "duration", None)
+			record["cpu_percent"] = getattr(runtime, "cpu_percent", None)
+			record["peak_rss_gb"] = getattr(runtime, "mem_peak_gb", None)
+			record["threads"] = getattr(runtime, "nthreads_max", None)
+			if record["wall_time"] is not None and record["cpu_percent"] is not None:
+				record["cpu_time"] = record["wall_time"]*record["cpu_percent"]/100.
+		self.records.append(record)
+
+	def write(self, profile_dir):
+		"""Write the recorded node runs to "profile.csv" and "profile.json" in the given directory, and return the path of the former."""
+		import pandas as pd
+		profile_dir = os.path.abspath(os.path.expanduser(profile_dir))
+		if not os.path.isdir(profile_dir):
+			os.makedirs(profile_dir)
+		df = pd.DataFrame(self.records, columns=PROFILE_FIELDS)
+		csv_path = os.path.join(profile_dir, "profile.csv")
+		df.to_csv(csv_path, index=False)
+		df.to_json(os.path.join(profile_dir, "profile.json"), orient="records")
+		return csv_path
+
+def multiproc_arguments(n_procs,
+	memory_gb=None,
+	):
+	"""Return the arguments for the nipype MultiProc plugin, which schedules nodes according to their declared `n_procs` and `mem_gb` (see `samri.pipelines.nodes.set_resources()`) within these limits.
+
+	Parameters
+	----------
+
+	n_procs : int
+	Number of processors available to the workflow.
+
+	memory_gb : float, optional
+	Memory available to the workflow, in GB. If unspecified, nipype uses 90% of the system memory.
+	"""
+	plugin_args = {"n_procs":n_procs}
+	if memory_gb:
+		plugin_args["memory_gb"] = memory_gb
+	return plugin_args
+
+def run_workflow(workflow,
+	plugin="MultiProc",
+	plugin_args={},
+	keep_work=False,
+	cached_nodes=[],
+	node_cache=NODE_CACHE,
+	node_cache_size_gb=NODE_CACHE_SIZE_GB,
+	profile_dir=None,
+	):
+	"""Run a nipype workflow, reusing the results of expensive nodes from previous runs (even if their work directory was deleted) via a content-addressed node cache.
+
+	Parameters
+	----------
+
+	workflow : nipype.pipeline.engine.Workflow
+	Workflow to run, with its `base_dir` set.
+
+	plugin : str, optional
+	Nipype execution plugin.
+
+	plugin_args : dict, optional
+	Arguments for the nipype execution plugin.
+
+	keep_work : bool, optional
+	Whether to keep the work directory after the workflow has run.
+
+	cached_nodes : list of str, optional
+	Names of the nodes whose results to cache.
+
+	node_cache : str or bool, optional
+	Path to the node cache directory. If this evaluates to False, no caching is performed.
+
+	node_cache_size_gb : float, optional
+	Maximal size of the node cache; least recently used entries are evicted beyond this size.
+
+	profile_dir : str, optional
+	Directory in which to write the per-node timing and memory usage of the run (see `NodeProfiler`), as "profile.csv" and "profile.json".
+	If specified, the nipype resource monitor is enabled.
+	"""
+	work_dir = os.path.join(workflow.base_dir, workflow.name)
+	if node_cache and cached_nodes:
+		workflow.config.setdefault("execution", {})["hash_method"] = "content"
+		restore_cached_nodes(work_dir, node_cache=node_cache)
+
+	profiler = None
+	if profile_dir:
+		from nipype import config
+		config.enable_resource_monitor()
+		profiler = NodeProfiler()
+		plugin_args = dict(plugin_args, status_callback=profiler)
+
+	try:
+		workflow.run(plugin=plugin, plugin_args=plugin_args)
+	except:
+		#the nodes which did complete are cached and profiled nonetheless, but the work directory is kept for debugging
+		if node_cache and cached_nodes:
+			store_cached_nodes(work_dir, node_names=cached_nodes, node_cache=node_cache, node_cache_size_gb=node_cache_size_gb)
+		if profiler:
+			profiler.write(profile_dir)
+		raise
+
+	if profiler:
+		profiler.write(profile_dir)
+
+	if node_cache and cached_nodes:
+		store_cached_nodes(work_dir,
+			node_names=cached_nodes,
+			node_cache=node_cache,
+			node_cache_size_gb=node_cache_size_gb,
+			move=not keep_work,
+			)
+	if not keep_work:
+		shutil.rmtree(work_dir)
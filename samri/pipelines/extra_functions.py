@@ -1,18 +1,21 @@
 import csv
 import inspect
 import os
-import re
 
 import nibabel as nb
 import pandas as pd
 try:
 	from utils import STIM_PROTOCOL_DICTIONARY
+	from catalog import CATALOG_PATH, N_JOBS, catalog_measurements
 except ImportError:
 	from .utils import STIM_PROTOCOL_DICTIONARY
+	from .catalog import CATALOG_PATH, N_JOBS, catalog_measurements
 
 def force_dummy_scans(in_file, scan_dir,
 	desired_dummy_scans=10,
 	out_file="forced_dummy_scans_file.nii.gz",
+	mode="stream",
+	compresslevel=1,
 	):
 	"""Take a scan and crop initial timepoints depending upon the number of dummy scans (determined from a Bruker scan directory) and the desired number of dummy scans.
 
@@ -24,30 +27,42 @@ def force_dummy_scans(in_file, scan_dir,
 
 	desired_dummy_scans : int , optional
 	Desired timepoints dummy scans.
+
+	out_file : string , optional
+	Path to the cropped output file (uncompressed unless this ends in ".gz").
+
+	mode : {"stream", "load"} , optional
+	"stream" slices the required volumes from the (memory-mapped, if uncompressed) input and writes them a chunk at a time, so that the full series is never held in memory.
+	"load" reads all of the retained volumes into memory at once, and writes them in one pass.
+
+	compresslevel : int , optional
+	Gzip compression level, if `out_file` is compressed.
 	"""
 
 	import nibabel as nib
 	from os import path
+	from samri.pipelines.bruker import read_parameters
+	from samri.pipelines.utils import write_volumes
+
+	if mode not in ("stream", "load"):
+		raise ValueError('Unsupported mode "{}", choose one of "stream" or "load".'.format(mode))
 
 	out_file = path.abspath(path.expanduser(out_file))
 
-	method_file_path = path.join(scan_dir,"method")
-	method_file = open(method_file_path, "r")
-	dummy_scans = 0
-	while True:
-		current_line = method_file.readline()
-		if "##$PVM_DummyScans=" in current_line:
-			dummy_scans = int(current_line.split("=")[1])
-			break
+	method_parameters = read_parameters(path.join(scan_dir,"method"), ["PVM_DummyScans"])
+	dummy_scans = method_parameters.get("PVM_DummyScans", 0)
 
 	delete_scans = desired_dummy_scans - dummy_scans
 
 	if delete_scans <= 0:
 		out_file = in_file
-	else:
+	elif mode == "load":
 		img = nib.load(in_file)
-		img_ = nib.Nifti1Image(img.get_data()[...,delete_scans:], img.affine, img.header)
+		img_ = nib.Nifti1Image(img.dataobj[...,delete_scans:], img.affine, img.header)
 		nib.save(img_,out_file)
+	else:
+		img = nib.load(in_file)
+		write_volumes(img.dataobj, img.header, out_file, compresslevel=compresslevel, first_volume=delete_scans, scaled=True)
 
 	return out_file
 
@@ -68,13 +83,105 @@ def write_function_call(frame, target_path):
 	target.write(function_call)
 	target.close()
 
+PROTOCOL_TIMINGS_CACHE = "~/.samri/protocol_timings.json"
+#resolved stimulation protocol timings, keyed by (database path, database modification time, protocol code)
+_protocol_timings = {}
+
+def stimulation_protocol_timings(trial_codes,
+	db_path="~/syncdata/meta.db",
+	cache_path=None,
+	):
+	"""Resolve the timings of a number of LabbookDB `LaserStimulationProtocol` entries via a single database session and query.
+
+	Results are cached in memory (and optionally in a small JSON file), and are invalidated if the database file changes.
+
+	Parameters
+	----------
+
+	trial_codes : iterable of str
+	Codes of the stimulation protocols to resolve (e.g. the values of `samri.pipelines.utils.STIM_PROTOCOL_DICTIONARY`).
+
+	db_path : str, optional
+	Path to the LabbookDB database.
+
+	cache_path : str, optional
+	Path to a JSON file in which to additionally cache the resolved timings across Python sessions (e.g. `PROTOCOL_TIMINGS_CACHE`).
+
+	Returns
+	-------
+
+	dict
+	Protocol codes as keys and (stimulation_onset, inter_stimulus_duration, stimulus_duration, stimulus_repetitions) tuples as values.
+	Codes not found in the database are omitted.
+	"""
+	import json
+
+	db_path = os.path.abspath(os.path.expanduser(db_path))
+	db_mtime = os.stat(db_path).st_mtime
+	trial_codes = sorted(set(trial_codes))
+
+	if cache_path:
+		cache_path = os.path.abspath(os.path.expanduser(cache_path))
+		try:
+			with open(cache_path, "r") as cache_file:
+				file_cache = json.load(cache_file)
+		except (IOError, ValueError):
+			file_cache = {}
+		if file_cache.get("db_path") == db_path and file_cache.get("db_mtime") == db_mtime:
+			for trial_code, timings in file_cache["timings"].items():
+				_protocol_timings[(db_path, db_mtime, trial_code)] = tuple(timings)
+
+	missing_codes = [i for i in trial_codes if (db_path, db_mtime, i) not in _protocol_timings]
+	if missing_codes:
+		from labbookdb.db.query import load_session
+		from labbookdb.db.common_classes import LaserStimulationProtocol
+
+		session, engine = load_session(db_path)
+		sql_query = session.query(LaserStimulationProtocol).filter(LaserStimulationProtocol.code.in_(missing_codes))
+		mydf = pd.read_sql_query(sql_query.statement,engine)
+		session.close()
+		for _, row in mydf.drop_duplicates("code").iterrows():
+			_protocol_timings[(db_path, db_mtime, row["code"])] = (
+				int(row["stimulation_onset"]),
+				int(row["inter_stimulus_duration"]),
+				float(row["stimulus_duration"]),
+				int(row["stimulus_repetitions"]),
+				)
+
+	timings = {}
+	for trial_code in trial_codes:
+		try:
+			timings[trial_code] = _protocol_timings[(db_path, db_mtime, trial_code)]
+		except KeyError:
+			pass
+
+	if cache_path and missing_codes:
+		cache_dir = os.path.dirname(cache_path)
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		all_timings = {key[2]:value for key, value in _protocol_timings.items() if key[:2] == (db_path, db_mtime)}
+		with open(cache_path, "w") as cache_file:
+			json.dump({"db_path":db_path, "db_mtime":db_mtime, "timings":all_timings}, cache_file, indent=1)
+
+	return timings
+
 def write_events_file(scan_dir, scan_type, stim_protocol_dictionary,
 	db_path="~/syncdata/meta.db",
 	out_file="events.tsv",
 	dummy_scans_ms="determine",
 	subject_delay=False,
 	very_nasty_bruker_delay_hack=False,
+	protocol_timings=None,
 	):
+	"""Write a BIDS events file for a Bruker scan, based on the stimulation protocol corresponding to its scan type.
+
+	Parameters
+	----------
+
+	protocol_timings : dict, optional
+	Protocol codes as keys and (stimulation_onset, inter_stimulus_duration, stimulus_duration, stimulus_repetitions) tuples as values, as returned by `stimulation_protocol_timings()`.
+	If specified, the database at `db_path` is not queried.
+	"""
 
 	import csv
 	import sys
@@ -83,8 +190,7 @@ def write_events_file(scan_dir, scan_type, stim_protocol_dictionary,
 	from os import path
 	import pandas as pd
 	import numpy as np
-	from labbookdb.db.query import load_session
-	from labbookdb.db.common_classes import LaserStimulationProtocol
+	from samri.pipelines.bruker import read_parameters
 
 	out_file = path.abspath(path.expanduser(out_file))
 
@@ -94,39 +200,22 @@ def write_events_file(scan_dir, scan_type, stim_protocol_dictionary,
 
 		#Here we read the `AdjStatePerScan` file, which may be missing if no adjustments were run at the beginning of this scan
 		try:
-			state_file = open(state_file_path, "r")
-		except IOError:
-			delay_seconds = 0
-		else:
-			while True:
-				current_line = state_file.readline()
-				if "AdjScanStateTime" in current_line:
-					delay_datetime_line = state_file.readline()
-					break
-
-			trigger_time, scanstart_time = [datetime.utcnow().strptime(i.split("+")[0], "<%Y-%m-%dT%H:%M:%S,%f") for i in delay_datetime_line.split(" ")]
+			state_parameters = read_parameters(state_file_path, ["AdjScanStateTime"])
+		except (IOError, OSError):
+			state_parameters = {}
+		if "AdjScanStateTime" in state_parameters:
+			trigger_time, scanstart_time = [datetime.strptime(i.split("+")[0], "%Y-%m-%dT%H:%M:%S,%f") for i in state_parameters["AdjScanStateTime"]]
 			delay = scanstart_time-trigger_time
 			delay_seconds=delay.total_seconds()
 			if very_nasty_bruker_delay_hack:
 				delay_seconds += 12
+		else:
+			delay_seconds = 0
 
 		#Here we read the `method` file, which contains info about dummy scans
-		method_file_path = path.join(scan_dir,"method")
-		method_file = open(method_file_path, "r")
-
-		read_variables=0 #count variables so that breaking takes place after both have been read
-
 		if dummy_scans_ms == "determine":
-			while True:
-				current_line = method_file.readline()
-				if "##$PVM_DummyScans=" in current_line:
-					dummy_scans = int(current_line.split("=")[1])
-					read_variables +=1 #count variables
-				if "##$PVM_DummyScansDur=" in current_line:
-					dummy_scans_ms = int(current_line.split("=")[1])
-					read_variables +=1 #count variables
-				if read_variables == 2:
-					break #prevent loop from going on forever
+			method_parameters = read_parameters(path.join(scan_dir,"method"), ["PVM_DummyScans", "PVM_DummyScansDur"])
+			dummy_scans_ms = method_parameters["PVM_DummyScansDur"]
 
 		subject_delay = delay_seconds + dummy_scans_ms/1000
 
@@ -135,14 +224,10 @@ def write_events_file(scan_dir, scan_type, stim_protocol_dictionary,
 	except KeyError:
 		return
 
-	session, engine = load_session(db_path)
-	sql_query=session.query(LaserStimulationProtocol).filter(LaserStimulationProtocol.code==trial_code)
-	mystring = sql_query.statement
-	mydf = pd.read_sql_query(mystring,engine)
-	delay = int(mydf["stimulation_onset"][0])
-	inter_stimulus_duration = int(mydf["inter_stimulus_duration"][0])
-	stimulus_duration = mydf["stimulus_duration"][0]
-	stimulus_repetitions = mydf["stimulus_repetitions"][0]
+	if protocol_timings is None:
+		from samri.pipelines.extra_functions import stimulation_protocol_timings
+		protocol_timings = stimulation_protocol_timings([trial_code], db_path=db_path)
+	delay, inter_stimulus_duration, stimulus_duration, stimulus_repetitions = protocol_timings[trial_code]
 
 	onsets=[]
 	names=[]
@@ -229,21 +314,208 @@ def get_level2_inputs(input_root, categories=[], participants=[], scan_types=[])
 
 	return l2_inputs
 
+def scan_lookup(data_selection):
+	"""Convert a data selection into a nested dictionary, for constant-time scan lookup in pipeline nodes.
+
+	Parameters
+	----------
+
+	data_selection : pandas.DataFrame
+	Data selection, as produced by `get_data_selection()`.
+
+	Returns
+	-------
+
+	dict
+	Nested dictionary of the form `lookup[subject][session][scan_type] = (measurement, scan)`.
+	This only contains strings, and is thus much cheaper to hash and pickle as a node input than the `pandas.DataFrame`.
+	If there are multiple matches for a subject, session, and scan type, the first one is retained.
+	"""
+	lookup = {}
+	for subject, session, measurement, scan_type, scan in data_selection[["subject","session","measurement","scan_type","scan"]].values.tolist():
+		lookup.setdefault(subject, {}).setdefault(session, {}).setdefault(scan_type, (measurement, scan))
+	return lookup
+
+def subject_scans(subject, data_lookup):
+	"""Return the scans of all sessions of a subject from a `scan_lookup()` dictionary, as a dictionary with sessions as keys and `session_scans()`-style dictionaries as values.
+
+	This is meant to be used as a connection function, analogously to `session_scans()`.
+	"""
+	return data_lookup.get(subject, {})
+
+def session_scans(subject_session, data_lookup):
+	"""Return the scans of a (subject, session) pair from a `scan_lookup()` dictionary, as a small dictionary with scan types as keys and (measurement, scan) tuples as values.
+
+	This is meant to be used as a connection function, so that nodes receive (and hash) only the scans of their session, rather than the lookup dictionary for the whole data selection.
+	"""
+	return data_lookup.get(subject_session[0], {}).get(subject_session[1], {})
+
 def get_scan(measurements_base, data_selection, scan_type, selector=None, subject=None, session=None):
+	"""Return the path of the Bruker scan directory for a subject, session, and scan type.
+
+	Parameters
+	----------
+
+	measurements_base : str
+	Path to the directory containing the Bruker measurement directories.
+
+	data_selection : dict or pandas.DataFrame
+	Scans of the session, as produced by `session_scans()`, or, alternatively, a data selection as produced by `get_data_selection()`.
+
+	scan_type : str
+	Scan type to look up.
+
+	selector : list, optional
+	Length-2 list of subject and session identifiers, used if `subject` or `session` are not specified.
+	Not needed if `data_selection` contains only the scans of the session.
+	"""
 	import os #for some reason the import outside the function fails
-	import pandas as pd
-	scan_paths = []
-	if not subject:
-		subject = selector[0]
-	if not session:
-		session = selector[1]
-	filtered_data = data_selection[(data_selection["session"] == session)&(data_selection["subject"] == subject)&(data_selection["scan_type"] == scan_type)]
-	measurement_path = filtered_data["measurement"].tolist()[0]
-	scan_subdir = filtered_data["scan"].tolist()[0]
+	if isinstance(data_selection, dict):
+		measurement_path, scan_subdir = data_selection[scan_type]
+	else:
+		if not subject:
+			subject = selector[0]
+		if not session:
+			session = selector[1]
+		filtered_data = data_selection[(data_selection["session"] == session)&(data_selection["subject"] == subject)&(data_selection["scan_type"] == scan_type)]
+		measurement_path = filtered_data["measurement"].tolist()[0]
+		scan_subdir = filtered_data["scan"].tolist()[0]
 	scan_path = os.path.join(measurements_base,measurement_path,scan_subdir)
 	return scan_path, scan_type
 
-def get_data_selection(workflow_base, sessions=[], scan_types=[], subjects=[], exclude_subjects=[], measurements=[], exclude_measurements=[]):
+def get_subject_scans(measurements_base, data_selection, scan_type):
+	"""Return the paths of the Bruker scan directories of a given scan type, for all sessions of a subject (in sorted session order).
+
+	Parameters
+	----------
+
+	measurements_base : str
+	Path to the directory containing the Bruker measurement directories.
+
+	data_selection : dict
+	Scans of all sessions of the subject, as produced by `subject_scans()`.
+
+	scan_type : str
+	Scan type to look up.
+	"""
+	import os
+	scan_paths = []
+	for session in sorted(data_selection):
+		try:
+			measurement_path, scan_subdir = data_selection[session][scan_type]
+		except KeyError:
+			continue
+		scan_paths.append(os.path.join(measurements_base,measurement_path,scan_subdir))
+	return scan_paths
+
+def get_subject_template(subject_session, subject_templates):
+	"""Return the subject template and subject-to-template transform paths for the subject of a subject-session pair.
+
+	Parameters
+	----------
+
+	subject_session : list
+	Length-2 list of subject and session identifiers.
+
+	subject_templates : dict
+	Subject identifiers as keys and (template, transform) tuples as values.
+	"""
+	template, transform = subject_templates[subject_session[0]]
+	return template, transform
+
+def rigid_mean_template(in_files,
+	out_file="subject_template.nii.gz",
+	iterations=2,
+	num_threads=1,
+	):
+	"""Create a subject template from structural images of the same subject (e.g. from different sessions), by iteratively registering them rigidly to their mean.
+
+	The first iteration registers all images to the first one, and each further iteration to the mean of the previous iteration, reducing the bias towards the first image.
+	The template is sampled in the voxel grid of the first image.
+
+	Parameters
+	----------
+
+	in_files : list of str
+	Paths to the (bias field corrected) structural images.
+
+	out_file : str, optional
+	Path to the subject template.
+
+	iterations : int, optional
+	Number of registration and averaging iterations.
+
+	num_threads : int, optional
+	Number of threads for the registrations.
+	"""
+	import nibabel as nib
+	import numpy as np
+	from os import path
+	from nipype.interfaces import ants
+	from samri.pipelines.nodes import PHASES
+
+	out_file = path.abspath(path.expanduser(out_file))
+	if isinstance(in_files, str):
+		in_files = [in_files]
+
+	reference = in_files[0]
+	warped = in_files
+	for iteration in range(iterations if len(in_files) > 1 else 0):
+		warped = []
+		parameters = PHASES["s_rigid"]
+		for ix, in_file in enumerate(in_files):
+			registration = ants.Registration()
+			registration.inputs.fixed_image = reference
+			registration.inputs.moving_image = in_file
+			registration.inputs.output_transform_prefix = "iteration{}_{}_".format(iteration, ix)
+			registration.inputs.output_warped_image = path.abspath("iteration{}_{}.nii.gz".format(iteration, ix))
+			registration.inputs.dimension = 3
+			registration.inputs.initial_moving_transform_com = True
+			registration.inputs.args = '--float'
+			registration.inputs.num_threads = num_threads
+			for key, value in parameters.items():
+				setattr(registration.inputs, key, [value])
+			warped.append(registration.run().outputs.warped_image)
+		reference = path.abspath("iteration{}_mean.nii.gz".format(iteration))
+		reference_img = nib.load(warped[0])
+		mean = np.mean([nib.load(i).get_fdata(dtype=np.float32) for i in warped], axis=0)
+		nib.save(nib.Nifti1Image(mean.astype(np.float32), reference_img.affine), reference)
+
+	if len(warped) == 1:
+		reference_img = nib.load(warped[0])
+		nib.save(nib.Nifti1Image(reference_img.get_fdata(dtype=np.float32), reference_img.affine), out_file)
+	else:
+		nib.save(nib.load(reference), out_file)
+	return out_file
+
+def get_data_selection(workflow_base, sessions=[], scan_types=[], subjects=[], exclude_subjects=[], measurements=[], exclude_measurements=[],
+	catalog_path=CATALOG_PATH,
+	n_jobs=N_JOBS,
+	):
+	"""Select Bruker measurements and scans matching the given criteria.
+
+	The subject, session, and scan program information of each measurement directory is read from (and recorded to) a persistent catalog, so that only new or modified directories are parsed.
+	Directories are checked and parsed concurrently, but the selection is always returned in the same (sorted) order, so that workflow hashes remain stable.
+
+	Parameters
+	----------
+
+	workflow_base : str
+	Path to the directory containing the Bruker measurement directories.
+
+	catalog_path : str or bool, optional
+	Path to the SQLite catalog of parsed measurement directories (see `samri.pipelines.catalog`).
+	Set to False to parse all directories without recording them.
+
+	n_jobs : int, optional
+	Number of threads with which to scan the measurement directories.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+	With the columns "subject", "session", "measurement", "scan_type", and "scan".
+	"""
 	import os
 
 	workflow_base = os.path.abspath(os.path.expanduser(workflow_base))
@@ -251,81 +523,38 @@ def get_data_selection(workflow_base, sessions=[], scan_types=[], subjects=[], e
 	if measurements:
 		measurement_path_list = [os.path.join(workflow_base,i) for i in measurements]
 	else:
-		measurement_path_list = os.listdir(workflow_base)
+		measurement_path_list = sorted(os.listdir(workflow_base))
+	measurement_path_list = [i for i in measurement_path_list if i not in exclude_measurements]
+
+	records = catalog_measurements([os.path.join(workflow_base,i) for i in measurement_path_list], catalog_path=catalog_path, n_jobs=n_jobs)
 
 	selected_measurements=[]
 	#populate a list of lists with acceptable subject names, sessions, and sub_dir's
 	for sub_dir in measurement_path_list:
-		if sub_dir not in exclude_measurements:
-			selected_measurement = []
-			try:
-				state_file = open(os.path.join(workflow_base,sub_dir,"subject"), "r")
-				read_variables=0 #count variables so that breaking takes place after both have been read
-				while True:
-					current_line = state_file.readline()
-					if "##$SUBJECT_name_string=" in current_line:
-						entry=re.sub("[<>\n]", "", state_file.readline())
-						if entry not in exclude_subjects:
-							if len(subjects) > 0 and entry not in subjects:
-								break
-							else:
-								selected_measurement.append(entry)
-						else:
-							break
-						read_variables +=1 #count recorded variables
-					if "##$SUBJECT_study_name=" in current_line:
-						entry=re.sub("[<>\n]", "", state_file.readline())
-						if entry in sessions or len(sessions) == 0:
-							selected_measurement.append(entry)
-						else:
-							break
-						read_variables +=1 #count recorded variables
-					if read_variables == 2:
-						selected_measurement.append(sub_dir)
-						#if the directory passed both the subject and sessions tests, append a line for it
-						if not scan_types:
-							#add two empty entries to fill columns otherwise dedicated to the scan program
-							selected_measurement.extend(["",""])
-							selected_measurements.append(selected_measurement)
-						#if various scan types are selected extend and copy lines to accommodate:
-						else:
-							for scan_type in scan_types:
-								#make a shallow copy of the list:
-								measurement_copy = selected_measurement[:]
-								scan_number=None
-								try:
-									scan_program_file_path = os.path.join(workflow_base,sub_dir,"ScanProgram.scanProgram")
-									scan_program_file = open(scan_program_file_path, "r")
-									syntax_adjusted_scan_type = ">"+scan_type+" "
-									while True:
-										current_line = scan_program_file.readline()
-										if syntax_adjusted_scan_type in current_line:
-											scan_number = current_line.split(syntax_adjusted_scan_type)[1].strip("(E").strip(")</displayName>\n")
-											measurement_copy.extend([scan_type, scan_number])
-											selected_measurements.append(measurement_copy)
-											break
-										#avoid infinite while loop:
-										if "</de.bruker.mri.entities.scanprogram.StudyScanProgramEntity>" in current_line:
-											break
-								except IOError:
-									pass
-								#If the ScanProgram.scanProgram file is small in size and the scan_type could not be matched, that may be because ParaVision failed
-								#to write all the information into the file. This happens occasionally.
-								#Thus we scan the individual acquisition protocols as well. These are a suboptimal and second choice, because acqp scans **also**
-								#keep the original names the sequences had on import (and may thus be misleading, if the name was changed by the user after import).
-								if os.stat(scan_program_file_path).st_size <= 700 and not scan_number:
-									for sub_sub_dir in os.listdir(os.path.join(workflow_base,sub_dir)):
-										try:
-											acqp_file = os.path.join(workflow_base,sub_dir,sub_sub_dir,"acqp")
-											if "<"+scan_type+">" in open(acqp_file).read():
-												scan_number = sub_sub_dir
-												measurement_copy.extend([scan_type, scan_number])
-												selected_measurements.append(measurement_copy)
-										except IOError:
-											pass
-						break #prevent loop from going on forever
-			except IOError:
-				pass
+		record = records[os.path.join(workflow_base,sub_dir)]
+		if not record or record["subject"] is None or record["session"] is None:
+			continue
+		subject = record["subject"]
+		session = record["session"]
+		if subject in exclude_subjects or (subjects and subject not in subjects):
+			continue
+		if sessions and session not in sessions:
+			continue
+		#if the directory passed both the subject and sessions tests, append a line for it
+		if not scan_types:
+			#add two empty entries to fill columns otherwise dedicated to the scan program
+			selected_measurements.append([subject, session, sub_dir, "", ""])
+			continue
+		#if various scan types are selected extend and copy lines to accommodate:
+		for scan_type in scan_types:
+			program_scans = [scan for entry_type, scan, source in record["scans"] if source == "program" and entry_type == scan_type]
+			if program_scans:
+				selected_measurements.append([subject, session, sub_dir, scan_type, program_scans[0]])
+			else:
+				#acqp entries are only recorded if the scan program is incomplete
+				for entry_type, scan, source in record["scans"]:
+					if source == "acqp" and entry_type == scan_type:
+						selected_measurements.append([subject, session, sub_dir, scan_type, scan])
 
 	data_selection = pd.DataFrame(selected_measurements, columns=["subject", "session", "measurement", "scan_type", "scan"])
 
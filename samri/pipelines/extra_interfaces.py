@@ -1,12 +1,16 @@
-from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, TraitedSpec, Directory, CommandLineInputSpec, CommandLine, InputMultiPath, isdefined, Bunch, OutputMultiPath, load_template
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, TraitedSpec, Directory, CommandLineInputSpec, CommandLine, InputMultiPath, isdefined, Bunch, OutputMultiPath
+try:
+	from nipype.interfaces.base import load_template
+except ImportError:
+	from nipype.interfaces.fsl.model import load_template
 from nipype.interfaces.afni.base import AFNICommandOutputSpec, AFNICommandInputSpec, AFNICommand
+from nipype.interfaces.ants.segmentation import N4BiasFieldCorrection, N4BiasFieldCorrectionInputSpec
 from nipype.utils.filemanip import split_filename
 from itertools import product
 from nibabel import load
 
 import nibabel as nb
 import numpy as np
-import csv
 import os
 
 def scale_timings(timelist, input_units, output_units, time_repetition):
@@ -31,69 +35,117 @@ def scale_timings(timelist, input_units, output_units, time_repetition):
 	return timelist
 
 
-def gen_info(run_event_files, one_condition_file, habituation_regressor):
-	"""Generate subject_info structure from a list of event files or a multirow event file.
+EVENT_COLUMNS = ["run", "condition", "onset", "duration", "amplitude"]
+
+def _read_event_file(event_file, round_timings):
+	"""Read a BIDS events TSV file, or a 1 to 3 column FSL event text file, into a dataframe with onset, duration, and amplitude columns."""
+	import pandas as pd
+
+	if event_file.endswith(".tsv"):
+		events = pd.read_csv(event_file, sep="\t")
+		if "onset" not in events.columns or "duration" not in events.columns:
+			raise ValueError("The events file `{}` needs to have \"onset\" and \"duration\" columns.".format(event_file))
+		if "amplitude" in events.columns:
+			amplitude = events["amplitude"]
+		elif events.shape[1] > 2:
+			#the third column is used as the amplitude, as per the three column FSL format
+			amplitude = events.iloc[:,2]
+		else:
+			amplitude = 1
+		events = pd.DataFrame({"onset":events["onset"], "duration":events["duration"], "amplitude":amplitude})
+	else:
+		values = np.atleast_2d(np.loadtxt(event_file))
+		events = pd.DataFrame({"onset":values[:,0]})
+		events["duration"] = values[:,1] if values.shape[1] > 1 else 0
+		events["amplitude"] = values[:,2] if values.shape[1] > 2 else 1
+	try:
+		events = events.astype(np.float64)
+	except ValueError:
+		raise ValueError("The events file `{}` contains non-numeric onsets, durations, or amplitudes.".format(event_file))
+	if not np.isfinite(events.values).all() or (events["duration"] < 0).any():
+		raise ValueError("The events file `{}` contains missing or infinite values, or negative durations.".format(event_file))
+	if round_timings:
+		events = events.round()
+	return events
+
+def load_events(run_event_files,
+	habituation_regressor=False,
+	one_condition_file=True,
+	round_timings=True,
+	):
+	"""Load the events of all runs into a single columnar table, with one row per event and condition.
+
+	Parameters
+	----------
+
+	run_event_files : list
+	Event files for each run.
+	Each entry may be a BIDS events TSV file (with "onset" and "duration" columns, and an optional "amplitude" column, in lieu of which the third column is used), or a list of 1 to 3 column FSL event text files, one per condition.
+
+	habituation_regressor : bool, optional
+	Whether to add an "e1" condition for TSV files, containing all events with linearly decreasing amplitudes (from the number of events down to 1).
+	Only applies if `one_condition_file` is true.
+
+	one_condition_file : bool, optional
+	Whether all events of a TSV file belong to one "e0" condition, otherwise every event is a separate condition ("e0", "e1", ...).
+
+	round_timings : bool, optional
+	Whether to round onsets, durations, and amplitudes to integers.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+	With the columns "run" (index of the run), "condition", "onset", "duration", and "amplitude", sorted by run, and otherwise in order of the conditions.
+	FSL event text files are named after the file, without the run and extension suffixes.
 	"""
-	info = []
-	for i, event_file in enumerate(run_event_files):
-		runinfo = Bunch(conditions=[], onsets=[], durations=[], amplitudes=[])
-		if event_file.endswith(".tsv"):
-			with open(event_file) as tsv:
-				eventfile_data = list(csv.reader(tsv, delimiter="\t"))
-				if isinstance(eventfile_data[0][0], str):
-					eventfile_data = eventfile_data[1:]
-				eventfile_data = [[round(float(i)) for i in sublist] for sublist in eventfile_data]
+	import pandas as pd
+
+	tables = []
+	for run, event_files in enumerate(run_event_files):
+		if not isinstance(event_files, (list, tuple)):
+			event_files = [event_files]
+		for event_file in event_files:
+			events = _read_event_file(event_file, round_timings)
+			if event_file.endswith(".tsv"):
 				if one_condition_file:
-					name = "e0"
-					onsets = [i[0] for i in eventfile_data]
-					durations = [i[1] for i in eventfile_data]
-					amplitudes = [i[2] for i in eventfile_data]
-					runinfo.conditions.append(name)
-					runinfo.onsets.append(onsets)
-					runinfo.durations.append(durations)
-					runinfo.amplitudes.append(amplitudes)
+					events["condition"] = "e0"
 					if habituation_regressor:
-						name = "e1"
-						onsets = [i[0] for i in eventfile_data]
-						durations = [i[1] for i in eventfile_data]
-						amplitudes = [len(eventfile_data)-i for i in range(len(eventfile_data))]
-						runinfo.conditions.append(name)
-						runinfo.onsets.append(onsets)
-						runinfo.durations.append(durations)
-						runinfo.amplitudes.append(amplitudes)
+						habituation = events.copy()
+						habituation["condition"] = "e1"
+						habituation["amplitude"] = np.arange(len(events), 0, -1, dtype=np.float64)
+						events = pd.concat([events, habituation], ignore_index=True)
 				else:
-					for ix, line in enumerate(eventfile_data):
-						name = "e{}".format(ix)
-						runinfo.conditions.append(name)
-						event_info = np.atleast_2d(line)
-						event_info=np.array([np.array(sublist) for sublist in event_info])
-						runinfo.onsets.append(event_info[:, 0].tolist())
-						if event_info.shape[1] > 1:
-							runinfo.durations.append(event_info[:, 1].tolist())
-						else:
-							runinfo.durations.append([0])
-						if event_info.shape[1] > 2:
-							runinfo.amplitudes.append(event_info[:, 2].tolist())
-						else:
-							delattr(runinfo, 'amplitudes')
-		else:
-			for event_file in event_files:
-				_, name = os.path.split(event_file)
+					events["condition"] = ["e{}".format(ix) for ix in range(len(events))]
+			else:
+				name = os.path.basename(event_file)
 				if '.run' in name:
-					name, _ = name.split('.run%03d' % (i + 1))
+					name, _ = name.split('.run%03d' % (run + 1))
 				elif '.txt' in name:
 					name, _ = name.split('.txt')
-				runinfo.conditions.append(name)
-				event_info = np.atleast_2d(np.loadtxt(event_file))
-				runinfo.onsets.append(event_info[:, 0].tolist())
-				if event_info.shape[1] > 1:
-					runinfo.durations.append(event_info[:, 1].tolist())
-				else:
-					runinfo.durations.append([0])
-				if event_info.shape[1] > 2:
-					runinfo.amplitudes.append(event_info[:, 2].tolist())
-				else:
-					delattr(runinfo, 'amplitudes')
+				events["condition"] = name
+			events["run"] = run
+			tables.append(events)
+	if not tables:
+		return pd.DataFrame(columns=EVENT_COLUMNS)
+	return pd.concat(tables, ignore_index=True)[EVENT_COLUMNS]
+
+def gen_info(run_event_files, one_condition_file, habituation_regressor):
+	"""Generate subject_info structure from a list of event files or a multirow event file.
+	"""
+	events = load_events(run_event_files,
+		habituation_regressor=habituation_regressor,
+		one_condition_file=one_condition_file,
+		)
+	info = []
+	for run in range(len(run_event_files)):
+		runinfo = Bunch(conditions=[], onsets=[], durations=[], amplitudes=[])
+		run_events = events[events["run"] == run]
+		for condition, condition_events in run_events.groupby("condition", sort=False):
+			runinfo.conditions.append(condition)
+			runinfo.onsets.append(condition_events["onset"].tolist())
+			runinfo.durations.append(condition_events["duration"].tolist())
+			runinfo.amplitudes.append(condition_events["amplitude"].tolist())
 		info.append(runinfo)
 	return info
 
@@ -464,6 +516,311 @@ class Bru2(CommandLine):
 			outfile = os.getcwd()+"/"+os.path.basename(os.path.normpath(self.inputs.input_dir))
 			return outfile
 
+class BrukerToNiftiInputSpec(BaseInterfaceInputSpec):
+	input_dir = Directory(desc="Bruker scan directory", exists=True, mandatory=True)
+	actual_size = traits.Bool(False, usedefault=True, desc="Keep actual size - otherwise x10 scale so animals match human.")
+	desired_dummy_scans = traits.Int(desc="Crop initial timepoints so that this many dummy scans (including those discarded by the scanner) are excluded.")
+	output_filename = traits.Str(desc="Output filename ('.nii' will be appended)")
+	reconstruction = traits.Str("1", usedefault=True, desc="Reconstruction (subdirectory of `pdata`) to convert.")
+
+class BrukerToNiftiOutputSpec(TraitedSpec):
+	nii_file = File(exists=True)
+
+class BrukerToNifti(BaseInterface):
+	"""In-process alternative to the Bru2 command line interface, converting Bruker `2dseq` data to NIfTI in a single read and write pass.
+
+	The `2dseq` file is memory-mapped and optionally cropped to the desired number of dummy scans during conversion, so that no separate cropping step is needed.
+	Multi-orientation scans (e.g. localizers) are not supported.
+	"""
+	input_spec = BrukerToNiftiInputSpec
+	output_spec = BrukerToNiftiOutputSpec
+
+	def _run_interface(self, runtime):
+		from samri.pipelines.bruker import bruker_to_nifti
+
+		desired_dummy_scans = None
+		if isdefined(self.inputs.desired_dummy_scans):
+			desired_dummy_scans = self.inputs.desired_dummy_scans
+		bruker_to_nifti(self.inputs.input_dir, self._list_outputs()["nii_file"],
+			actual_size=self.inputs.actual_size,
+			desired_dummy_scans=desired_dummy_scans,
+			reconstruction=self.inputs.reconstruction,
+			)
+		return runtime
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		if isdefined(self.inputs.output_filename):
+			output_filename = os.path.abspath(self.inputs.output_filename)
+		else:
+			output_filename = os.path.join(os.getcwd(),os.path.basename(os.path.normpath(self.inputs.input_dir)))
+		outputs["nii_file"] = output_filename+".nii"
+		return outputs
+
+class BandpassInputSpec(BaseInterfaceInputSpec):
+	in_file = File(desc="4D image to filter", exists=True, mandatory=True)
+	highpass_sigma = traits.Float(-1, usedefault=True, desc="Highpass filter sigma, in volumes (values of 0 or below disable the filter).")
+	lowpass_sigma = traits.Float(-1, usedefault=True, desc="Lowpass filter sigma, in volumes (values of 0 or below disable the filter).")
+	invert = traits.Bool(False, usedefault=True, desc="Invert the filtered values.")
+	mask = File(desc="Mask of the voxels to filter. Defaults to all voxels with a nonzero value at any timepoint.", exists=True)
+	num_threads = traits.Int(1, usedefault=True, nohash=True, desc="Number of threads to use.")
+	out_file = File(desc="Output filename")
+
+class BandpassOutputSpec(TraitedSpec):
+	out_file = File(exists=True)
+
+class Bandpass(BaseInterface):
+	"""In-process alternative to `fsl.maths.TemporalFilter`, reproducing the `fslmaths -bptf` algorithm (see `samri.pipelines.filtering.bandpass_timecourses()`).
+
+	Only the voxels inside the mask are filtered, all at once and across multiple threads.
+	"""
+	input_spec = BandpassInputSpec
+	output_spec = BandpassOutputSpec
+
+	def _run_interface(self, runtime):
+		from samri.pipelines.filtering import bandpass_filter
+
+		mask = ""
+		if isdefined(self.inputs.mask):
+			mask = self.inputs.mask
+		bandpass_filter(self.inputs.in_file, self._list_outputs()["out_file"], self.inputs.highpass_sigma, self.inputs.lowpass_sigma,
+			invert=self.inputs.invert,
+			mask=mask,
+			n_jobs=self.inputs.num_threads,
+			)
+		return runtime
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		if isdefined(self.inputs.out_file):
+			outputs["out_file"] = os.path.abspath(self.inputs.out_file)
+		else:
+			_, base, ext = split_filename(self.inputs.in_file)
+			outputs["out_file"] = os.path.join(os.getcwd(),base+"_bp"+ext)
+		return outputs
+
+class AdaptiveN4BiasFieldCorrectionInputSpec(N4BiasFieldCorrectionInputSpec):
+	shrink_target_voxels = traits.Int(desc="If `shrink_factor` is not set, use the smallest shrink factor (up to `max_shrink_factor`) which reduces the input image to at most this many voxels.")
+	max_shrink_factor = traits.Int(4, usedefault=True, desc="Largest shrink factor to choose via `shrink_target_voxels`.")
+
+class AdaptiveN4BiasFieldCorrection(N4BiasFieldCorrection):
+	"""N4 bias field correction, with the shrink factor chosen at run time from the size of the input image.
+
+	This allows the same node configuration to be used for images of very different resolutions (e.g. actual and inflated size, structural and functional), estimating the bias field on images of similar size.
+	"""
+	input_spec = AdaptiveN4BiasFieldCorrectionInputSpec
+
+	def _shrink_factor(self):
+		voxels = np.prod(nb.load(self.inputs.input_image).shape[:3])
+		shrink_factor = 1
+		while shrink_factor < self.inputs.max_shrink_factor and voxels/float(shrink_factor**3) > self.inputs.shrink_target_voxels:
+			shrink_factor += 1
+		return shrink_factor
+
+	def _parse_inputs(self, skip=None):
+		args = super(AdaptiveN4BiasFieldCorrection, self)._parse_inputs(skip=skip)
+		if isdefined(self.inputs.shrink_target_voxels) and not isdefined(self.inputs.shrink_factor):
+			args.append("--shrink-factor {:d}".format(self._shrink_factor()))
+		return args
+
+class DesignMatrixInputSpec(BaseInterfaceInputSpec):
+	in_file = File(desc="4D image or masked \".npz\" archive to be modelled, from which only the number of volumes is read.", exists=True, mandatory=True)
+	session_info = traits.Any(mandatory=True, desc="Session information for the run, as output by `SpecifyModel`.")
+	bases = traits.Dict(mandatory=True, desc="Basis function specification, in the format of the `Level1Design` \"bases\" input (\"custom\" or \"gamma\").")
+	contrasts = traits.List(mandatory=True, desc="T contrasts, in the format of the `Level1Design` \"contrasts\" input.")
+	interscan_interval = traits.Float(mandatory=True, desc="Repetition time, in seconds.")
+	orthogonalization = traits.Dict(desc="Orthogonalization specification, in the format of the `Level1Design` \"orthogonalization\" input.")
+	basis_resolution = traits.Float(0.05, usedefault=True, desc="Temporal resolution of the basis function, in seconds.")
+	design_cache = traits.Str(desc="Directory in which design matrices are cached across runs. Defaults to `samri.pipelines.regression.DESIGN_CACHE`, an empty string disables the cache.", nohash=True)
+
+class DesignMatrixOutputSpec(TraitedSpec):
+	design_file = File(exists=True, desc="Design matrix, in the FSL VEST format.")
+	con_file = File(exists=True, desc="T contrast matrix, in the FSL VEST format.")
+
+class DesignMatrix(BaseInterface):
+	"""In-process alternative to the `Level1Design` and `fsl.FEATModel` chain, writing design and contrast files which can be passed to `fsl.GLM`.
+
+	Designs are built via `samri.pipelines.regression.cached_design_matrix()`, and are thus reused across runs with the same timings, number of volumes, basis function, and orthogonalization.
+	"""
+	input_spec = DesignMatrixInputSpec
+	output_spec = DesignMatrixOutputSpec
+
+	def _run_interface(self, runtime):
+		from samri.pipelines.regression import basis_function, cached_design_matrix, contrast_matrix, image_volumes, save_fsl_design, DESIGN_CACHE
+
+		session_info = self.inputs.session_info
+		if isinstance(session_info, list):
+			session_info = session_info[0]
+		orthogonalization = {}
+		if isdefined(self.inputs.orthogonalization):
+			orthogonalization = self.inputs.orthogonalization
+		design_cache = DESIGN_CACHE
+		if isdefined(self.inputs.design_cache):
+			design_cache = self.inputs.design_cache
+		basis = basis_function(self.inputs.bases, resolution=self.inputs.basis_resolution)
+		names, design = cached_design_matrix(session_info, basis, image_volumes(self.inputs.in_file), self.inputs.interscan_interval,
+			design_cache=design_cache,
+			orthogonalization=orthogonalization,
+			resolution=self.inputs.basis_resolution,
+			)
+		outputs = self._list_outputs()
+		save_fsl_design(design, contrast_matrix(self.inputs.contrasts, names), outputs["design_file"], outputs["con_file"],
+			contrast_names=[contrast[0] for contrast in self.inputs.contrasts],
+			)
+		return runtime
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		outputs["design_file"] = os.path.abspath("design.mat")
+		outputs["con_file"] = os.path.abspath("design.con")
+		return outputs
+
+class FirstLevelGLMInputSpec(BaseInterfaceInputSpec):
+	in_file = File(desc="4D image or masked \".npz\" archive to model", exists=True, mandatory=True)
+	session_info = traits.Any(mandatory=True, desc="Session information for the run, as output by `SpecifyModel`.")
+	bases = traits.Dict(mandatory=True, desc="Basis function specification, in the format of the `Level1Design` \"bases\" input (\"custom\" or \"gamma\").")
+	contrasts = traits.List(mandatory=True, desc="T contrasts, in the format of the `Level1Design` \"contrasts\" input.")
+	interscan_interval = traits.Float(mandatory=True, desc="Repetition time, in seconds.")
+	orthogonalization = traits.Dict(desc="Orthogonalization specification, in the format of the `Level1Design` \"orthogonalization\" input.")
+	ar1 = traits.Bool(False, usedefault=True, desc="Prewhiten with a voxelwise AR(1) model.")
+	basis_resolution = traits.Float(0.05, usedefault=True, desc="Temporal resolution of the basis function, in seconds.")
+	design_cache = traits.Str(desc="Directory in which design matrices are cached across runs. Defaults to `samri.pipelines.regression.DESIGN_CACHE`, an empty string disables the cache.", nohash=True)
+	mask = File(desc="Mask of the voxels to model. Defaults to all voxels with a nonzero value at any timepoint.", exists=True)
+	num_threads = traits.Int(1, usedefault=True, nohash=True, desc="Number of threads to use.")
+	out_file = File("betas.nii.gz", usedefault=True, desc="Output filename for the parameter estimates.")
+	out_cope = File("cope.nii.gz", usedefault=True, desc="Output filename for the COPEs.")
+	out_varcb_name = File("varcb.nii.gz", usedefault=True, desc="Output filename for the COPE variances.")
+	out_t_name = File("tstat.nii.gz", usedefault=True, desc="Output filename for the t statistics.")
+	out_z_name = File("zstat.nii.gz", usedefault=True, desc="Output filename for the z statistics.")
+	out_p_name = File("pstat.nii.gz", usedefault=True, desc="Output filename for the p values.")
+	out_pf_name = File("pfstat.nii.gz", usedefault=True, desc="Output filename for the F test p values.")
+
+class FirstLevelGLMOutputSpec(TraitedSpec):
+	out_file = File(exists=True)
+	out_cope = File(exists=True)
+	out_varcb = File(exists=True)
+	out_t = File(exists=True)
+	out_z = File(exists=True)
+	out_p = File(exists=True)
+	out_pf = File(exists=True)
+
+class FirstLevelGLM(BaseInterface):
+	"""In-process alternative to the `Level1Design`, `fsl.FEATModel`, and `fsl.GLM` chain (see `samri.pipelines.regression.first_level()`).
+
+	The design matrix is built directly from the session information and the basis function, and all in-mask voxels are fit at once, writing all statistic images in one pass.
+	Output names match those of `fsl.GLM`, so that the interface can be connected in its place.
+	"""
+	input_spec = FirstLevelGLMInputSpec
+	output_spec = FirstLevelGLMOutputSpec
+
+	#output: (statistic, filename input)
+	_output_names = {
+		"out_file":("betas","out_file"),
+		"out_cope":("cope","out_cope"),
+		"out_varcb":("varcb","out_varcb_name"),
+		"out_t":("t","out_t_name"),
+		"out_z":("z","out_z_name"),
+		"out_p":("p","out_p_name"),
+		"out_pf":("pf","out_pf_name"),
+		}
+
+	def _max_group_size(self):
+		return None
+
+	def _runs(self):
+		"""Return the input files, session information, and statistic output file dictionaries of the runs to model."""
+		session_info = self.inputs.session_info
+		if isinstance(session_info, list):
+			session_info = session_info[0]
+		outputs = self._list_outputs()
+		out_files = dict([(self._output_names[key][0], outputs[key]) for key in self._output_names])
+		return [self.inputs.in_file], [session_info], [out_files]
+
+	def _run_interface(self, runtime):
+		from samri.pipelines.regression import first_level, DESIGN_CACHE
+
+		mask = ""
+		if isdefined(self.inputs.mask):
+			mask = self.inputs.mask
+		orthogonalization = {}
+		if isdefined(self.inputs.orthogonalization):
+			orthogonalization = self.inputs.orthogonalization
+		design_cache = DESIGN_CACHE
+		if isdefined(self.inputs.design_cache):
+			design_cache = self.inputs.design_cache
+		in_files, session_infos, out_files = self._runs()
+		first_level(in_files, session_infos, self.inputs.contrasts, self.inputs.bases,
+			ar1=self.inputs.ar1,
+			basis_resolution=self.inputs.basis_resolution,
+			design_cache=design_cache,
+			mask=mask,
+			max_group_size=self._max_group_size(),
+			n_jobs=self.inputs.num_threads,
+			orthogonalization=orthogonalization,
+			out_files=out_files,
+			tr=self.inputs.interscan_interval,
+			)
+		return runtime
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		for key, (_, name) in self._output_names.items():
+			outputs[key] = os.path.abspath(getattr(self.inputs, name))
+		return outputs
+
+class BatchFirstLevelGLMInputSpec(FirstLevelGLMInputSpec):
+	in_file = InputMultiPath(File(exists=True), desc="4D images or masked \".npz\" archives to model", mandatory=True)
+	session_info = traits.List(mandatory=True, desc="Session information for each run, as output by `SpecifyModel`.")
+	max_group_size = traits.Int(0, usedefault=True, desc="Maximum number of runs to fit jointly (0 for no limit).")
+	out_file = traits.List(File, desc="Output filenames for the parameter estimates of each run.")
+	out_cope = traits.List(File, desc="Output filenames for the COPEs of each run.")
+	out_varcb_name = traits.List(File, desc="Output filenames for the COPE variances of each run.")
+	out_t_name = traits.List(File, desc="Output filenames for the t statistics of each run.")
+	out_z_name = traits.List(File, desc="Output filenames for the z statistics of each run.")
+	out_p_name = traits.List(File, desc="Output filenames for the p values of each run.")
+	out_pf_name = traits.List(File, desc="Output filenames for the F test p values of each run.")
+
+class BatchFirstLevelGLMOutputSpec(TraitedSpec):
+	out_file = OutputMultiPath(File(exists=True))
+	out_cope = OutputMultiPath(File(exists=True))
+	out_varcb = OutputMultiPath(File(exists=True))
+	out_t = OutputMultiPath(File(exists=True))
+	out_z = OutputMultiPath(File(exists=True))
+	out_p = OutputMultiPath(File(exists=True))
+	out_pf = OutputMultiPath(File(exists=True))
+
+class BatchFirstLevelGLM(FirstLevelGLM):
+	"""Multi-run variant of `FirstLevelGLM`, which fits all runs sharing a design matrix in a single matrix solve.
+
+	This is meant to be used as a `JoinNode`, with the statistic outputs being lists in the order of the input runs.
+	Unspecified output filenames default to the base name of the respective input file, suffixed with the statistic name.
+	"""
+	input_spec = BatchFirstLevelGLMInputSpec
+	output_spec = BatchFirstLevelGLMOutputSpec
+
+	def _max_group_size(self):
+		return self.inputs.max_group_size or None
+
+	def _runs(self):
+		session_infos = [i[0] if isinstance(i, list) else i for i in self.inputs.session_info]
+		outputs = self._list_outputs()
+		out_files = []
+		for ix in range(len(self.inputs.in_file)):
+			out_files.append(dict([(self._output_names[key][0], outputs[key][ix]) for key in self._output_names]))
+		return self.inputs.in_file, session_infos, out_files
+
+	def _list_outputs(self):
+		outputs = self._outputs().get()
+		for key, (statistic, name) in self._output_names.items():
+			if isdefined(getattr(self.inputs, name)):
+				outputs[key] = [os.path.abspath(i) for i in getattr(self.inputs, name)]
+			else:
+				outputs[key] = []
+				for in_file in self.inputs.in_file:
+					_, base, _ = split_filename(in_file)
+					outputs[key].append(os.path.join(os.getcwd(), "{}_{}.nii.gz".format(base, statistic)))
+		return outputs
+
 class SubjectInfoInputSpec(BaseInterfaceInputSpec):
 	conditions = traits.List(traits.Str(exists=True))
 	durations = traits.List(traits.List(traits.Float(exists=True)))
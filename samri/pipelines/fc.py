@@ -101,12 +101,14 @@ def seed_based_connectivity(ts, seed_mask,
 
 	ts : string
 	Path to the 4D NIfTI timeseries file on which to perform the connectivity analysis.
+	This may also be a masked ".npz" archive (see `samri.pipelines.masked`), in which case only its in-brain voxels are loaded and cleaned, and its mask is used in lieu of `brain_mask`.
 
 	seed_mask : string
 	Path to a 3D NIfTI-like binary mask file designating the seed region.
 
 	smoothing_fwhm : float, optional
 	Spatial smoothing kernel, passed to the NiftiMasker.
+	This is not applied to masked ".npz" timeseries, which need to be smoothed before masking.
 
 	detrend : bool, optional
 	Whether to detrend the data, passed to the NiftiMasker.
@@ -159,9 +161,24 @@ def seed_based_connectivity(ts, seed_mask,
 		t_r=tr,
 		memory='nilearn_cache', memory_level=1, verbose=0
 		)
-	seed_time_series = seed_masker.fit_transform(ts,).T
-	seed_time_series = np.mean(seed_time_series, axis=0)
-	brain_time_series = brain_masker.fit_transform(ts,)
+	if ts.endswith(".npz"):
+		from nilearn import signal
+		from samri.pipelines.masked import _load_mask, load_masked
+
+		data, brain, affine, header = load_masked(ts)
+		seed = _load_mask(seed_mask, brain.shape)[brain]
+		brain_time_series = signal.clean(data.T,
+			detrend=detrend,
+			standardize=standardize,
+			low_pass=low_pass,
+			high_pass=high_pass,
+			t_r=tr,
+			)
+		seed_time_series = np.mean(brain_time_series[:,seed], axis=1)
+	else:
+		seed_time_series = seed_masker.fit_transform(ts,).T
+		seed_time_series = np.mean(seed_time_series, axis=0)
+		brain_time_series = brain_masker.fit_transform(ts,)
 
 	seed_based_correlations = np.dot(brain_time_series.T, seed_time_series) / seed_time_series.shape[0]
 	try:
@@ -173,7 +190,12 @@ def seed_based_connectivity(ts, seed_mask,
 	seed_based_correlations_fisher_z = np.arctanh(seed_based_correlations)
 	print("seed-based correlation Fisher-z transformed: min = %.3f; max = %.3f" % (seed_based_correlations_fisher_z.min(),seed_based_correlations_fisher_z.max()))
 
-	seed_based_correlation_img = brain_masker.inverse_transform(seed_based_correlations_fisher_z.T)
+	if ts.endswith(".npz"):
+		volume = np.zeros(brain.shape, dtype=np.float32)
+		volume[brain] = seed_based_correlations_fisher_z
+		seed_based_correlation_img = nibabel.Nifti1Image(volume, affine)
+	else:
+		seed_based_correlation_img = brain_masker.inverse_transform(seed_based_correlations_fisher_z.T)
 
 	if save_as:
 		seed_based_correlation_img.to_filename(save_as)
@@ -0,0 +1,154 @@
+import numpy as np
+from joblib import Parallel, delayed
+
+def _correlate(data, kernel):
+	"""Correlate every column of a (time, voxel) array with a kernel centered on each timepoint, treating values beyond the array edges as zero."""
+	from scipy.signal import fftconvolve
+
+	return fftconvolve(data, kernel[::-1, np.newaxis], mode="same", axes=0)
+
+def _highpass_weights(highpass_sigma, timepoints):
+	"""Return the kernels and the edge-dependent normalization terms of the Gaussian-weighted running line fit."""
+	half_width = int(highpass_sigma*3)
+	offsets = np.arange(-half_width, half_width+1, dtype=np.float64)
+	weights = np.exp(-0.5 * offsets**2 / highpass_sigma**2)
+	ones = np.ones((timepoints,1))
+	n = _correlate(ones, weights)
+	a = _correlate(ones, weights*offsets)
+	c = _correlate(ones, weights*offsets**2)
+	return weights, offsets, n, a, c
+
+def _lowpass_weights(lowpass_sigma, timepoints):
+	"""Return the Gaussian smoothing kernel and its edge-dependent sum."""
+	half_width = int(lowpass_sigma*20)+2
+	offsets = np.arange(-half_width, half_width+1, dtype=np.float64)
+	weights = np.exp(-0.5 * offsets**2 / lowpass_sigma**2)
+	weights /= weights.sum()
+	ones = np.ones((timepoints,1))
+	return weights, _correlate(ones, weights)
+
+def bandpass_timecourses(data, highpass_sigma, lowpass_sigma,
+	chunk_voxels=4096,
+	n_jobs=1,
+	):
+	"""Temporally bandpass filter a (time, voxel) array, reproducing the algorithm of `fslmaths -bptf`.
+
+	The highpass filter subtracts a Gaussian-weighted running line fit from every timecourse (as in FSL 5.0.7 and later, this also removes the temporal mean), and the lowpass filter is a Gaussian smoothing normalized at the edges.
+	Rather than fitting each timepoint of each voxel separately, the weighted sums are computed for all voxels at once via FFT convolution, a chunk of voxels at a time.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+	Array of shape (time, voxel).
+
+	highpass_sigma : float
+	Highpass filter sigma, in volumes (values of 0 or below disable the filter).
+
+	lowpass_sigma : float
+	Lowpass filter sigma, in volumes (values of 0 or below disable the filter).
+
+	chunk_voxels : int, optional
+	Number of voxels to filter at a time.
+
+	n_jobs : int, optional
+	Number of threads across which to distribute the chunks.
+
+	Returns
+	-------
+
+	numpy.ndarray
+	Filtered float64 array of the same shape as `data`.
+	"""
+	timepoints = data.shape[0]
+	if highpass_sigma > 0:
+		highpass = _highpass_weights(highpass_sigma, timepoints)
+	if lowpass_sigma > 0:
+		lowpass = _lowpass_weights(lowpass_sigma, timepoints)
+
+	def filter_chunk(start):
+		#copy, so that the filter is not applied in place to float64 input data
+		chunk = np.array(data[:,start:start+chunk_voxels], dtype=np.float64)
+		if highpass_sigma > 0:
+			weights, offsets, n, a, c = highpass
+			b = _correlate(chunk, weights)
+			d = _correlate(chunk, weights*offsets)
+			denominator = c*n - a*a
+			valid = denominator[:,0] != 0
+			trend = (b[valid]*c[valid] - a[valid]*d[valid]) / denominator[valid]
+			chunk[valid] -= trend
+		if lowpass_sigma > 0:
+			weights, norm = lowpass
+			chunk = _correlate(chunk, weights) / norm
+		return chunk
+
+	chunks = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(filter_chunk),
+		range(0, data.shape[1], chunk_voxels),
+		))
+	if not chunks:
+		return np.zeros(data.shape)
+	return np.concatenate(chunks, axis=1)
+
+def bandpass_filter(in_file, out_file, highpass_sigma, lowpass_sigma,
+	invert=False,
+	mask="",
+	n_jobs=1,
+	):
+	"""Temporally bandpass filter a 4D image in-process, filtering only the voxels inside a mask.
+
+	Parameters
+	----------
+
+	in_file : str
+	Path to the 4D NIfTI image or masked ".npz" archive (see `samri.pipelines.masked`) to filter.
+
+	out_file : str
+	Path to the filtered image, written as a masked archive if this ends in ".npz", and as a float32 NIfTI image otherwise.
+
+	highpass_sigma : float
+	Highpass filter sigma, in volumes (values of 0 or below disable the filter).
+
+	lowpass_sigma : float
+	Lowpass filter sigma, in volumes (values of 0 or below disable the filter).
+
+	invert : bool, optional
+	Whether to invert the filtered values (e.g. for negative contrast agent measurements).
+
+	mask : str, optional
+	Path to a 3D mask of the voxels to filter, ignored for masked archives.
+	If unspecified, all voxels with a nonzero value at any timepoint are filtered.
+	Voxels outside the mask are set to zero, which is also what the filter returns for all-zero timecourses.
+
+	n_jobs : int, optional
+	Number of threads to use.
+	"""
+	import nibabel as nib
+	from samri.pipelines.masked import _load_mask, load_masked, save_masked
+
+	if in_file.endswith(".npz"):
+		timecourses, mask, affine, header = load_masked(in_file)
+	else:
+		img = nib.load(in_file)
+		data = np.asanyarray(img.dataobj).astype(np.float32, copy=False)
+		if mask:
+			mask = _load_mask(mask, img.shape)
+		else:
+			mask = np.any(data != 0, axis=3)
+		timecourses = data[mask]
+		del data
+		affine, header = img.affine, img.header
+
+	timecourses = bandpass_timecourses(timecourses.T, highpass_sigma, lowpass_sigma, n_jobs=n_jobs).T
+	if invert:
+		timecourses *= -1
+
+	if out_file.endswith(".npz"):
+		return save_masked(timecourses, mask, affine, header, out_file)
+
+	data = np.zeros(mask.shape+timecourses.shape[1:], dtype=np.float32)
+	data[mask] = timecourses
+	header = header.copy()
+	header.set_data_dtype(np.float32)
+	header.set_slope_inter(1, 0)
+	nib.save(nib.Nifti1Image(data, affine, header), out_file)
+	return out_file
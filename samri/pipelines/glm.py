@@ -1,4 +1,4 @@
-from os import path, listdir, getcwd, remove
+from os import path, listdir, getcwd, makedirs, remove
 from samri.pipelines.extra_functions import get_level2_inputs, get_subjectinfo, write_function_call, bids_inputs
 
 import inspect
@@ -7,23 +7,39 @@ import shutil
 import nipype.interfaces.io as nio
 import nipype.interfaces.utility as util
 import nipype.pipeline.engine as pe
+from glob import glob
 from itertools import product
+from joblib import Parallel, delayed
 from nipype.interfaces import fsl
 from nipype.interfaces.fsl.model import Level1Design
 
-from samri.pipelines.extra_interfaces import SpecifyModel
+from samri.pipelines.execution import multiproc_arguments, run_workflow, NODE_CACHE, L1_CACHED_NODES, L2_CACHED_NODES
+from samri.pipelines.extra_interfaces import BatchFirstLevelGLM, DesignMatrix, FirstLevelGLM, SpecifyModel
+from samri.pipelines.nodes import estimate_mem_gb, image_voxels, set_resources, DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL
+from samri.pipelines.regression import second_level, DESIGN_CACHE
 from samri.pipelines.utils import sss_to_source, ss_to_path, iterfield_selector, datasource_exclude
 
+#maximum number of runs fit jointly by the batched in-process GLM
+BATCH_GROUP_SIZE = 16
+
 def l1(preprocessing_dir,
+	batch_runs=False,
+	design_cache=DESIGN_CACHE,
 	highpass_sigma=225,
 	include={},
 	exclude={},
 	keep_work=False,
 	l1_dir="",
+	memory_gb=None,
 	nprocs=10,
 	mask="/home/chymera/ni_data/templates/ds_QBI_chr_bin.nii.gz",
+	native_design=False,
+	native_glm=False,
+	node_cache=NODE_CACHE,
 	per_stimulus_contrast=False,
 	habituation="",
+	prewhiten=False,
+	profile=False,
 	tr=1,
 	workflow_name="generic",
 	):
@@ -32,6 +48,14 @@ def l1(preprocessing_dir,
 	Parameters
 	----------
 
+	batch_runs : bool
+	Whether to model all runs in a single node, fitting all runs which share a design matrix (e.g. runs of the same stimulation protocol) jointly, in one matrix solve per design (and per `BATCH_GROUP_SIZE` runs).
+	This requires `native_glm=True`.
+
+	design_cache : string or bool
+	Path to a directory in which in-process design matrices (see `native_design` and `native_glm`) are cached, so that they are reused by all runs with the same timings and number of volumes, as well as across reruns.
+	If this evaluates to False, designs are only reused within a process.
+
 	include : dict
 	A dictionary with any combination of "sessions", "subjects", "trials" as keys and corresponding identifiers as values.
 	If this is specified ony matching entries will be included in the analysis.
@@ -43,8 +67,37 @@ def l1(preprocessing_dir,
 	habituation : string
 	One value of "confound", "in_main_contrast", "separate_contrast", "" indicating how the habituation regressor should be handled.
 	"" or any other value which evaluates to False will mean no habituation regressor is used int he model
+
+	memory_gb : float
+	Memory available to the workflow, in GB.
+	If unspecified, nipype uses 90% of the system memory.
+
+	native_design : bool
+	Whether to build the design matrix in-process (see `samri.pipelines.regression.cached_design_matrix()`) and pass it to `fsl.GLM`, rather than via the `Level1Design` and `FEATModel` chain of command line tools.
+	This is implied by `native_glm`.
+
+	native_glm : bool
+	Whether to build the design matrix and fit the model in-process (see `samri.pipelines.regression`), rather than via the `Level1Design`, `FEATModel`, and `fsl.GLM` chain of command line tools.
+	The in-process model is fit to all in-mask voxels at once, and writes all statistic images in one pass.
+
+	node_cache : string or bool
+	Path to a directory in which the GLM results are cached across runs, even if the work directory is not kept.
+	If this evaluates to False, no caching is performed.
+
+	prewhiten : bool
+	Whether to prewhiten the data and design with a voxelwise AR(1) model, estimated from the residuals of an initial OLS fit.
+	This requires `native_glm=True`.
+
+	profile : bool
+	Whether to record the wall time, CPU time, peak memory usage, and thread count of every node run, and write them to "profile.csv" and "profile.json" next to the workflow outputs.
+	These can be summarized via `samri.report.profiling.summarize_profiles()`.
 	"""
 
+	if prewhiten and not native_glm:
+		raise ValueError('The `prewhiten` option requires `native_glm=True`.')
+	if batch_runs and not native_glm:
+		raise ValueError('The `batch_runs` option requires `native_glm=True`.')
+
 	preprocessing_dir = path.expanduser(preprocessing_dir)
 	if not l1_dir:
 		l1_dir = path.abspath(path.join(preprocessing_dir,"..","..","l1"))
@@ -61,6 +114,7 @@ def l1(preprocessing_dir,
 		iterfields = iterfield_selector(iterfields, exclude, "exclude")
 
 	infosource = pe.Node(interface=util.IdentityInterface(fields=['subject_session_scan']), name="infosource")
+	iterfields = list(iterfields)
 	infosource.iterables = [('subject_session_scan', iterfields)]
 
 	datafile_source = pe.Node(name='datafile_source', interface=util.Function(function=sss_to_source,input_names=inspect.getargspec(sss_to_source)[0], output_names=['out_file']))
@@ -78,32 +132,65 @@ def l1(preprocessing_dir,
 	specify_model.inputs.one_condition_file = not per_stimulus_contrast
 	specify_model.inputs.habituation_regressor = bool(habituation)
 
-	level1design = pe.Node(interface=Level1Design(), name="level1design")
-	level1design.inputs.interscan_interval = tr
-	level1design.inputs.bases = {"custom": {"bfcustompath":"/mnt/data/ni_data/irfs/chr_beta1.txt"}}
-	# level1design.inputs.bases = {'gamma': {'derivs':False, 'gammasigma':10, 'gammadelay':5}}
-	level1design.inputs.orthogonalization = {1: {0:0,1:0,2:0}, 2: {0:1,1:1,2:0}}
-	level1design.inputs.model_serial_correlations = True
+	bases = {"custom": {"bfcustompath":"/mnt/data/ni_data/irfs/chr_beta1.txt"}}
+	# bases = {'gamma': {'derivs':False, 'gammasigma':10, 'gammadelay':5}}
+	orthogonalization = {1: {0:0,1:0,2:0}, 2: {0:1,1:1,2:0}}
 	if per_stimulus_contrast:
-		level1design.inputs.contrasts = [('allStim','T', ["e0","e1","e2","e3","e4","e5"],[1,1,1,1,1,1])] #condition names as defined in specify_model
+		contrasts = [('allStim','T', ["e0","e1","e2","e3","e4","e5"],[1,1,1,1,1,1])] #condition names as defined in specify_model
 	elif habituation=="separate_contrast":
-		level1design.inputs.contrasts = [('allStim','T', ["e0"],[1]),('allStim','T', ["e1"],[1])] #condition names as defined in specify_model
+		contrasts = [('allStim','T', ["e0"],[1]),('allStim','T', ["e1"],[1])] #condition names as defined in specify_model
 	elif habituation=="in_main_contrast":
-		level1design.inputs.contrasts = [('allStim','T', ["e0", "e1"],[1,1])] #condition names as defined in specify_model
+		contrasts = [('allStim','T', ["e0", "e1"],[1,1])] #condition names as defined in specify_model
 	elif habituation=="confound":
-		level1design.inputs.contrasts = [('allStim','T', ["e0"],[1])] #condition names as defined in specify_model
+		contrasts = [('allStim','T', ["e0"],[1])] #condition names as defined in specify_model
 	else:
-		level1design.inputs.contrasts = [('allStim','T', ["e0"],[1])] #condition names as defined in specify_model
-
-	modelgen = pe.Node(interface=fsl.FEATModel(), name='modelgen')
+		contrasts = [('allStim','T', ["e0"],[1])] #condition names as defined in specify_model
 
-	glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
-	glm.inputs.out_cope = "cope.nii.gz"
-	glm.inputs.out_varcb_name = "varcb.nii.gz"
-	#not setting a betas output file might lead to beta export in lieu of COPEs
-	glm.inputs.out_file = "betas.nii.gz"
-	glm.inputs.out_t_name = "t_stat.nii.gz"
-	glm.inputs.out_p_name = "p_stat.nii.gz"
+	if batch_runs:
+		glm = pe.JoinNode(interface=BatchFirstLevelGLM(), name='glm',
+			joinsource=infosource,
+			joinfield=['in_file', 'session_info', 'out_cope', 'out_varcb_name', 'out_t_name', 'out_z_name', 'out_p_name', 'out_pf_name'],
+			)
+		glm.inputs.max_group_size = BATCH_GROUP_SIZE
+	elif native_glm:
+		glm = pe.Node(interface=FirstLevelGLM(), name='glm')
+	if native_glm:
+		glm.inputs.ar1 = prewhiten
+		glm.inputs.bases = bases
+		glm.inputs.contrasts = contrasts
+		glm.inputs.design_cache = design_cache or ""
+		glm.inputs.interscan_interval = tr
+		glm.inputs.orthogonalization = orthogonalization
+		set_resources(glm, min(4, nprocs), estimate_mem_gb(image_voxels(mask)*DEFAULT_VOLUMES*(min(len(iterfields), BATCH_GROUP_SIZE) if batch_runs else 1), 3*TIMESERIES_BYTES_PER_VOXEL))
+	else:
+		if native_design:
+			design = pe.Node(interface=DesignMatrix(), name="design")
+			design.inputs.bases = bases
+			design.inputs.contrasts = contrasts
+			design.inputs.design_cache = design_cache or ""
+			design.inputs.interscan_interval = tr
+			design.inputs.orthogonalization = orthogonalization
+		else:
+			level1design = pe.Node(interface=Level1Design(), name="level1design")
+			level1design.inputs.interscan_interval = tr
+			level1design.inputs.bases = bases
+			level1design.inputs.orthogonalization = orthogonalization
+			level1design.inputs.model_serial_correlations = True
+			level1design.inputs.contrasts = contrasts
+
+			modelgen = pe.Node(interface=fsl.FEATModel(), name='modelgen')
+
+		glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
+		#final outputs are compressed, independently of the FSLOUTPUTTYPE environment variable
+		glm.inputs.output_type = "NIFTI_GZ"
+		set_resources(glm, 1, estimate_mem_gb(image_voxels(mask)*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
+	if not batch_runs:
+		glm.inputs.out_cope = "cope.nii.gz"
+		glm.inputs.out_varcb_name = "varcb.nii.gz"
+		#not setting a betas output file might lead to beta export in lieu of COPEs
+		glm.inputs.out_file = "betas.nii.gz"
+		glm.inputs.out_t_name = "t_stat.nii.gz"
+		glm.inputs.out_p_name = "p_stat.nii.gz"
 	if mask:
 		glm.inputs.mask = mask
 
@@ -123,19 +210,16 @@ def l1(preprocessing_dir,
 	datasink = pe.Node(nio.DataSink(), name='datasink')
 	datasink.inputs.base_directory = path.join(l1_dir,workflow_name)
 	datasink.inputs.parameterization = False
+	if batch_runs:
+		#the joined outputs all arrive in one container, and are sorted into the BIDS subject and session directories by name
+		datasink.inputs.regexp_substitutions = [(r'/(sub-([^/_]+)_ses-([^/_]+)_[^/]+)$', r'/sub-\2/ses-\3/\1')]
 
 	workflow_connections = [
 		(infosource, datafile_source, [('subject_session_scan', 'subject_session_scan')]),
 		(infosource, eventfile_source, [('subject_session_scan', 'subject_session_scan')]),
 		(eventfile_source, specify_model, [('out_file', 'event_files')]),
 		(datafile_source, specify_model, [('out_file', 'functional_runs')]),
-		(specify_model, level1design, [('session_info', 'session_info')]),
-		(level1design, modelgen, [('ev_files', 'ev_files')]),
-		(level1design, modelgen, [('fsf_files', 'fsf_file')]),
 		(datafile_source, glm, [('out_file', 'in_file')]),
-		(modelgen, glm, [('design_file', 'design')]),
-		(modelgen, glm, [('con_file', 'contrasts')]),
-		(infosource, datasink, [(('subject_session_scan',ss_to_path), 'container')]),
 		(infosource, cope_filename, [('subject_session_scan', 'subject_session_scan')]),
 		(infosource, varcb_filename, [('subject_session_scan', 'subject_session_scan')]),
 		(infosource, tstat_filename, [('subject_session_scan', 'subject_session_scan')]),
@@ -155,6 +239,29 @@ def l1(preprocessing_dir,
 		(glm, datasink, [('out_cope', '@cope')]),
 		(glm, datasink, [('out_varcb', '@varcb')]),
 		]
+	if not batch_runs:
+		workflow_connections.extend([
+			(infosource, datasink, [(('subject_session_scan',ss_to_path), 'container')]),
+			])
+	if native_glm:
+		workflow_connections.extend([
+			(specify_model, glm, [('session_info', 'session_info')]),
+			])
+	elif native_design:
+		workflow_connections.extend([
+			(specify_model, design, [('session_info', 'session_info')]),
+			(datafile_source, design, [('out_file', 'in_file')]),
+			(design, glm, [('design_file', 'design')]),
+			(design, glm, [('con_file', 'contrasts')]),
+			])
+	else:
+		workflow_connections.extend([
+			(specify_model, level1design, [('session_info', 'session_info')]),
+			(level1design, modelgen, [('ev_files', 'ev_files')]),
+			(level1design, modelgen, [('fsf_files', 'fsf_file')]),
+			(modelgen, glm, [('design_file', 'design')]),
+			(modelgen, glm, [('con_file', 'contrasts')]),
+			])
 
 	workdir_name = workflow_name+"_work"
 	workflow = pe.Workflow(name=workdir_name)
@@ -163,9 +270,7 @@ def l1(preprocessing_dir,
 	workflow.config = {"execution": {"crashdump_dir": path.join(l1_dir,"crashdump")}}
 	workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph.dot"), graph2use="hierarchical", format="png")
 
-	workflow.run(plugin="MultiProc",  plugin_args={'n_procs' : nprocs})
-	if not keep_work:
-		shutil.rmtree(path.join(l1_dir,workdir_name))
+	run_workflow(workflow, plugin="MultiProc", plugin_args=multiproc_arguments(nprocs, memory_gb), keep_work=keep_work, cached_nodes=L1_CACHED_NODES, node_cache=node_cache, profile_dir=datasink.inputs.base_directory if profile else None)
 
 def getlen(a):
 	return len(a)
@@ -201,11 +306,31 @@ def l2_common_effect(l1_dir,
 	keep_work=False,
 	l2_dir="",
 	loud=False,
+	memory_gb=None,
+	native_glm=False,
+	profile=False,
+	run_mode="ols",
 	tr=1,
 	nprocs=6,
 	workflow_name="generic",
 	mask="/home/chymera/ni_data/templates/ds_QBI_chr_bin.nii.gz",
+	node_cache=NODE_CACHE,
 	):
+	"""Calculate group level GLM statistics for the common effect across the runs of each group.
+
+	Parameters
+	----------
+
+	native_glm : bool
+	Whether to fit the models in-process (see `samri.pipelines.regression.second_level()`), reading only the in-mask voxels of every first-level COPE, rather than via merged 4D files and FLAMEO.
+	All groups are fit in one process (using up to `nprocs` threads), and the same "cope1", "varcope1", "tstat1", and "zstat1" images are written to the group directories, without intermediate files.
+
+	run_mode : string
+	FLAMEO run mode, of which the in-process models support "ols" and "fe".
+	"""
+
+	if native_glm and run_mode not in ("ols", "fe"):
+		raise ValueError('The `native_glm` option supports only the "ols" and "fe" values of `run_mode`, not "{}".'.format(run_mode))
 
 	l1_dir = path.expanduser(l1_dir)
 	if not l2_dir:
@@ -219,6 +344,40 @@ def l2_common_effect(l1_dir,
 	sessions = set(datafind_res.outputs.ses)
 	scans = set(datafind_res.outputs.scan)
 
+	if native_glm:
+		if groupby == "subject":
+			groups = [(subject, "sub-{0}/ses-*/sub-{0}_ses-*_trial-*_cope.nii.gz".format(subject)) for subject in subjects]
+		elif groupby == "subject_scan":
+			groups = [("_scan_{}_subject_{}".format(scan, subject), "sub-{0}/ses-*/sub-{0}_ses-*_trial-{1}_cope.nii.gz".format(subject, scan)) for subject, scan in product(subjects, scans)]
+		elif groupby == "session":
+			groups = [(session, "sub-*/ses-{0}/sub-*_ses-{0}_trial-*_cope.nii.gz".format(session)) for session in sessions]
+		elif groupby == "scan":
+			groups = [(scan, "sub-*/ses-*/sub-*_ses-*_trial-{}_cope.nii.gz".format(scan)) for scan in scans]
+
+		def fit_group(group_pattern):
+			group, pattern = group_pattern
+			copes = datasource_exclude(sorted(glob(path.join(l1_dir, pattern))), exclude)
+			if not copes:
+				print("WARNING: No COPEs have been found for the \"{}\" group.".format(group))
+				return
+			group_dir = path.join(l2_dir, workflow_name, group)
+			try:
+				makedirs(group_dir)
+			except OSError:
+				if not path.isdir(group_dir):
+					raise
+			second_level(copes,
+				mask=path.abspath(path.expanduser(mask)) if mask else "",
+				mode=run_mode,
+				out_files=dict([(statistic, path.join(group_dir, statistic+"1.nii.gz")) for statistic in ["cope", "varcope", "tstat", "zstat"]]),
+				varcbs=[cope[:-len("_cope.nii.gz")]+"_varcb.nii.gz" for cope in copes],
+				)
+
+		Parallel(n_jobs=nprocs, verbose=0, backend="threading")(map(delayed(fit_group),
+			groups,
+			))
+		return
+
 	copemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="copemerge")
 	varcopemerge = pe.Node(interface=fsl.Merge(dimension='t'),name="varcopemerge")
 
@@ -226,7 +385,9 @@ def l2_common_effect(l1_dir,
 
 	flameo = pe.Node(interface=fsl.FLAMEO(), name="flameo")
 	flameo.inputs.mask_file = mask
-	flameo.inputs.run_mode = "ols"
+	#final outputs are compressed, independently of the FSLOUTPUTTYPE environment variable, as are those of the in-process models
+	flameo.inputs.output_type = "NIFTI_GZ"
+	flameo.inputs.run_mode = run_mode
 
 	datasink = pe.Node(nio.DataSink(), name='datasink')
 	datasink.inputs.base_directory = path.join(l2_dir,workflow_name)
@@ -332,15 +493,13 @@ def l2_common_effect(l1_dir,
 
 	if not loud:
 		try:
-			workflow.run(plugin="MultiProc",  plugin_args={'n_procs' : nprocs})
+			run_workflow(workflow, plugin="MultiProc", plugin_args=multiproc_arguments(nprocs, memory_gb), keep_work=keep_work, cached_nodes=L2_CACHED_NODES, node_cache=node_cache, profile_dir=datasink.inputs.base_directory if profile else None)
 		except RuntimeError:
 			print("WARNING: Some expected scans have not been found (or another RuntimeError has occured).")
+			if not keep_work:
+				shutil.rmtree(path.join(l2_dir,workdir_name))
 		for f in listdir(getcwd()):
 			if re.search("crash.*?-varcopemerge|-copemerge.*", f):
 				remove(path.join(getcwd(), f))
 	else:
-		workflow.run(plugin="MultiProc",  plugin_args={'n_procs' : nprocs})
-
-
-	if not keep_work:
-		shutil.rmtree(path.join(l2_dir,workdir_name))
+		run_workflow(workflow, plugin="MultiProc", plugin_args=multiproc_arguments(nprocs, memory_gb), keep_work=keep_work, cached_nodes=L2_CACHED_NODES, node_cache=node_cache, profile_dir=datasink.inputs.base_directory if profile else None)
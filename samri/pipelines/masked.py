@@ -0,0 +1,135 @@
+"""Masked 2D representation of (functional) images, containing only the in-brain voxels.
+
+A masked image is stored as a NumPy ".npz" archive with the following arrays:
+
+data : (voxel, time) or (voxel,) float32 array of the in-mask values, in the C order of the mask voxels.
+mask : 3D boolean array.
+affine : 4x4 affine of the image.
+header : the raw bytes of the NIfTI header of the image, from which its zooms, units, and TR are recovered on conversion back to NIfTI.
+"""
+
+import numpy as np
+
+def _load_mask(mask, shape=None):
+	import nibabel as nib
+
+	if isinstance(mask, np.ndarray):
+		mask = mask.astype(bool)
+	else:
+		mask = np.asanyarray(nib.load(mask).dataobj).astype(bool)
+	if shape is not None and mask.shape != tuple(shape[:3]):
+		raise ValueError("The mask shape {} does not match the image shape {}.".format(mask.shape, tuple(shape[:3])))
+	return mask
+
+def save_masked(data, mask, affine, header, out_file):
+	"""Save in-mask values, together with the mask and the image geometry, to a masked ".npz" archive.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+	Array of shape (voxel, time) or (voxel,), with one row per nonzero `mask` voxel.
+
+	mask : numpy.ndarray
+	3D boolean mask.
+
+	affine : numpy.ndarray
+	4x4 image affine.
+
+	header : nibabel.Nifti1Header
+	Image header.
+
+	out_file : str
+	Path of the archive, ".npz" is appended by NumPy if missing.
+	"""
+	np.savez(out_file,
+		data=np.asarray(data, dtype=np.float32),
+		mask=mask,
+		affine=affine,
+		header=np.frombuffer(header.binaryblock, dtype=np.uint8),
+		)
+	if not out_file.endswith(".npz"):
+		out_file += ".npz"
+	return out_file
+
+def load_masked(in_file):
+	"""Load a masked ".npz" archive.
+
+	Returns
+	-------
+
+	data : numpy.ndarray
+	(voxel, time) or (voxel,) array of the in-mask values.
+
+	mask : numpy.ndarray
+	3D boolean mask.
+
+	affine : numpy.ndarray
+	4x4 image affine.
+
+	header : nibabel.Nifti1Header
+	Image header.
+	"""
+	import nibabel as nib
+
+	with np.load(in_file) as archive:
+		data = archive["data"]
+		mask = archive["mask"]
+		affine = archive["affine"]
+		header = nib.Nifti1Header(archive["header"].tobytes())
+	return data, mask, affine, header
+
+def mask_image(in_file, mask,
+	out_file="",
+	):
+	"""Convert a NIfTI image to a masked ".npz" archive, containing only the values inside the mask.
+
+	Parameters
+	----------
+
+	in_file : str
+	Path to a 3D or 4D NIfTI image.
+
+	mask : str or numpy.ndarray
+	Path to a 3D mask in the same voxel grid as `in_file`, or the mask array itself.
+
+	out_file : str, optional
+	Path of the archive. Defaults to the base name of `in_file` with a ".npz" extension, in the current directory.
+	"""
+	from os import path
+	import nibabel as nib
+
+	img = nib.load(in_file)
+	mask = _load_mask(mask, img.shape)
+	data = np.asanyarray(img.dataobj).astype(np.float32, copy=False)[mask]
+	if not out_file:
+		out_file = path.basename(in_file).split(".")[0]+".npz"
+	return save_masked(data, mask, img.affine, img.header, path.abspath(out_file))
+
+def unmask_image(in_file,
+	out_file="",
+	):
+	"""Convert a masked ".npz" archive back to a NIfTI image, with zeros outside the mask.
+
+	Parameters
+	----------
+
+	in_file : str
+	Path to the masked archive.
+
+	out_file : str, optional
+	Path of the NIfTI image. Defaults to the base name of `in_file` with a ".nii" extension, in the current directory.
+	"""
+	from os import path
+	import nibabel as nib
+
+	data, mask, affine, header = load_masked(in_file)
+	volume = np.zeros(mask.shape+data.shape[1:], dtype=np.float32)
+	volume[mask] = data
+	header.set_data_dtype(np.float32)
+	header.set_slope_inter(1, 0)
+	if not out_file:
+		out_file = path.basename(in_file).split(".")[0]+".nii"
+	out_file = path.abspath(out_file)
+	nib.save(nib.Nifti1Image(volume, affine, header), out_file)
+	return out_file
@@ -1,8 +1,12 @@
+import os
 from os import path
 
 import nipype.pipeline.engine as pe				# pypeline engine
 import nipype.interfaces.ants as ants
-from nipype.interfaces import fsl
+import nipype.interfaces.utility as util
+from nipype.interfaces import bru2nii, fsl
+
+from samri.pipelines.extra_interfaces import AdaptiveN4BiasFieldCorrection, BrukerToNifti
 
 PHASES = {
 	"f_rigid":{
@@ -73,7 +77,248 @@ PHASES = {
 		"use_estimate_learning_rate_once":False,
 		"use_histogram_matching":True,
 		},
+	#the "fast" phases form a Gaussian pyramid: linear transforms are estimated on 4x and 2x downsampled images only, SyN on the two finest levels, and all stop as soon as the similarity improvement stalls
+	"fast_f_rigid":{
+		"transforms":"Rigid",
+		"transform_parameters":(0.1,),
+		"number_of_iterations":[40,20],
+		"metric":"GC",
+		"metric_weight":1,
+		"radius_or_number_of_bins":32,
+		"sampling_strategy":"Regular",
+		"sampling_percentage":0.2,
+		"convergence_threshold":1.e-6,
+		"convergence_window_size":10,
+		"smoothing_sigmas":[2,1],
+		"sigma_units":"vox",
+		"shrink_factors":[4,2],
+		"use_estimate_learning_rate_once":False,
+		"use_histogram_matching":False,
+		},
+	"fast_rigid":{
+		"transforms":"Rigid",
+		"transform_parameters":(0.1,),
+		"number_of_iterations":[1000,500],
+		"metric":"GC",
+		"metric_weight":1,
+		"radius_or_number_of_bins":64,
+		"sampling_strategy":"Regular",
+		"sampling_percentage":0.2,
+		"convergence_threshold":1.e-6,
+		"convergence_window_size":10,
+		"smoothing_sigmas":[2,1],
+		"sigma_units":"vox",
+		"shrink_factors":[4,2],
+		"use_estimate_learning_rate_once":False,
+		"use_histogram_matching":True,
+		},
+	"fast_affine":{
+		"transforms":"Affine",
+		"transform_parameters":(0.1,),
+		"number_of_iterations":[500,250],
+		"metric":"MI",
+		"metric_weight":1,
+		"radius_or_number_of_bins":8,
+		"sampling_strategy":"Regular",
+		"sampling_percentage":0.3,
+		"convergence_threshold":1.e-6,
+		"convergence_window_size":10,
+		"smoothing_sigmas":[2,1],
+		"sigma_units":"vox",
+		"shrink_factors":[4,2],
+		"use_estimate_learning_rate_once":False,
+		"use_histogram_matching":True,
+		},
+	"fast_syn":{
+		"transforms":"SyN",
+		"transform_parameters":(0.1, 2.0, 0.2),
+		"number_of_iterations":[100,50],
+		"metric":"MI",
+		"metric_weight":1,
+		"radius_or_number_of_bins":16,
+		"sampling_strategy":None,
+		"sampling_percentage":0.3,
+		"convergence_threshold":1.e-6,
+		"convergence_window_size":10,
+		"smoothing_sigmas":[1,0],
+		"sigma_units":"vox",
+		"shrink_factors":[2,1],
+		"use_estimate_learning_rate_once":False,
+		"use_histogram_matching":True,
+		},
+	}
+
+#selections of `PHASES` for the structural (and structural-like functional) registration and the functional to structural registration
+REGISTRATION_PRESETS = {
+	"default":{
+		"s_phases":["s_rigid","affine","syn"],
+		"f_phases":["f_rigid"],
+		},
+	"fast":{
+		"s_phases":["fast_rigid","fast_affine","fast_syn"],
+		"f_phases":["fast_f_rigid"],
+		},
+	}
+
+#N4 parameters for actual and inflated (x10) voxel sizes; the iterations are upper limits, the convergence thresholds are attainable, so that the fitting levels stop early
+#both share the same convergence-driven schedule; the B-spline fitting distance (in mm) scales with the voxel size
+N4_PRESETS = {
+	"real_size":{
+		"bspline_fitting_distance":10,
+		"bspline_order":4,
+		"n_iterations":[150,100,50,30],
+		"convergence_threshold":1e-7,
+		},
+	"inflated_size":{
+		"bspline_fitting_distance":100,
+		"n_iterations":[150,100,50,30],
+		"convergence_threshold":1e-7,
+		},
+	}
+#the bias field is smooth, and can be estimated on images shrunk to about this many voxels (see `samri.pipelines.extra_interfaces.AdaptiveN4BiasFieldCorrection`)
+N4_SHRINK_TARGET_VOXELS = 2*10**5
+
+#estimated memory requirements, in bytes per voxel of the (template) image; SyN keeps several full-resolution displacement fields (and their inverses) in memory
+REGISTRATION_BYTES_PER_VOXEL = {
+	"Rigid":64,
+	"Affine":64,
+	"SyN":512,
 	}
+#ApplyTransforms and fslmaths hold the full input and output time series in memory
+TIMESERIES_BYTES_PER_VOXEL = 16
+N4_BYTES_PER_VOXEL = 128
+#number of voxels and volumes assumed if they cannot be determined at workflow construction time
+DEFAULT_VOXELS = 100*150*100
+DEFAULT_FUNCTIONAL_VOXELS = 64*64*32
+DEFAULT_VOLUMES = 1500
+
+def image_voxels(image):
+	"""Return the number of spatial voxels of a NIfTI image (read from the header only), or `DEFAULT_VOXELS` if the image cannot be read."""
+	import nibabel as nib
+	import numpy as np
+	try:
+		return int(np.prod(nib.load(path.abspath(path.expanduser(image))).shape[:3]))
+	except (IOError, OSError):
+		return DEFAULT_VOXELS
+
+def estimate_mem_gb(voxels, bytes_per_voxel,
+	base_gb=0.25,
+	):
+	"""Estimate the memory requirements of a node in GB, from the number of voxels it processes."""
+	return round(base_gb + float(voxels)*bytes_per_voxel/1024**3, 2)
+
+def set_resources(node,
+	n_procs=1,
+	mem_gb=0.25,
+	):
+	"""Declare the CPU and memory requirements of a node, so that the MultiProc plugin can schedule it accordingly.
+
+	For interfaces with a `num_threads` input (e.g. ANTs) this also sets the number of threads used.
+	"""
+	node.n_procs = n_procs
+	#`mem_gb` is a read-only property, which can otherwise only be set via the node constructor
+	node._mem_gb = mem_gb
+	#not all nipype versions propagate `n_procs` to the interface
+	if hasattr(node.interface.inputs, "num_threads"):
+		node.interface.inputs.num_threads = n_procs
+	return node
+
+TEMPLATE_CACHE = "~/.samri/templates"
+
+def _atomic_save(img, file_path):
+	import nibabel as nib
+	temporary_path = "{}.{}.tmp.nii".format(file_path[:-4], os.getpid())
+	nib.save(img, temporary_path)
+	os.rename(temporary_path, file_path)
+
+def prepare_template(template,
+	mask=None,
+	cache_dir=TEMPLATE_CACHE,
+	):
+	"""Precompute the template-side inputs of the registration nodes once, and store them in a cache directory shared across workflows.
+
+	The template is stored uncompressed and in single precision (the precision at which the registrations are performed), so that registration and warping nodes need not decompress and convert it for every subject.
+	If a mask is given, it is stored as uncompressed 8-bit integers.
+	ANTs builds its smoothing and shrinking pyramid internally, and cannot be passed precomputed levels.
+
+	Parameters
+	----------
+
+	template : str
+	Path to the template image.
+
+	mask : str, optional
+	Path to the template mask.
+
+	cache_dir : str, optional
+	Directory in which to store the prepared templates, in a subdirectory specific to the template and mask files (as identified by their paths, sizes, and modification times).
+
+	Returns
+	-------
+
+	dict
+	With the keys "template", "mask" (`None` if no mask is given), and "sources" (path to a JSON file listing the source files, which marks the preparation as complete).
+	"""
+	import hashlib
+	import json
+	import nibabel as nib
+	import numpy as np
+
+	template = path.abspath(path.expanduser(template))
+	sources = [template]
+	if mask:
+		mask = path.abspath(path.expanduser(mask))
+		sources.append(mask)
+	identifier = hashlib.sha1()
+	for source in sources:
+		source_stat = os.stat(source)
+		identifier.update("{}:{}:{}".format(source, source_stat.st_size, source_stat.st_mtime).encode("utf-8"))
+	prepared_dir = path.join(path.abspath(path.expanduser(cache_dir)), identifier.hexdigest()[:16])
+
+	prepared = {
+		"template":path.join(prepared_dir,"template.nii"),
+		"mask":path.join(prepared_dir,"mask.nii") if mask else None,
+		"sources":path.join(prepared_dir,"sources.json"),
+		}
+	if path.isfile(prepared["sources"]):
+		return prepared
+	if not path.isdir(prepared_dir):
+		os.makedirs(prepared_dir)
+
+	template_img = nib.load(template)
+	template_data = np.asanyarray(template_img.dataobj).astype(np.float32)
+	template_header = template_img.header.copy()
+	template_header.set_data_dtype(np.float32)
+	_atomic_save(nib.Nifti1Image(template_data, template_img.affine, template_header), prepared["template"])
+	if mask:
+		mask_img = nib.load(mask)
+		mask_data = np.asanyarray(mask_img.dataobj) > 0
+		mask_header = mask_img.header.copy()
+		mask_header.set_data_dtype(np.uint8)
+		_atomic_save(nib.Nifti1Image(mask_data.astype(np.uint8), mask_img.affine, mask_header), prepared["mask"])
+	#the sources file is written last, and marks the preparation as complete
+	temporary_path = "{}.{}.tmp".format(prepared["sources"], os.getpid())
+	with open(temporary_path, "w") as sources_file:
+		json.dump(sources, sources_file, indent=1)
+	os.rename(temporary_path, prepared["sources"])
+
+	return prepared
+
+def _template_and_mask(template, mask, template_cache):
+	"""Return the paths to the prepared template and mask (see `prepare_template()`), or to the original files if the template cache is disabled or the template cannot be read."""
+	template = path.abspath(path.expanduser(template))
+	if mask:
+		mask = path.abspath(path.expanduser(mask))
+	if template_cache:
+		try:
+			prepared = prepare_template(template, mask, template_cache)
+		except (IOError, OSError) as e:
+			print("WARNING: The template could not be prepared ({}), using the original files.".format(e))
+		else:
+			template = prepared["template"]
+			if mask:
+				mask = prepared["mask"]
+	return template, mask
 
 def autorotate(template):
 	flt = fsl.FLIRT(bins=640, cost_func='mutualinfo')
@@ -89,51 +334,64 @@ def autorotate(template):
 	rotated = flt.run()
 	return rotated
 
-def structural_registration(template, num_threads=4):
+def structural_registration(template, num_threads=4, registration_preset="default", template_cache=TEMPLATE_CACHE):
+	"""Return nodes for registering an inflated size structural scan to a template, and for warping structural and functional scans into the template space.
+
+	The "default" `registration_preset` uses affine and SyN parameters tuned for this registration; other keys of `REGISTRATION_PRESETS` select its `s_phases` from `PHASES` instead.
+	"""
+	template, _ = _template_and_mask(template, None, template_cache)
 	registration = pe.Node(ants.Registration(), name="s_register")
 	registration.inputs.fixed_image = path.abspath(path.expanduser(template))
 	registration.inputs.output_transform_prefix = "output_"
-	registration.inputs.transforms = ['Affine', 'SyN'] ##
-	registration.inputs.transform_parameters = [(1.0,), (1.0, 3.0, 5.0)] ##
-	registration.inputs.number_of_iterations = [[2000, 1000, 500], [100, 100, 100]] #
 	registration.inputs.dimension = 3
 	registration.inputs.write_composite_transform = True
 	registration.inputs.collapse_output_transforms = True
 	registration.inputs.initial_moving_transform_com = True
-	# Tested on Affine transform: CC takes too long; Demons does not tilt, but moves the slices too far caudally; GC tilts too much on; MI and MeanSquares seem equally good
-	registration.inputs.metric = ['MeanSquares', 'Mattes']
-	registration.inputs.metric_weight = [1, 1]
-	registration.inputs.radius_or_number_of_bins = [16, 32] #
-	registration.inputs.sampling_strategy = ['Random', None]
-	registration.inputs.sampling_percentage = [0.3, 0.3]
-	registration.inputs.convergence_threshold = [1.e-11, 1.e-8] #
-	registration.inputs.convergence_window_size = [20, 20]
-	registration.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1]]
-	registration.inputs.sigma_units = ['vox', 'vox']
-	registration.inputs.shrink_factors = [[3, 2, 1],[3, 2, 1]]
-	registration.inputs.use_estimate_learning_rate_once = [True, True]
-	# if the fixed_image is not acquired similarly to the moving_image (e.g. RARE to histological (e.g. AMBMC)) this should be False
-	registration.inputs.use_histogram_matching = [False, False]
+	if registration_preset == "default":
+		registration.inputs.transforms = ['Affine', 'SyN'] ##
+		registration.inputs.transform_parameters = [(1.0,), (1.0, 3.0, 5.0)] ##
+		registration.inputs.number_of_iterations = [[2000, 1000, 500], [100, 100, 100]] #
+		# Tested on Affine transform: CC takes too long; Demons does not tilt, but moves the slices too far caudally; GC tilts too much on; MI and MeanSquares seem equally good
+		registration.inputs.metric = ['MeanSquares', 'Mattes']
+		registration.inputs.metric_weight = [1, 1]
+		registration.inputs.radius_or_number_of_bins = [16, 32] #
+		registration.inputs.sampling_strategy = ['Random', None]
+		registration.inputs.sampling_percentage = [0.3, 0.3]
+		registration.inputs.convergence_threshold = [1.e-11, 1.e-8] #
+		registration.inputs.convergence_window_size = [20, 20]
+		registration.inputs.smoothing_sigmas = [[4, 2, 1], [4, 2, 1]]
+		registration.inputs.sigma_units = ['vox', 'vox']
+		registration.inputs.shrink_factors = [[3, 2, 1],[3, 2, 1]]
+		registration.inputs.use_estimate_learning_rate_once = [True, True]
+		# if the fixed_image is not acquired similarly to the moving_image (e.g. RARE to histological (e.g. AMBMC)) this should be False
+		registration.inputs.use_histogram_matching = [False, False]
+		transforms = ['Affine', 'SyN']
+	else:
+		s_parameters = [PHASES[selection] for selection in REGISTRATION_PRESETS[registration_preset]["s_phases"]]
+		for key in s_parameters[0]:
+			setattr(registration.inputs, key, [i[key] for i in s_parameters])
+		transforms = [i["transforms"] for i in s_parameters]
 	registration.inputs.winsorize_lower_quantile = 0.005
 	registration.inputs.winsorize_upper_quantile = 0.995
 	registration.inputs.args = '--float'
-	registration.inputs.num_threads = num_threads
+	voxels = image_voxels(template)
+	set_resources(registration, num_threads, estimate_mem_gb(voxels, max([REGISTRATION_BYTES_PER_VOXEL[i] for i in transforms])))
 
 	f_warp = pe.Node(ants.ApplyTransforms(), name="f_warp")
 	f_warp.inputs.reference_image = path.abspath(path.expanduser(template))
 	f_warp.inputs.input_image_type = 3
 	f_warp.inputs.interpolation = 'Linear'
 	f_warp.inputs.invert_transform_flags = [False]
-	f_warp.inputs.terminal_output = 'file'
-	f_warp.num_threads = num_threads
+	f_warp.interface.terminal_output = 'file'
+	set_resources(f_warp, num_threads, estimate_mem_gb(voxels*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
 
 	s_warp = pe.Node(ants.ApplyTransforms(), name="s_warp")
 	s_warp.inputs.reference_image = path.abspath(path.expanduser(template))
 	s_warp.inputs.input_image_type = 3
 	s_warp.inputs.interpolation = 'Linear'
 	s_warp.inputs.invert_transform_flags = [False]
-	s_warp.inputs.terminal_output = 'file'
-	s_warp.num_threads = num_threads
+	s_warp.interface.terminal_output = 'file'
+	set_resources(s_warp, num_threads, estimate_mem_gb(voxels, TIMESERIES_BYTES_PER_VOXEL))
 
 	return registration, s_warp, f_warp
 
@@ -143,8 +401,11 @@ def DSURQEc_structural_registration(template,
 	phase_dictionary=PHASES,
 	s_phases=["s_rigid","affine","syn"],
 	f_phases=["f_rigid",],
+	template_cache=TEMPLATE_CACHE,
 	):
 
+	template, mask = _template_and_mask(template, mask, template_cache)
+
 	s_parameters = [phase_dictionary[selection] for selection in s_phases]
 
 	s_registration = pe.Node(ants.Registration(), name="s_register")
@@ -174,7 +435,8 @@ def DSURQEc_structural_registration(template,
 	s_registration.inputs.args = '--float'
 	if mask:
 		s_registration.inputs.fixed_image_masks = [path.abspath(path.expanduser(mask))]
-	s_registration.inputs.num_threads = num_threads
+	voxels = image_voxels(template)
+	set_resources(s_registration, num_threads, estimate_mem_gb(voxels, max([REGISTRATION_BYTES_PER_VOXEL[i["transforms"]] for i in s_parameters])))
 
 	f_parameters = [phase_dictionary[selection] for selection in f_phases]
 
@@ -205,28 +467,28 @@ def DSURQEc_structural_registration(template,
 	f_registration.inputs.args = '--float'
 	if mask:
 		f_registration.inputs.fixed_image_masks = [path.abspath(path.expanduser(mask))]
-	f_registration.inputs.num_threads = num_threads
-
+	set_resources(f_registration, num_threads, estimate_mem_gb(voxels, max([REGISTRATION_BYTES_PER_VOXEL[i["transforms"]] for i in f_parameters])))
 
 	f_warp = pe.Node(ants.ApplyTransforms(), name="f_warp")
 	f_warp.inputs.reference_image = path.abspath(path.expanduser(template))
 	f_warp.inputs.input_image_type = 3
 	f_warp.inputs.interpolation = 'Linear'
 	f_warp.inputs.invert_transform_flags = [False, False]
-	f_warp.inputs.terminal_output = 'file'
-	f_warp.num_threads = num_threads
+	f_warp.interface.terminal_output = 'file'
+	set_resources(f_warp, num_threads, estimate_mem_gb(voxels*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
 
 	s_warp = pe.Node(ants.ApplyTransforms(), name="s_warp")
 	s_warp.inputs.reference_image = path.abspath(path.expanduser(template))
 	s_warp.inputs.input_image_type = 3
 	s_warp.inputs.interpolation = 'Linear'
 	s_warp.inputs.invert_transform_flags = [False]
-	s_warp.inputs.terminal_output = 'file'
-	s_warp.num_threads = num_threads
+	s_warp.interface.terminal_output = 'file'
+	set_resources(s_warp, num_threads, estimate_mem_gb(voxels, TIMESERIES_BYTES_PER_VOXEL))
 
 	return s_registration, s_warp, f_registration, f_warp
 
-def composite_registration(template, num_threads=4):
+def composite_registration(template, num_threads=4, template_cache=TEMPLATE_CACHE):
+	template, _ = _template_and_mask(template, None, template_cache)
 	f_registration = pe.Node(ants.Registration(), name="f_register")
 	f_registration.inputs.output_transform_prefix = "output_"
 	f_registration.inputs.transforms = ['Rigid']
@@ -251,15 +513,16 @@ def composite_registration(template, num_threads=4):
 	f_registration.inputs.winsorize_lower_quantile = 0.005
 	f_registration.inputs.winsorize_upper_quantile = 0.995
 	f_registration.inputs.args = '--float'
-	f_registration.inputs.num_threads = num_threads
+	voxels = image_voxels(template)
+	set_resources(f_registration, num_threads, estimate_mem_gb(voxels, REGISTRATION_BYTES_PER_VOXEL["Rigid"]))
 
 	f_warp = pe.Node(ants.ApplyTransforms(), name="f_warp")
 	f_warp.inputs.reference_image = path.abspath(path.expanduser(template))
 	f_warp.inputs.input_image_type = 3
 	f_warp.inputs.interpolation = 'Linear'
 	f_warp.inputs.invert_transform_flags = [False, False]
-	f_warp.inputs.terminal_output = 'file'
-	f_warp.num_threads = num_threads
+	f_warp.interface.terminal_output = 'file'
+	set_resources(f_warp, num_threads, estimate_mem_gb(voxels*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
 
 	return f_registration, f_warp
 
@@ -268,9 +531,10 @@ def functional_registration(template,
 	num_threads=4,
 	phase_dictionary=PHASES,
 	f_phases=["s_rigid","affine","syn"],
+	template_cache=TEMPLATE_CACHE,
 	):
 
-	template = path.abspath(path.expanduser(template))
+	template, mask = _template_and_mask(template, mask, template_cache)
 
 	f_parameters = [phase_dictionary[selection] for selection in f_phases]
 
@@ -301,50 +565,213 @@ def functional_registration(template,
 	f_registration.inputs.args = '--float'
 	if mask:
 		f_registration.inputs.fixed_image_masks = [path.abspath(path.expanduser(mask))]
-	f_registration.inputs.num_threads = num_threads
+	voxels = image_voxels(template)
+	set_resources(f_registration, num_threads, estimate_mem_gb(voxels, max([REGISTRATION_BYTES_PER_VOXEL[i["transforms"]] for i in f_parameters])))
 
 	warp = pe.Node(ants.ApplyTransforms(), name="f_warp")
 	warp.inputs.reference_image = template
 	warp.inputs.input_image_type = 3
 	warp.inputs.interpolation = 'Linear'
 	warp.inputs.invert_transform_flags = [False]
-	warp.inputs.terminal_output = 'file'
-	warp.num_threads = 4
+	warp.interface.terminal_output = 'file'
+	set_resources(warp, num_threads, estimate_mem_gb(voxels*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
 
 	return f_registration, warp
 
-def real_size_nodes():
-	s_biascorrect = pe.Node(interface=ants.N4BiasFieldCorrection(), name="s_biascorrect")
-	s_biascorrect.inputs.dimension = 3
-	s_biascorrect.inputs.bspline_fitting_distance = 10
-	s_biascorrect.inputs.bspline_order = 4
-	s_biascorrect.inputs.shrink_factor = 2
-	s_biascorrect.inputs.n_iterations = [150,100,50,30]
-	s_biascorrect.inputs.convergence_threshold = 1e-16
-
-	f_biascorrect = pe.Node(interface=ants.N4BiasFieldCorrection(), name="f_biascorrect")
-	f_biascorrect.inputs.dimension = 3
-	f_biascorrect.inputs.bspline_fitting_distance = 10
-	f_biascorrect.inputs.bspline_order = 4
-	f_biascorrect.inputs.shrink_factor = 2
-	f_biascorrect.inputs.n_iterations = [150,100,50,30]
-	f_biascorrect.inputs.convergence_threshold = 1e-11
+def session_registration(template,
+	num_threads=4,
+	phase_dictionary=PHASES,
+	s_phases=["s_rigid"],
+	template_cache=TEMPLATE_CACHE,
+	):
+	"""Return nodes for registering a session's structural scan to a subject template (to be connected to the `fixed_image` input of the registration node, see `samri.pipelines.preprocessing.subject_templates()`), and for warping structural and functional scans into the study template space.
 
-	return s_biascorrect, f_biascorrect
+	The warping nodes expect a single list of transforms, composed from the study template back to the scan (e.g. functional-to-session, session-to-subject, subject-to-template), so that each image is resampled only once.
+	"""
+	template, _ = _template_and_mask(template, None, template_cache)
+
+	s_parameters = [phase_dictionary[selection] for selection in s_phases]
+
+	s_registration = pe.Node(ants.Registration(), name="s_register")
+	s_registration.inputs.output_transform_prefix = "output_"
+	s_registration.inputs.dimension = 3
+	s_registration.inputs.write_composite_transform = True
+	s_registration.inputs.collapse_output_transforms = True
+	s_registration.inputs.initial_moving_transform_com = True
+	for key in s_parameters[0]:
+		setattr(s_registration.inputs, key, [i[key] for i in s_parameters])
+	s_registration.inputs.winsorize_lower_quantile = 0.05
+	s_registration.inputs.winsorize_upper_quantile = 0.95
+	s_registration.inputs.args = '--float'
+	set_resources(s_registration, num_threads, estimate_mem_gb(DEFAULT_VOXELS, max([REGISTRATION_BYTES_PER_VOXEL[i["transforms"]] for i in s_parameters])))
 
-def inflated_size_nodes():
-	s_biascorrect = pe.Node(interface=ants.N4BiasFieldCorrection(), name="s_biascorrect")
-	s_biascorrect.inputs.dimension = 3
-	s_biascorrect.inputs.bspline_fitting_distance = 100
-	s_biascorrect.inputs.shrink_factor = 2
-	s_biascorrect.inputs.n_iterations = [200,200,200,200]
-	s_biascorrect.inputs.convergence_threshold = 1e-11
-
-	f_biascorrect = pe.Node(interface=ants.N4BiasFieldCorrection(), name="f_biascorrect")
-	f_biascorrect.inputs.dimension = 3
-	f_biascorrect.inputs.bspline_fitting_distance = 100
-	f_biascorrect.inputs.shrink_factor = 2
-	f_biascorrect.inputs.n_iterations = [200,200,200,200]
-	f_biascorrect.inputs.convergence_threshold = 1e-11
+	voxels = image_voxels(template)
 
+	f_warp = pe.Node(ants.ApplyTransforms(), name="f_warp")
+	f_warp.inputs.reference_image = template
+	f_warp.inputs.input_image_type = 3
+	f_warp.inputs.interpolation = 'Linear'
+	f_warp.interface.terminal_output = 'file'
+	set_resources(f_warp, num_threads, estimate_mem_gb(voxels*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
+
+	s_warp = pe.Node(ants.ApplyTransforms(), name="s_warp")
+	s_warp.inputs.reference_image = template
+	s_warp.inputs.input_image_type = 3
+	s_warp.inputs.interpolation = 'Linear'
+	s_warp.interface.terminal_output = 'file'
+	set_resources(s_warp, num_threads, estimate_mem_gb(voxels, TIMESERIES_BYTES_PER_VOXEL))
+
+	return s_registration, s_warp, f_warp
+
+def biascorrect_node(name,
+	preset="inflated_size",
+	num_threads=2,
+	shrink_target_voxels=N4_SHRINK_TARGET_VOXELS,
+	):
+	"""Return an N4 bias field correction node configured from `N4_PRESETS`, with the shrink factor chosen from the size of its input image."""
+	biascorrect = pe.Node(interface=AdaptiveN4BiasFieldCorrection(), name=name)
+	biascorrect.inputs.dimension = 3
+	biascorrect.inputs.shrink_target_voxels = shrink_target_voxels
+	for key, value in N4_PRESETS[preset].items():
+		setattr(biascorrect.inputs, key, value)
+	set_resources(biascorrect, num_threads, estimate_mem_gb(DEFAULT_VOXELS, N4_BYTES_PER_VOXEL))
+	return biascorrect
+
+def real_size_nodes(num_threads=2):
+	s_biascorrect = biascorrect_node("s_biascorrect", "real_size", num_threads)
+	f_biascorrect = biascorrect_node("f_biascorrect", "real_size", num_threads)
+	return s_biascorrect, f_biascorrect
+
+def inflated_size_nodes(num_threads=2):
+	s_biascorrect = biascorrect_node("s_biascorrect", "inflated_size", num_threads)
+	f_biascorrect = biascorrect_node("f_biascorrect", "inflated_size", num_threads)
 	return s_biascorrect, f_biascorrect
+
+def structural_workflow(template,
+	actual_size=False,
+	name="structural",
+	native_conversion=False,
+	num_threads=4,
+	register=True,
+	registration_mask=False,
+	registration_preset="default",
+	subject_template=False,
+	template_cache=TEMPLATE_CACHE,
+	):
+	"""Return a workflow converting a structural scan, correcting its bias field, extracting the brain (for inflated voxel sizes), and registering it to the template.
+
+	The workflow is shared by all SAMRI workflows processing structural scans.
+	As the paths of its nodes relative to the enclosing work directory only depend on its name and the upstream iterables, their results can be shared across workflows via the node cache (see `samri.pipelines.execution.restore_cached_nodes()`).
+
+	Parameters
+	----------
+
+	template : str
+	Path to the template to register to.
+
+	actual_size : bool, optional
+	Whether the scan is converted with its actual voxel size (rather than inflated by a factor of 10), which selects the bias correction preset and registration.
+
+	name : str, optional
+	Name of the workflow.
+
+	native_conversion : bool, optional
+	Whether to convert the Bruker data in-process, rather than via the Bru2 command line tool.
+
+	num_threads : int, optional
+	Number of threads for each registration node; bias field correction uses up to 2 threads.
+
+	register : bool, optional
+	Whether to correct, skull-strip, and register the scan; if False, the workflow only converts it.
+
+	registration_mask : str or bool, optional
+	Template mask for actual-size registration.
+
+	registration_preset : str, optional
+	Key of `REGISTRATION_PRESETS` selecting the registration phases.
+	For inflated voxel sizes, "default" keeps the parameters of `structural_registration()`, and other presets select their structural phases.
+
+	subject_template : bool, optional
+	Whether the scan is registered rigidly to a subject template (see `session_registration()`), rather than directly to `template`.
+
+	template_cache : str or bool, optional
+	Directory in which the template is prepared for registration (see `prepare_template()`).
+
+	Returns
+	-------
+
+	nipype.pipeline.engine.Workflow
+	With an "inputnode" node with the fields "scan_path" (Bruker scan directory), and "subject_template" and "subject_transform" (the subject template and its transform to `template`, used if `subject_template` is True);
+	and an "outputnode" node with the fields "nii_file" (converted scan), "biascorrected", "transforms" (the transform(s) from the scan to `template`, in the order expected by ANTs), and "warped" (the scan in template space).
+	"""
+	workflow = pe.Workflow(name=name)
+
+	inputnode = pe.Node(interface=util.IdentityInterface(fields=['scan_path','subject_template','subject_transform']), name="inputnode")
+	outputnode = pe.Node(interface=util.IdentityInterface(fields=['nii_file','biascorrected','transforms','warped']), name="outputnode")
+
+	if native_conversion:
+		s_bru2nii = pe.Node(interface=BrukerToNifti(), name="s_bru2nii")
+	else:
+		s_bru2nii = pe.Node(interface=bru2nii.Bru2(), name="s_bru2nii")
+		s_bru2nii.inputs.force_conversion=True
+	s_bru2nii.inputs.actual_size=actual_size
+
+	workflow_connections = [
+		(inputnode, s_bru2nii, [('scan_path','input_dir')]),
+		(s_bru2nii, outputnode, [('nii_file','nii_file')]),
+		]
+
+	if register:
+		if actual_size:
+			s_biascorrect = biascorrect_node("s_biascorrect", "real_size", num_threads=min(2, num_threads))
+			s_register, s_warp, _, _ = DSURQEc_structural_registration(template, registration_mask, num_threads=num_threads, template_cache=template_cache, **REGISTRATION_PRESETS[registration_preset])
+			s_registration_input, s_registration_output = s_biascorrect, 'output_image'
+		else:
+			s_biascorrect = biascorrect_node("s_biascorrect", "inflated_size", num_threads=min(2, num_threads))
+			s_register, s_warp, _ = structural_registration(template, num_threads=num_threads, registration_preset=registration_preset, template_cache=template_cache)
+
+			s_cutoff = pe.Node(interface=fsl.ImageMaths(), name="s_cutoff")
+			s_cutoff.inputs.op_string = "-thrP 20 -uthrp 98"
+
+			s_BET = pe.Node(interface=fsl.BET(), name="s_BET")
+			s_BET.inputs.mask = True
+			s_BET.inputs.frac = 0.3
+			s_BET.inputs.robust = True
+
+			s_mask = pe.Node(interface=fsl.ApplyMask(), name="s_mask")
+
+			workflow_connections.extend([
+				#the same bias field estimate serves both brain extraction and registration
+				(s_biascorrect, s_cutoff, [('output_image', 'in_file')]),
+				(s_cutoff, s_BET, [('out_file', 'in_file')]),
+				(s_biascorrect, s_mask, [('output_image', 'in_file')]),
+				(s_BET, s_mask, [('mask_file', 'mask_file')]),
+				])
+			s_registration_input, s_registration_output = s_mask, 'out_file'
+
+		if subject_template:
+			s_register, s_warp, _ = session_registration(template, num_threads=num_threads, s_phases=REGISTRATION_PRESETS[registration_preset]["s_phases"][:1], template_cache=template_cache)
+			s_transforms = pe.Node(util.Merge(2), name='s_transforms')
+			workflow_connections.extend([
+				(inputnode, s_register, [('subject_template', 'fixed_image')]),
+				(s_register, s_transforms, [('composite_transform', 'in1')]),
+				(inputnode, s_transforms, [('subject_transform', 'in2')]),
+				(s_transforms, s_warp, [('out', 'transforms')]),
+				(s_transforms, outputnode, [('out', 'transforms')]),
+				])
+		else:
+			workflow_connections.extend([
+				(s_register, s_warp, [('composite_transform', 'transforms')]),
+				(s_register, outputnode, [('composite_transform', 'transforms')]),
+				])
+
+		workflow_connections.extend([
+			(s_bru2nii, s_biascorrect, [('nii_file', 'input_image')]),
+			(s_biascorrect, outputnode, [('output_image', 'biascorrected')]),
+			(s_registration_input, s_register, [(s_registration_output, 'moving_image')]),
+			(s_bru2nii, s_warp, [('nii_file', 'input_image')]),
+			(s_warp, outputnode, [('output_image', 'warped')]),
+			])
+
+	workflow.connect(workflow_connections)
+	return workflow
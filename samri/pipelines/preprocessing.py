@@ -1,11 +1,13 @@
 from os import path, listdir, getcwd, remove
 try:
-	from ..extra_functions import get_data_selection, get_scan, write_events_file, force_dummy_scans
+	from ..extra_functions import get_data_selection, get_scan, session_scans, get_subject_scans, subject_scans, get_subject_template, rigid_mean_template, scan_lookup, stimulation_protocol_timings, PROTOCOL_TIMINGS_CACHE, write_events_file, force_dummy_scans
 except (SystemError, ValueError, ImportError):
-	from samri.pipelines.extra_functions import get_data_selection, get_scan, write_events_file, force_dummy_scans
+	from samri.pipelines.extra_functions import get_data_selection, get_scan, session_scans, get_subject_scans, subject_scans, get_subject_template, rigid_mean_template, scan_lookup, stimulation_protocol_timings, PROTOCOL_TIMINGS_CACHE, write_events_file, force_dummy_scans
 
-import re
+import hashlib
 import inspect
+import json
+import re
 import shutil
 from copy import deepcopy
 from itertools import product
@@ -17,21 +19,149 @@ import nipype.pipeline.engine as pe				# pypeline engine
 import pandas as pd
 from nipype.interfaces import afni, bru2nii, fsl, nipy
 
+from samri.pipelines.execution import multiproc_arguments, run_workflow, NODE_CACHE, PREPROCESSING_CACHED_NODES
+from samri.pipelines.extra_interfaces import Bandpass, BrukerToNifti
+from samri.pipelines.masked import unmask_image
 from samri.pipelines.nodes import *
-from samri.pipelines.utils import ss_to_path, sss_filename, fslmaths_invert_values, STIM_PROTOCOL_DICTIONARY
+from samri.pipelines.utils import dictionary_value, s_to_path, ss_to_path, sss_filename, compress_image, fslmaths_bandpass, set_intermediate_format, INTERMEDIATE_EXTENSIONS, INTERMEDIATE_FORMAT, STIM_PROTOCOL_DICTIONARY
 from samri.utilities import N_PROCS
 
 DUMMY_SCANS=10
 N_PROCS=max(N_PROCS-4, 2)
 
-#set all outputs to compressed NIfTI
-afni.base.AFNICommand.set_default_output_type('NIFTI_GZ')
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
-
 #relative paths
 thisscriptspath = path.dirname(path.realpath(__file__))
 scan_classification_file_path = path.join(thisscriptspath,"scan_type_classification.csv")
 
+def subject_templates(measurements_base, data_lookup, subjects, scan_type,
+	actual_size=False,
+	keep_work=False,
+	memory_gb=None,
+	n_procs=N_PROCS,
+	native_conversion=False,
+	registration_mask=False,
+	registration_preset="default",
+	template="/home/chymera/ni_data/templates/ds_QBI_chr.nii.gz",
+	template_cache=TEMPLATE_CACHE,
+	workflow_name="generic",
+	):
+	'''Create a template for each subject from its structural scans across all sessions, and register it to the study template.
+
+	The scans are preprocessed and registered as in `samri.pipelines.nodes.structural_workflow()`, i.e. skull-stripped for inflated voxel sizes.
+	The outputs are stored in a directory specific to the subject's scans and to the parameters they depend on, and subjects for which both outputs already exist are not reprocessed.
+
+	subjects: list of str
+		Subjects for which to create templates.
+
+	scan_type: str
+		Structural scan type from which to create the subject templates.
+
+	Returns a dictionary with subjects as keys and (subject template, subject-to-study-template composite transform) tuples as values.
+	Other parameters are as for `bruker()`.
+	'''
+
+	out_dir = path.join(measurements_base,"preprocessing",workflow_name+"_subjects")
+	parameters = [
+		path.abspath(path.expanduser(template)),
+		path.abspath(path.expanduser(registration_mask)) if registration_mask else registration_mask,
+		registration_preset,
+		actual_size,
+		native_conversion,
+		scan_type,
+		]
+	containers = {}
+	templates = {}
+	for subject in subjects:
+		scan_paths = get_subject_scans(measurements_base, subject_scans(subject, data_lookup), scan_type)
+		identifier = hashlib.sha1(json.dumps(parameters+scan_paths).encode("utf-8"))
+		containers[subject] = "sub-{}/{}".format(subject, identifier.hexdigest()[:16])
+		templates[subject] = (
+			path.join(out_dir,containers[subject],"subject_template.nii.gz"),
+			path.join(out_dir,containers[subject],"output_Composite.h5"),
+			)
+	missing_subjects = [i for i in subjects if not all([path.isfile(j) for j in templates[i]])]
+	if not missing_subjects:
+		return templates
+
+	num_threads = min(4, n_procs)
+
+	subjectsource = pe.Node(interface=util.IdentityInterface(fields=['subject']), name="subjectsource")
+	subjectsource.iterables = [('subject', missing_subjects)]
+
+	get_subject_s_scans = pe.Node(name='get_subject_s_scans', interface=util.Function(function=get_subject_scans,input_names=inspect.getargspec(get_subject_scans)[0], output_names=['scan_paths']))
+	get_subject_s_scans.inputs.measurements_base = measurements_base
+	get_subject_s_scans.inputs.scan_type = scan_type
+
+	if native_conversion:
+		s_bru2nii = pe.MapNode(interface=BrukerToNifti(), name="s_bru2nii", iterfield=['input_dir'])
+	else:
+		s_bru2nii = pe.MapNode(interface=bru2nii.Bru2(), name="s_bru2nii", iterfield=['input_dir'])
+		s_bru2nii.inputs.force_conversion=True
+	s_bru2nii.inputs.actual_size=actual_size
+
+	if actual_size:
+		s_biascorrect, _ = real_size_nodes(num_threads=min(2, n_procs))
+	else:
+		s_biascorrect, _ = inflated_size_nodes(num_threads=min(2, n_procs))
+	s_biascorrect = set_resources(pe.MapNode(interface=s_biascorrect.interface, name="s_biascorrect", iterfield=['input_image']), s_biascorrect.n_procs, s_biascorrect.mem_gb)
+
+	subject_template = pe.Node(name='subject_template', interface=util.Function(function=rigid_mean_template,input_names=inspect.getargspec(rigid_mean_template)[0], output_names=['out_file']))
+	subject_template.inputs.num_threads = num_threads
+	set_resources(subject_template, num_threads, estimate_mem_gb(DEFAULT_VOXELS, REGISTRATION_BYTES_PER_VOXEL["Rigid"]))
+
+	workflow_connections = [
+		(subjectsource, get_subject_s_scans, [(('subject',subject_scans,data_lookup), 'data_selection')]),
+		(get_subject_s_scans, s_bru2nii, [('scan_paths', 'input_dir')]),
+		(s_bru2nii, s_biascorrect, [('nii_file', 'input_image')]),
+		]
+
+	if actual_size:
+		s_register, _, _, _ = DSURQEc_structural_registration(template, registration_mask, num_threads=num_threads, template_cache=template_cache, **REGISTRATION_PRESETS[registration_preset])
+		workflow_connections.extend([
+			(s_biascorrect, subject_template, [('output_image', 'in_files')]),
+			])
+	else:
+		s_register, _, _ = structural_registration(template, num_threads=num_threads, registration_preset=registration_preset, template_cache=template_cache)
+
+		s_cutoff = pe.MapNode(interface=fsl.ImageMaths(), name="s_cutoff", iterfield=['in_file'])
+		s_cutoff.inputs.op_string = "-thrP 20 -uthrp 98"
+
+		s_BET = pe.MapNode(interface=fsl.BET(), name="s_BET", iterfield=['in_file'])
+		s_BET.inputs.mask = True
+		s_BET.inputs.frac = 0.3
+		s_BET.inputs.robust = True
+
+		s_mask = pe.MapNode(interface=fsl.ApplyMask(), name="s_mask", iterfield=['in_file','mask_file'])
+
+		workflow_connections.extend([
+			(s_biascorrect, s_cutoff, [('output_image', 'in_file')]),
+			(s_cutoff, s_BET, [('out_file', 'in_file')]),
+			(s_biascorrect, s_mask, [('output_image', 'in_file')]),
+			(s_BET, s_mask, [('mask_file', 'mask_file')]),
+			(s_mask, subject_template, [('out_file', 'in_files')]),
+			])
+
+	datasink = pe.Node(nio.DataSink(), name='datasink')
+	datasink.inputs.base_directory = out_dir
+	datasink.inputs.parameterization = False
+
+	workflow_connections.extend([
+		(subjectsource, datasink, [(('subject',dictionary_value,containers), 'container')]),
+		(subject_template, s_register, [('out_file', 'moving_image')]),
+		(subject_template, datasink, [('out_file', '@template')]),
+		(s_register, datasink, [('composite_transform', '@transform')]),
+		])
+
+	workdir_name = workflow_name+"_subjects_work"
+	workflow = pe.Workflow(name=workdir_name)
+	workflow.connect(workflow_connections)
+	set_intermediate_format(workflow)
+	workflow.base_dir = path.join(measurements_base,"preprocessing")
+	workflow.config = {"execution": {"crashdump_dir": path.join(measurements_base,"preprocessing/crashdump")}}
+	run_workflow(workflow, plugin="MultiProc", plugin_args=multiproc_arguments(n_procs, memory_gb), keep_work=keep_work)
+
+	return templates
+
 def bruker(measurements_base,
 	functional_scan_types=[],
 	structural_scan_types=[],
@@ -41,31 +171,89 @@ def bruker(measurements_base,
 	exclude_subjects=[],
 	exclude_measurements=[],
 	actual_size=False,
+	brain_mask="",
+	compresslevel=6,
+	db_path="~/syncdata/meta.db",
 	functional_blur_xy=False,
 	functional_registration_method="structural",
 	highpass_sigma=225,
+	intermediate_format=INTERMEDIATE_FORMAT,
 	lowpass_sigma=None,
+	memory_gb=None,
 	negative_contrast_agent=False,
 	n_procs=N_PROCS,
+	native_bandpass=False,
+	native_conversion=False,
+	node_cache=NODE_CACHE,
+	profile=False,
 	realign="time",
 	registration_mask=False,
+	registration_preset="default",
 	template="/home/chymera/ni_data/templates/ds_QBI_chr.nii.gz",
+	template_cache=TEMPLATE_CACHE,
 	tr=1,
 	very_nasty_bruker_delay_hack=False,
 	workflow_name="generic",
 	keep_work=False,
 	autorotate=False,
 	strict=False,
+	subject_template=False,
 	verbose=False,
 	):
 	'''
 
+	autorotate: bool
+		Not currently supported, and only kept for backwards compatibility; must be False. The shared structural workflow (see `samri.pipelines.nodes.structural_workflow()`) does not rotate the structural scans before registration.
+
+	brain_mask: str
+		Path to a brain mask in the template voxel grid. If specified, the bandpass filter (which requires `native_bandpass=True`) only processes the in-brain voxels, and its output is additionally saved in the masked 2D representation (voxels by time, see `samri.pipelines.masked`) as ".npz" next to the NIfTI output, for downstream analyses restricted to the same voxels.
+
+	compresslevel: int
+		Gzip compression level of the final outputs. These are compressed once, by dedicated nodes before the datasink, using the fastest compressor available (see `samri.pipelines.utils.compress_image()`).
+
+	db_path: str
+		Path to the LabbookDB database from which to read the stimulation protocols. The protocols for all functional scan types are resolved once, when the workflow is constructed, and passed to the events file nodes.
+
+	intermediate_format: {"NIFTI","NIFTI_GZ"}
+		Format of the intermediate images written to the work directory. Uncompressed NIfTI spares every node the compression and decompression of its inputs and outputs, at the cost of disk space.
+
+	memory_gb: float
+		Memory available to the workflow, in GB. Nodes are scheduled according to their estimated CPU and memory requirements within this limit, and that of `n_procs`. If unspecified, nipype uses 90% of the system memory.
+
+	native_bandpass: bool
+		Whether to bandpass filter the functional data in-process (via `samri.pipelines.extra_interfaces.Bandpass`), filtering all voxels with data at once across `num_threads` threads, rather than via fslmaths. Both reproduce the `fslmaths -bptf` algorithm.
+
+	native_conversion: bool
+		Whether to convert the Bruker data in-process (via `samri.pipelines.extra_interfaces.BrukerToNifti`) rather than via the Bru2 command line tool. This also crops the dummy scans during conversion.
+
+	node_cache: str or bool
+		Path to a directory in which the results of the expensive nodes (registration, bias field correction, and bandpass filtering) are cached across runs, even if the work directory is not kept. If this evaluates to False, no caching is performed.
+
+	profile: bool
+		Whether to record the wall time, CPU time, peak memory usage, and thread count of every node run, and write them to "profile.csv" and "profile.json" next to the workflow outputs. These can be summarized via `samri.report.profiling.summarize_profiles()`.
+
 	realign: {"space","time","spacetime",""}
 		Parameter that dictates slictiming correction and realignment of slices. "time" (FSL.SliceTimer) is default, since it works safely. Use others only with caution!
 
+	registration_preset: {"default","fast"}
+		Selection of registration phases from `samri.pipelines.nodes.REGISTRATION_PRESETS`. "fast" estimates the linear transforms on downsampled images only and the SyN transform on the two finest pyramid levels, with realistic convergence criteria. The preset applies to both actual and inflated voxel sizes; for the latter, "default" keeps the parameters of `samri.pipelines.nodes.structural_registration()`. Use `samri.optimization.newreg.preset_tradeoff()` to compare the similarity and run time of the presets for a study.
+
+	subject_template: bool
+		Whether to create a template for each subject from its structural scans across all sessions, and register it to the study template only once (see `subject_templates()`). Each session's structural scan is then only registered rigidly to its subject template, and all transforms are composed, so that each scan is warped into the study template space with a single `ApplyTransforms` call. Requires `functional_registration_method` to be "structural" or "composite".
+
+	template_cache: str or bool
+		Directory in which the template (and mask) are prepared for registration once, and shared across workflows (see `samri.pipelines.nodes.prepare_template()`). If this evaluates to False, the original files are used by all registration nodes.
+
 	'''
 
 	measurements_base = path.abspath(path.expanduser(measurements_base))
+	intermediate_extension = INTERMEDIATE_EXTENSIONS[intermediate_format]
+
+	if autorotate:
+		raise ValueError('The `autorotate` option is not currently supported.')
+
+	#multithreaded nodes may not request more processors than are available to the workflow
+	num_threads = min(4, n_procs)
 
 	#select all functional/sturctural scan types unless specified
 	if not functional_scan_types or not structural_scan_types:
@@ -94,31 +282,82 @@ def bruker(measurements_base,
 
 	# we start to define nipype workflow elements (nodes, connections, meta)
 	subjects_sessions = data_selection[["subject","session"]].drop_duplicates().values.tolist()
+	data_lookup = scan_lookup(data_selection)
+
+	if subject_template:
+		if not structural_scan_types or functional_registration_method not in ("structural", "composite"):
+			raise ValueError('The option `subject_template=True` requires there to be a structural scan type, and `functional_registration_method` to be "structural" or "composite".')
+		templates = subject_templates(measurements_base, data_lookup, sorted(subjects), structural_scan_types[0],
+			actual_size=actual_size,
+			keep_work=keep_work,
+			memory_gb=memory_gb,
+			n_procs=n_procs,
+			native_conversion=native_conversion,
+			registration_mask=registration_mask,
+			registration_preset=registration_preset,
+			template=template,
+			template_cache=template_cache,
+			workflow_name=workflow_name,
+			)
+		get_s_template = pe.Node(name='get_s_template', interface=util.Function(function=get_subject_template,input_names=inspect.getargspec(get_subject_template)[0], output_names=['template','transform']))
+		get_s_template.inputs.subject_templates = templates
+
 	infosource = pe.Node(interface=util.IdentityInterface(fields=['subject_session']), name="infosource")
 	infosource.iterables = [('subject_session', subjects_sessions)]
 
 	get_f_scan = pe.Node(name='get_f_scan', interface=util.Function(function=get_scan,input_names=inspect.getargspec(get_scan)[0], output_names=['scan_path','scan_type']))
 	if not strict:
 		get_f_scan.inputs.ignore_exception = True
-	get_f_scan.inputs.data_selection = data_selection
 	get_f_scan.inputs.measurements_base = measurements_base
 	get_f_scan.iterables = ("scan_type", functional_scan_types)
 
-	f_bru2nii = pe.Node(interface=bru2nii.Bru2(), name="f_bru2nii")
+	if native_conversion:
+		#the in-process converter also crops the dummy scans, and thus takes the place of the `dummy_scans` node
+		f_bru2nii = pe.Node(interface=BrukerToNifti(), name="f_bru2nii")
+		f_bru2nii.inputs.desired_dummy_scans = DUMMY_SCANS
+		dummy_scans = f_bru2nii
+		dummy_scans_output = 'nii_file'
+	else:
+		f_bru2nii = pe.Node(interface=bru2nii.Bru2(), name="f_bru2nii")
+		dummy_scans = pe.Node(name='dummy_scans', interface=util.Function(function=force_dummy_scans,input_names=inspect.getargspec(force_dummy_scans)[0], output_names=['out_file']))
+		dummy_scans.inputs.desired_dummy_scans = DUMMY_SCANS
+		dummy_scans.inputs.out_file = "forced_dummy_scans_file"+intermediate_extension
+		dummy_scans_output = 'out_file'
 	f_bru2nii.inputs.actual_size=actual_size
 
-	dummy_scans = pe.Node(name='dummy_scans', interface=util.Function(function=force_dummy_scans,input_names=inspect.getargspec(force_dummy_scans)[0], output_names=['out_file']))
-	dummy_scans.inputs.desired_dummy_scans = DUMMY_SCANS
-
-	bandpass = pe.Node(interface=fsl.maths.TemporalFilter(), name="bandpass")
-	bandpass.inputs.highpass_sigma = highpass_sigma
-	if lowpass_sigma:
+	#the value inversion for negative contrast agents is performed by the bandpass node, saving a full pass over (and a copy of) the timecourse
+	if not lowpass_sigma:
+		lowpass_sigma = tr
+	if brain_mask and not native_bandpass:
+		raise ValueError('The `brain_mask` option requires `native_bandpass=True`.')
+	if native_bandpass:
+		bandpass = pe.Node(interface=Bandpass(), name="bandpass")
+		#the in-process filter holds both the input and the filtered timecourses in memory
+		set_resources(bandpass, num_threads, estimate_mem_gb(image_voxels(template)*DEFAULT_VOLUMES, 2*TIMESERIES_BYTES_PER_VOXEL))
+		bandpass.inputs.highpass_sigma = highpass_sigma
 		bandpass.inputs.lowpass_sigma = lowpass_sigma
+		bandpass.inputs.invert = negative_contrast_agent
+		if brain_mask:
+			bandpass.inputs.mask = path.abspath(path.expanduser(brain_mask))
 	else:
-		bandpass.inputs.lowpass_sigma = tr
+		bandpass = pe.Node(interface=fsl.ImageMaths(), name="bandpass")
+		set_resources(bandpass, 1, estimate_mem_gb(image_voxels(template)*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
+		bandpass.inputs.op_string = fslmaths_bandpass(highpass_sigma, lowpass_sigma, invert=negative_contrast_agent)
+
+	compress = pe.Node(name='compress', interface=util.Function(function=compress_image,input_names=inspect.getargspec(compress_image)[0], output_names=['out_file']))
+	compress.inputs.compresslevel = compresslevel
+	compress.inputs.num_threads = num_threads
+	set_resources(compress, num_threads)
 
 	bids_filename = pe.Node(name='bids_filename', interface=util.Function(function=sss_filename,input_names=inspect.getargspec(sss_filename)[0], output_names=['filename']))
 
+	if brain_mask:
+		#the bandpass node writes the masked representation, which is converted back to NIfTI only for the datasink
+		bids_masked_filename = pe.Node(name='bids_masked_filename', interface=util.Function(function=sss_filename,input_names=inspect.getargspec(sss_filename)[0], output_names=['filename']))
+		bids_masked_filename.inputs.extension = ".npz"
+		unmask = pe.Node(name='unmask', interface=util.Function(function=unmask_image,input_names=inspect.getargspec(unmask_image)[0], output_names=['out_file']))
+		set_resources(unmask, 1, estimate_mem_gb(image_voxels(template)*DEFAULT_VOLUMES, TIMESERIES_BYTES_PER_VOXEL))
+
 	bids_stim_filename = pe.Node(name='bids_stim_filename', interface=util.Function(function=sss_filename,input_names=inspect.getargspec(sss_filename)[0], output_names=['filename']))
 	bids_stim_filename.inputs.suffix = "events"
 	bids_stim_filename.inputs.extension = ".tsv"
@@ -127,6 +366,17 @@ def bruker(measurements_base,
 	events_file.inputs.dummy_scans_ms = DUMMY_SCANS * tr * 1000
 	events_file.inputs.stim_protocol_dictionary = STIM_PROTOCOL_DICTIONARY
 	events_file.inputs.very_nasty_bruker_delay_hack = very_nasty_bruker_delay_hack
+	events_file.inputs.db_path = db_path
+	trial_codes = [STIM_PROTOCOL_DICTIONARY[i] for i in functional_scan_types if i in STIM_PROTOCOL_DICTIONARY]
+	if trial_codes:
+		try:
+			from sqlalchemy.exc import SQLAlchemyError
+		except ImportError:
+			SQLAlchemyError = ImportError
+		try:
+			events_file.inputs.protocol_timings = stimulation_protocol_timings(trial_codes, db_path=db_path, cache_path=PROTOCOL_TIMINGS_CACHE)
+		except (ImportError, KeyError, OSError, ValueError, SQLAlchemyError) as e:
+			print("WARNING: The stimulation protocols could not be resolved ({}), the events file nodes will query the database individually.".format(e))
 	if not (strict or verbose):
 		events_file.inputs.ignore_exception = True
 
@@ -137,12 +387,10 @@ def bruker(measurements_base,
 		datasink.inputs.ignore_exception = True
 
 	workflow_connections = [
-		(infosource, get_f_scan, [('subject_session', 'selector')]),
+		(infosource, get_f_scan, [(('subject_session',session_scans,data_lookup), 'data_selection')]),
 		(infosource, bids_stim_filename, [('subject_session', 'subject_session')]),
 		(get_f_scan, bids_stim_filename, [('scan_type', 'scan')]),
 		(get_f_scan, f_bru2nii, [('scan_path', 'input_dir')]),
-		(f_bru2nii, dummy_scans, [('nii_file', 'in_file')]),
-		(get_f_scan, dummy_scans, [('scan_path', 'scan_dir')]),
 		(get_f_scan, events_file, [
 			('scan_type', 'scan_type'),
 			('scan_path', 'scan_dir')
@@ -152,15 +400,33 @@ def bruker(measurements_base,
 		(infosource, datasink, [(('subject_session',ss_to_path), 'container')]),
 		(infosource, bids_filename, [('subject_session', 'subject_session')]),
 		(get_f_scan, bids_filename, [('scan_type', 'scan')]),
-		(bids_filename, bandpass, [('filename', 'out_file')]),
-		(bandpass, datasink, [('out_file', 'func')]),
+		(bids_filename, compress, [('filename', 'out_file')]),
+		(compress, datasink, [('out_file', 'func')]),
 		]
+	if brain_mask:
+		workflow_connections.extend([
+			(infosource, bids_masked_filename, [('subject_session', 'subject_session')]),
+			(get_f_scan, bids_masked_filename, [('scan_type', 'scan')]),
+			(bids_masked_filename, bandpass, [('filename', 'out_file')]),
+			(bandpass, datasink, [('out_file', 'func.@masked')]),
+			(bandpass, unmask, [('out_file', 'in_file')]),
+			(unmask, compress, [('out_file', 'in_file')]),
+			])
+	else:
+		workflow_connections.extend([
+			(bandpass, compress, [('out_file', 'in_file')]),
+			])
+	if not native_conversion:
+		workflow_connections.extend([
+			(f_bru2nii, dummy_scans, [('nii_file', 'in_file')]),
+			(get_f_scan, dummy_scans, [('scan_path', 'scan_dir')]),
+			])
 
 	if realign == "space":
 		realigner = pe.Node(interface=spm.Realign(), name="realigner")
 		realigner.inputs.register_to_mean = True
 		workflow_connections.extend([
-			(dummy_scans, realigner, [('out_file', 'in_file')]),
+			(dummy_scans, realigner, [(dummy_scans_output, 'in_file')]),
 			])
 
 	elif realign == "spacetime":
@@ -169,113 +435,76 @@ def bruker(measurements_base,
 		realigner.inputs.tr = tr
 		realigner.inputs.slice_info = 3 #3 for coronal slices (2 for horizontal, 1 for sagittal)
 		workflow_connections.extend([
-			(dummy_scans, realigner, [('out_file', 'in_file')]),
+			(dummy_scans, realigner, [(dummy_scans_output, 'in_file')]),
 			])
 
 	elif realign == "time":
 		realigner = pe.Node(interface=fsl.SliceTimer(), name="slicetimer")
 		realigner.inputs.time_repetition = tr
 		workflow_connections.extend([
-			(dummy_scans, realigner, [('out_file', 'in_file')]),
+			(dummy_scans, realigner, [(dummy_scans_output, 'in_file')]),
 			])
 
 	#ADDING SELECTABLE NODES AND EXTENDING WORKFLOW AS APPROPRIATE:
 	if actual_size:
-		s_biascorrect, f_biascorrect = real_size_nodes()
+		_, f_biascorrect = real_size_nodes(num_threads=min(2, n_procs))
 	else:
-		s_biascorrect, f_biascorrect = inflated_size_nodes()
+		_, f_biascorrect = inflated_size_nodes(num_threads=min(2, n_procs))
 
 	if structural_scan_types:
 		get_s_scan = pe.Node(name='get_s_scan', interface=util.Function(function=get_scan, input_names=inspect.getargspec(get_scan)[0], output_names=['scan_path','scan_type']))
 		if not strict:
 			get_s_scan.inputs.ignore_exception = True
-		get_s_scan.inputs.data_selection = data_selection
 		get_s_scan.inputs.measurements_base = measurements_base
 		get_s_scan.iterables = ("scan_type", structural_scan_types)
 
-		s_bru2nii = pe.Node(interface=bru2nii.Bru2(), name="s_bru2nii")
-		s_bru2nii.inputs.force_conversion=True
-		s_bru2nii.inputs.actual_size=actual_size
+		structural = structural_workflow(template,
+			actual_size=actual_size,
+			native_conversion=native_conversion,
+			num_threads=num_threads,
+			registration_mask=registration_mask,
+			registration_preset=registration_preset,
+			subject_template=subject_template,
+			template_cache=template_cache,
+			)
 
 		s_bids_filename = pe.Node(name='s_bids_filename', interface=util.Function(function=sss_filename,input_names=inspect.getargspec(sss_filename)[0], output_names=['filename']))
 		s_bids_filename.inputs.scan_prefix = False
 
-		if actual_size:
-			s_register, s_warp, _, _ = DSURQEc_structural_registration(template, registration_mask)
-			#TODO: incl. in func registration
-			if autorotate:
-				workflow_connections.extend([
-					(s_biascorrect, s_rotated, [('output_image', 'out_file')]),
-					(s_rotated, s_register, [('out_file', 'moving_image')]),
-					])
-			else:
-				workflow_connections.extend([
-					(s_biascorrect, s_register, [('output_image', 'moving_image')]),
-					(s_register, s_warp, [('composite_transform', 'transforms')]),
-					(s_bru2nii, s_warp, [('nii_file', 'input_image')]),
-					(s_warp, datasink, [('output_image', 'anat')]),
-					])
-		else:
-			s_reg_biascorrect = pe.Node(interface=ants.N4BiasFieldCorrection(), name="s_reg_biascorrect")
-			s_reg_biascorrect.inputs.dimension = 3
-			s_reg_biascorrect.inputs.bspline_fitting_distance = 95
-			s_reg_biascorrect.inputs.shrink_factor = 2
-			s_reg_biascorrect.inputs.n_iterations = [500,500,500,500]
-			s_reg_biascorrect.inputs.convergence_threshold = 1e-14
-
-			s_cutoff = pe.Node(interface=fsl.ImageMaths(), name="s_cutoff")
-			s_cutoff.inputs.op_string = "-thrP 20 -uthrp 98"
-
-			s_BET = pe.Node(interface=fsl.BET(), name="s_BET")
-			s_BET.inputs.mask = True
-			s_BET.inputs.frac = 0.3
-			s_BET.inputs.robust = True
-
-			s_mask = pe.Node(interface=fsl.ApplyMask(), name="s_mask")
-			s_register, s_warp, f_warp = structural_registration(template)
-
-			workflow_connections.extend([
-				(s_bru2nii, s_reg_biascorrect, [('nii_file', 'input_image')]),
-				(s_reg_biascorrect, s_cutoff, [('output_image', 'in_file')]),
-				(s_cutoff, s_BET, [('out_file', 'in_file')]),
-				(s_biascorrect, s_mask, [('output_image', 'in_file')]),
-				(s_BET, s_mask, [('mask_file', 'mask_file')]),
-				])
-
-			#TODO: incl. in func registration
-			if autorotate:
-				workflow_connections.extend([
-					(s_mask, s_rotated, [('out_file', 'out_file')]),
-					(s_rotated, s_register, [('out_file', 'moving_image')]),
-					])
-			else:
-				workflow_connections.extend([
-					(s_mask, s_register, [('out_file', 'moving_image')]),
-					(s_register, s_warp, [('composite_transform', 'transforms')]),
-					(s_bru2nii, s_warp, [('nii_file', 'input_image')]),
-					(s_warp, datasink, [('output_image', 'anat')]),
-					])
-
-
-		if autorotate:
-			s_rotated = autorotate(template)
+		s_compress = pe.Node(name='s_compress', interface=util.Function(function=compress_image,input_names=inspect.getargspec(compress_image)[0], output_names=['out_file']))
+		s_compress.inputs.compresslevel = compresslevel
+		s_compress.inputs.num_threads = num_threads
+		set_resources(s_compress, num_threads)
 
 		workflow_connections.extend([
-			(infosource, get_s_scan, [('subject_session', 'selector')]),
+			(infosource, get_s_scan, [(('subject_session',session_scans,data_lookup), 'data_selection')]),
 			(infosource, s_bids_filename, [('subject_session', 'subject_session')]),
-			(get_s_scan, s_bru2nii, [('scan_path','input_dir')]),
+			(get_s_scan, structural, [('scan_path','inputnode.scan_path')]),
 			(get_s_scan, s_bids_filename, [('scan_type', 'scan')]),
-			(s_bids_filename, s_warp, [('filename','output_image')]),
-			(s_bru2nii, s_biascorrect, [('nii_file', 'input_image')]),
+			(s_bids_filename, s_compress, [('filename','out_file')]),
+			(structural, s_compress, [('outputnode.warped', 'in_file')]),
+			(s_compress, datasink, [('out_file', 'anat')]),
 			])
-
-
+		if subject_template:
+			workflow_connections.extend([
+				(infosource, get_s_template, [('subject_session', 'subject_session')]),
+				(get_s_template, structural, [
+					('template', 'inputnode.subject_template'),
+					('transform', 'inputnode.subject_transform'),
+					]),
+				])
 
 	if functional_registration_method == "structural":
 		if not structural_scan_types:
 			raise ValueError('The option `registration="structural"` requires there to be a structural scan type.')
+		if subject_template:
+			_, _, f_warp = session_registration(template, num_threads=num_threads, template_cache=template_cache)
+		elif actual_size:
+			_, _, _, f_warp = DSURQEc_structural_registration(template, registration_mask, num_threads=num_threads, template_cache=template_cache, **REGISTRATION_PRESETS[registration_preset])
+		else:
+			_, _, f_warp = structural_registration(template, num_threads=num_threads, registration_preset=registration_preset, template_cache=template_cache)
 		workflow_connections.extend([
-			(s_register, f_warp, [('composite_transform', 'transforms')]),
+			(structural, f_warp, [('outputnode.transforms', 'transforms')]),
 			])
 		if realign == "space":
 			workflow_connections.extend([
@@ -291,14 +520,16 @@ def bruker(measurements_base,
 				])
 		else:
 			workflow_connections.extend([
-				(dummy_scans, f_warp, [('out_file', 'input_image')]),
+				(dummy_scans, f_warp, [(dummy_scans_output, 'input_image')]),
 				])
 
 
 	if functional_registration_method == "composite":
 		if not structural_scan_types:
 			raise ValueError('The option `registration="composite"` requires there to be a structural scan type.')
-		_, _, f_register, f_warp = DSURQEc_structural_registration(template, registration_mask)
+		_, _, f_register, f_warp = DSURQEc_structural_registration(template, registration_mask, num_threads=num_threads, template_cache=template_cache, **REGISTRATION_PRESETS[registration_preset])
+		if subject_template:
+			_, _, f_warp = session_registration(template, num_threads=num_threads, template_cache=template_cache)
 
 		temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
 
@@ -307,9 +538,9 @@ def bruker(measurements_base,
 		workflow_connections.extend([
 			(temporal_mean, f_biascorrect, [('out_file', 'input_image')]),
 			(f_biascorrect, f_register, [('output_image', 'moving_image')]),
-			(s_biascorrect, f_register, [('output_image', 'fixed_image')]),
+			(structural, f_register, [('outputnode.biascorrected', 'fixed_image')]),
 			(f_register, merge, [('composite_transform', 'in1')]),
-			(s_register, merge, [('composite_transform', 'in2')]),
+			(structural, merge, [('outputnode.transforms', 'in2')]),
 			(merge, f_warp, [('out', 'transforms')]),
 			])
 		if realign == "space":
@@ -329,12 +560,12 @@ def bruker(measurements_base,
 				])
 		else:
 			workflow_connections.extend([
-				(dummy_scans, temporal_mean, [('out_file', 'in_file')]),
-				(dummy_scans, f_warp, [('out_file', 'input_image')]),
+				(dummy_scans, temporal_mean, [(dummy_scans_output, 'in_file')]),
+				(dummy_scans, f_warp, [(dummy_scans_output, 'input_image')]),
 				])
 
 	elif functional_registration_method == "functional":
-		f_register, f_warp = functional_registration(template)
+		f_register, f_warp = functional_registration(template, num_threads=num_threads, f_phases=REGISTRATION_PRESETS[registration_preset]["s_phases"], template_cache=template_cache)
 
 		temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
 
@@ -370,36 +601,18 @@ def bruker(measurements_base,
 				])
 		else:
 			workflow_connections.extend([
-				(dummy_scans, temporal_mean, [('out_file', 'in_file')]),
-				(dummy_scans, f_warp, [('out_file', 'input_image')]),
+				(dummy_scans, temporal_mean, [(dummy_scans_output, 'in_file')]),
+				(dummy_scans, f_warp, [(dummy_scans_output, 'input_image')]),
 				])
 
 
-	invert = pe.Node(interface=fsl.ImageMaths(), name="invert")
-	if functional_blur_xy and negative_contrast_agent:
-		blur = pe.Node(interface=afni.preprocess.BlurToFWHM(), name="blur")
-		blur.inputs.fwhmxy = functional_blur_xy
-		workflow_connections.extend([
-			(f_warp, blur, [('output_image', 'in_file')]),
-			(blur, invert, [(('out_file', fslmaths_invert_values), 'op_string')]),
-			(blur, invert, [('out_file', 'in_file')]),
-			(invert, bandpass, [('out_file', 'in_file')]),
-			])
-	elif functional_blur_xy:
+	if functional_blur_xy:
 		blur = pe.Node(interface=afni.preprocess.BlurToFWHM(), name="blur")
 		blur.inputs.fwhmxy = functional_blur_xy
 		workflow_connections.extend([
 			(f_warp, blur, [('output_image', 'in_file')]),
 			(blur, bandpass, [('out_file', 'in_file')]),
 			])
-	elif negative_contrast_agent:
-		blur = pe.Node(interface=afni.preprocess.BlurToFWHM(), name="blur")
-		blur.inputs.fwhmxy = functional_blur_xy
-		workflow_connections.extend([
-			(f_warp, invert, [(('output_image', fslmaths_invert_values), 'op_string')]),
-			(f_warp, invert, [('output_image', 'in_file')]),
-			(invert, bandpass, [('out_file', 'in_file')]),
-			])
 	else:
 		workflow_connections.extend([
 			(f_warp, bandpass, [('output_image', 'in_file')]),
@@ -408,11 +621,11 @@ def bruker(measurements_base,
 	workdir_name = workflow_name+"_work"
 	workflow = pe.Workflow(name=workdir_name)
 	workflow.connect(workflow_connections)
+	#intermediate outputs are written in the intermediate format, final outputs are compressed by dedicated nodes before the datasink
+	set_intermediate_format(workflow, intermediate_format)
 	workflow.base_dir = path.join(measurements_base,"preprocessing")
 	workflow.config = {"execution": {"crashdump_dir": path.join(measurements_base,"preprocessing/crashdump")}}
 	workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph.dot"), graph2use="hierarchical", format="png")
 
-	workflow.run(plugin="MultiProc",  plugin_args={'n_procs' : n_procs})
-	if not keep_work:
-		shutil.rmtree(path.join(workflow.base_dir,workdir_name))
+	run_workflow(workflow, plugin="MultiProc", plugin_args=multiproc_arguments(n_procs, memory_gb), keep_work=keep_work, cached_nodes=PREPROCESSING_CACHED_NODES, node_cache=node_cache, profile_dir=datasink.inputs.base_directory if profile else None)
 
@@ -0,0 +1,553 @@
+"""In-process general linear model estimation, as an alternative to the FEAT model generation and `fsl_glm` command line tools."""
+
+import os
+import numpy as np
+from joblib import Parallel, delayed
+
+DESIGN_CACHE = "~/.samri/designs"
+_designs = {}
+
+def basis_function(bases, resolution=0.05):
+	"""Return a single basis function, sampled at the given temporal resolution.
+
+	Parameters
+	----------
+
+	bases : dict
+	Basis function specification in the format of the `nipype.interfaces.fsl.model.Level1Design` "bases" input.
+	Supported are the "custom" basis (a text file with a single column, sampled at `resolution`) and the "gamma" basis (without derivatives).
+
+	resolution : float, optional
+	Temporal resolution at which to sample the basis function, in seconds.
+	For custom bases this needs to match the resolution at which the file was written, which for FEAT custom basis files is 0.05 seconds.
+	"""
+	if "custom" in bases:
+		basis = np.loadtxt(bases["custom"]["bfcustompath"], ndmin=2)[:,0]
+	elif "gamma" in bases:
+		from scipy.stats import gamma
+
+		if bases["gamma"].get("derivs"):
+			raise NotImplementedError("Gamma basis function derivatives are not supported.")
+		delay = bases["gamma"].get("gammadelay",6)
+		sigma = bases["gamma"].get("gammasigma",3)
+		times = np.arange(0, delay+sigma*8, resolution)
+		basis = gamma.pdf(times, (delay/sigma)**2, scale=sigma**2/delay)
+	else:
+		raise NotImplementedError("Only \"custom\" and \"gamma\" basis functions are supported, got: {}".format(", ".join(bases.keys())))
+	return np.asarray(basis, dtype=np.float64)
+
+def convolved_regressor(onsets, durations, amplitudes, basis, n_volumes, tr,
+	resolution=0.05,
+	):
+	"""Return a regressor sampled at the start of every volume, obtained by convolving the stimulation boxcar with the basis function at a high temporal resolution.
+
+	Parameters
+	----------
+
+	onsets : list
+	Event onsets, in seconds.
+
+	durations : list
+	Event durations, in seconds. Events with durations shorter than `resolution` are modelled as single impulses.
+
+	amplitudes : list
+	Event amplitudes.
+
+	basis : numpy.ndarray
+	Basis function, sampled at `resolution`.
+
+	n_volumes : int
+	Number of volumes of the timecourse.
+
+	tr : float
+	Repetition time, in seconds.
+
+	resolution : float, optional
+	Temporal resolution of the basis function and boxcar, in seconds.
+	"""
+	samples = int(np.ceil(n_volumes*tr/resolution))+1
+	onsets = np.asarray(onsets, dtype=np.float64)
+	starts = np.round(onsets/resolution).astype(int)
+	stops = np.maximum(starts+1, np.round((onsets+np.asarray(durations, dtype=np.float64))/resolution).astype(int))
+	#the boxcar is the cumulative sum of the amplitude steps at the event starts and stops
+	steps = np.zeros(samples+1)
+	np.add.at(steps, np.clip(starts, 0, samples), amplitudes)
+	np.add.at(steps, np.clip(stops, 0, samples), -np.asarray(amplitudes, dtype=np.float64))
+	boxcar = np.cumsum(steps[:samples])
+	convolved = np.convolve(boxcar, basis)[:samples]
+	return convolved[np.round(np.arange(n_volumes)*tr/resolution).astype(int)]
+
+def design_matrix(session_info, basis, n_volumes, tr,
+	orthogonalization={},
+	resolution=0.05,
+	):
+	"""Build a first-level design matrix following the FEAT model generation steps: convolution, demeaning, orthogonalization, and highpass filtering of the explanatory variables.
+
+	Parameters
+	----------
+
+	session_info : dict
+	Session information in the format of the `samri.pipelines.extra_interfaces.SpecifyModel` "session_info" output, i.e. with a "cond" list of dictionaries containing "name", "onset", "duration", and optionally "amplitudes" entries, and an optional "hpf" highpass cutoff in seconds.
+
+	basis : numpy.ndarray
+	Basis function, sampled at `resolution` (see `basis_function()`).
+
+	n_volumes : int
+	Number of volumes of the timecourse.
+
+	tr : float
+	Repetition time, in seconds.
+
+	orthogonalization : dict, optional
+	Orthogonalization specification in the format of the `nipype.interfaces.fsl.model.Level1Design` "orthogonalization" input, i.e. a dictionary of 1-based explanatory variable indices, each mapping to a dictionary of the indices with respect to which it is orthogonalized (value 1).
+
+	resolution : float, optional
+	Temporal resolution of the basis function, in seconds.
+
+	Returns
+	-------
+
+	names : list
+	Names of the explanatory variables.
+
+	design : numpy.ndarray
+	Design matrix of shape (time, explanatory variable).
+	"""
+	from samri.pipelines.filtering import bandpass_timecourses
+
+	names = []
+	columns = []
+	for condition in session_info["cond"]:
+		names.append(condition["name"])
+		onsets = condition["onset"]
+		durations = condition["duration"]
+		if len(durations) == 1:
+			durations = durations*len(onsets)
+		amplitudes = condition.get("amplitudes", [1]*len(onsets))
+		columns.append(convolved_regressor(onsets, durations, amplitudes, basis, n_volumes, tr, resolution=resolution))
+	design = np.column_stack(columns)
+	design -= design.mean(axis=0)
+	for ev in sorted(orthogonalization):
+		for other, orthogonalize in orthogonalization[ev].items():
+			if orthogonalize and other not in (0, ev) and 0 < ev <= design.shape[1] and other <= design.shape[1]:
+				reference = design[:,other-1]
+				if np.any(reference):
+					design[:,ev-1] -= reference * np.dot(reference, design[:,ev-1]) / np.dot(reference, reference)
+	if session_info.get("hpf", 0) > 0:
+		design = bandpass_timecourses(design, session_info["hpf"]/(2.*tr), -1)
+		design -= design.mean(axis=0)
+	return names, design
+
+def design_key(session_info, basis, n_volumes, tr,
+	orthogonalization={},
+	resolution=0.05,
+	):
+	"""Return a hash identifying a design matrix by all of its inputs (see `design_matrix()`)."""
+	import hashlib
+	import json
+
+	conditions = []
+	for condition in session_info["cond"]:
+		conditions.append([
+			condition["name"],
+			[float(i) for i in condition["onset"]],
+			[float(i) for i in condition["duration"]],
+			[float(i) for i in condition.get("amplitudes", [])],
+			])
+	orthogonalization = sorted([(int(ev), sorted([(int(other), int(flag)) for other, flag in others.items()])) for ev, others in orthogonalization.items()])
+	identifier = hashlib.sha1()
+	identifier.update(json.dumps([conditions, float(session_info.get("hpf", 0)), int(n_volumes), float(tr), orthogonalization, float(resolution)]).encode("utf-8"))
+	identifier.update(np.ascontiguousarray(basis, dtype=np.float64).tobytes())
+	return identifier.hexdigest()
+
+def cached_design_matrix(session_info, basis, n_volumes, tr,
+	design_cache=DESIGN_CACHE,
+	orthogonalization={},
+	resolution=0.05,
+	):
+	"""Return the design matrix for the given inputs (see `design_matrix()`), building it only if it has not been built before.
+
+	Designs are memoized within the process, and stored as ".npz" files in a cache directory, so that they are also reused across processes and reruns.
+
+	Parameters
+	----------
+
+	design_cache : str, optional
+	Directory in which to store the designs, as files named after their `design_key()`.
+	If this evaluates to False, designs are only memoized within the process.
+	"""
+	key = design_key(session_info, basis, n_volumes, tr, orthogonalization=orthogonalization, resolution=resolution)
+	if key in _designs:
+		names, design = _designs[key]
+		return list(names), design.copy()
+	design_file = ""
+	if design_cache:
+		design_cache = os.path.abspath(os.path.expanduser(design_cache))
+		design_file = os.path.join(design_cache, key+".npz")
+	if design_file and os.path.isfile(design_file):
+		with np.load(design_file) as archive:
+			names, design = [str(i) for i in archive["names"]], archive["design"]
+	else:
+		names, design = design_matrix(session_info, basis, n_volumes, tr, orthogonalization=orthogonalization, resolution=resolution)
+		if design_file:
+			try:
+				os.makedirs(design_cache)
+			except OSError:
+				if not os.path.isdir(design_cache):
+					raise
+			temporary_path = "{}.{}.tmp.npz".format(design_file[:-4], os.getpid())
+			np.savez(temporary_path, names=np.array(names), design=design)
+			os.rename(temporary_path, design_file)
+	_designs[key] = (names, design)
+	return list(names), design.copy()
+
+def save_fsl_design(design, contrasts, design_file, con_file,
+	contrast_names=[],
+	):
+	"""Write a design matrix and a contrast matrix as FSL VEST text files, as produced by FEAT model generation and read by `fsl_glm`."""
+	heights = np.ptp(design, axis=0)
+	with open(design_file, "w") as f:
+		f.write("/NumWaves\t{}\n/NumPoints\t{}\n".format(design.shape[1], design.shape[0]))
+		f.write("/PPheights\t\t{}\n\n/Matrix\n".format("\t".join("{:e}".format(i) for i in heights)))
+		np.savetxt(f, design, fmt="%e", delimiter="\t")
+	with open(con_file, "w") as f:
+		for ix, name in enumerate(contrast_names):
+			f.write("/ContrastName{}\t{}\n".format(ix+1, name))
+		f.write("/NumWaves\t{}\n/NumContrasts\t{}\n".format(contrasts.shape[1], contrasts.shape[0]))
+		f.write("/PPheights\t\t{}\n".format("\t".join("{:e}".format(i) for i in np.abs(np.dot(contrasts, heights)))))
+		f.write("/RequiredEffect\t\t{}\n\n/Matrix\n".format("\t".join(["0"]*contrasts.shape[0])))
+		np.savetxt(f, contrasts, fmt="%e", delimiter="\t")
+
+def image_volumes(in_file):
+	"""Return the number of volumes of a 4D NIfTI image or masked ".npz" archive, reading only its header."""
+	import nibabel as nib
+
+	if in_file.endswith(".npz"):
+		with np.load(in_file) as archive:
+			shape = nib.Nifti1Header(archive["header"].tobytes()).get_data_shape()
+	else:
+		shape = nib.load(in_file).shape
+	if len(shape) < 4:
+		return 1
+	return shape[3]
+
+def contrast_matrix(contrasts, names):
+	"""Return a (contrast, explanatory variable) array from contrasts in the format of the `nipype.interfaces.fsl.model.Level1Design` "contrasts" input.
+
+	Only T contrasts are supported.
+	"""
+	matrix = np.zeros((len(contrasts), len(names)))
+	for ix, contrast in enumerate(contrasts):
+		if contrast[1] != "T":
+			raise NotImplementedError("Only T contrasts are supported, got: {}".format(contrast[1]))
+		for name, weight in zip(contrast[2], contrast[3]):
+			matrix[ix, names.index(name)] = weight
+	return matrix
+
+def _ols(design, data):
+	"""Fit all columns of a (time, voxel) array at once, returning the parameter estimates, the residual variance, and the unscaled parameter covariance."""
+	pseudoinverse = np.linalg.pinv(design)
+	betas = np.dot(pseudoinverse, data)
+	residuals = data - np.dot(design, betas)
+	dof = design.shape[0] - np.linalg.matrix_rank(design)
+	sigma_squared = np.sum(residuals**2, axis=0) / dof
+	return betas, sigma_squared, np.dot(pseudoinverse, pseudoinverse.T), residuals
+
+def _prewhiten(array, rho):
+	"""Apply the Prais-Winsten AR(1) transform along the first axis of an array."""
+	whitened = np.empty_like(array)
+	whitened[0] = array[0] * np.sqrt(1 - rho**2)
+	whitened[1:] = array[1:] - rho * array[:-1]
+	return whitened
+
+def fit_glm(data, design, contrasts,
+	ar1=False,
+	chunk_voxels=4096,
+	n_jobs=1,
+	):
+	"""Fit a general linear model to all voxels at once and compute contrast statistics.
+
+	The ordinary least squares fit is a single solve over all voxels, which is also what `fsl_glm` computes.
+	If AR(1) prewhitening is requested, the autocorrelation coefficient of every voxel is estimated from the OLS residuals and rounded to two decimals, and the model is then refit for each group of voxels sharing a coefficient, with the groups split into chunks and distributed across threads.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+	Array of shape (time, voxel).
+
+	design : numpy.ndarray
+	Design matrix of shape (time, explanatory variable).
+
+	contrasts : numpy.ndarray
+	Contrast matrix of shape (contrast, explanatory variable).
+
+	ar1 : bool, optional
+	Whether to prewhiten the data and design with a voxelwise AR(1) model.
+
+	chunk_voxels : int, optional
+	Maximum number of voxels to refit at a time when prewhitening.
+
+	n_jobs : int, optional
+	Number of threads across which to distribute the prewhitened fits.
+
+	Returns
+	-------
+
+	dict
+	Dictionary of (contrast, voxel) arrays with the keys "cope", "varcb", "t", "z", "p", and "pf", as well as the (explanatory variable, voxel) parameter estimates under "betas".
+	"""
+	from scipy import stats
+
+	data = np.asarray(data, dtype=np.float64)
+	betas, sigma_squared, covariance, residuals = _ols(design, data)
+	dof = design.shape[0] - np.linalg.matrix_rank(design)
+	contrast_variance = np.einsum("ij,jk,ik->i", contrasts, covariance, contrasts)[:,np.newaxis]
+	varcb = contrast_variance * sigma_squared
+
+	if ar1:
+		rho = np.sum(residuals[1:]*residuals[:-1], axis=0) / np.maximum(np.sum(residuals**2, axis=0), np.finfo(np.float64).tiny)
+		rho = np.round(np.clip(rho, -.99, .99), 2)
+		del residuals
+		groups = []
+		for value in np.unique(rho):
+			voxels = np.flatnonzero(rho == value)
+			for start in range(0, len(voxels), chunk_voxels):
+				groups.append((value, voxels[start:start+chunk_voxels]))
+
+		def fit_group(group):
+			value, voxels = group
+			whitened_design = _prewhiten(design, value)
+			group_betas, group_sigma_squared, group_covariance, _ = _ols(whitened_design, _prewhiten(data[:,voxels], value))
+			group_variance = np.einsum("ij,jk,ik->i", contrasts, group_covariance, contrasts)[:,np.newaxis]
+			return voxels, group_betas, group_variance * group_sigma_squared
+
+		fits = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(fit_group),
+			groups,
+			))
+		for voxels, group_betas, group_varcb in fits:
+			betas[:,voxels] = group_betas
+			varcb[:,voxels] = group_varcb
+	else:
+		del residuals
+
+	cope = np.dot(contrasts, betas)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		t = np.where(varcb > 0, cope / np.sqrt(varcb), 0)
+	p = stats.t.sf(t, dof)
+	z = np.clip(stats.norm.isf(p), -8.2, 8.2)
+	pf = stats.f.sf(t**2, 1, dof)
+	return {"betas":betas, "cope":cope, "varcb":varcb, "t":t, "z":z, "p":p, "pf":pf}
+
+def _load_timecourses(in_file, mask):
+	"""Return the (voxel, time) in-mask timecourses of a 4D NIfTI image or masked ".npz" archive, together with the mask, affine, and header."""
+	import nibabel as nib
+	from samri.pipelines.masked import _load_mask, load_masked
+
+	if in_file.endswith(".npz"):
+		return load_masked(in_file)
+	img = nib.load(in_file)
+	data = np.asanyarray(img.dataobj).astype(np.float32, copy=False)
+	if mask:
+		mask = _load_mask(mask, img.shape)
+	else:
+		mask = np.any(data != 0, axis=3)
+	return data[mask], mask, img.affine, img.header
+
+def _save_statistics(statistics, mask, affine, header, out_files):
+	import nibabel as nib
+	from samri.pipelines.masked import save_masked
+
+	header = header.copy()
+	header.set_data_dtype(np.float32)
+	header.set_slope_inter(1, 0)
+	for key, out_file in out_files.items():
+		values = statistics[key].T
+		if values.shape[1] == 1:
+			values = values[:,0]
+		if out_file.endswith(".npz"):
+			save_masked(values, mask, affine, header, out_file)
+		else:
+			volume = np.zeros(mask.shape+values.shape[1:], dtype=np.float32)
+			volume[mask] = values
+			nib.save(nib.Nifti1Image(volume, affine, header), out_file)
+
+def first_level(in_files, session_infos, contrasts, bases,
+	ar1=False,
+	basis_resolution=0.05,
+	design_cache=DESIGN_CACHE,
+	mask="",
+	max_group_size=None,
+	n_jobs=1,
+	orthogonalization={},
+	out_files=[],
+	tr=1,
+	):
+	"""Fit first-level general linear models to functional images in-process, writing all statistic images in one pass.
+
+	Runs with identical design matrices (e.g. runs of the same stimulation protocol, with the same number of volumes) are fit jointly, by stacking their in-mask voxels into a single data array.
+	Runs are thus grouped into a handful of large matrix solves rather than fit one at a time, with only one group held in memory at a time.
+
+	Parameters
+	----------
+
+	in_files : list
+	Paths to the 4D NIfTI images or masked ".npz" archives (see `samri.pipelines.masked`) to model.
+
+	session_infos : list
+	Session information for each run, as output by `samri.pipelines.extra_interfaces.SpecifyModel` (see `design_matrix()`).
+
+	contrasts : list
+	T contrasts in the format of the `nipype.interfaces.fsl.model.Level1Design` "contrasts" input.
+
+	bases : dict
+	Basis function specification in the format of the `nipype.interfaces.fsl.model.Level1Design` "bases" input (see `basis_function()`).
+
+	ar1 : bool, optional
+	Whether to prewhiten with a voxelwise AR(1) model.
+
+	basis_resolution : float, optional
+	Temporal resolution of the basis function, in seconds.
+
+	design_cache : str, optional
+	Directory in which design matrices are cached across runs (see `cached_design_matrix()`).
+
+	mask : str, optional
+	Path to a 3D mask of the voxels to model, ignored for masked archives.
+	If unspecified, all voxels with a nonzero value at any timepoint are modelled.
+
+	max_group_size : int, optional
+	Maximum number of runs to fit jointly, bounding the memory used by a single solve.
+	Larger groups of runs sharing a design are split accordingly.
+
+	n_jobs : int, optional
+	Number of threads to use.
+
+	orthogonalization : dict, optional
+	Orthogonalization specification, in the format of the `nipype.interfaces.fsl.model.Level1Design` "orthogonalization" input.
+
+	out_files : list, optional
+	Dictionaries for each run, with any of the `fit_glm()` output keys as keys and output paths as values.
+	Statistics are written as float32 NIfTI images with one volume per contrast (3D for single contrasts), or as masked archives if the path ends in ".npz".
+
+	tr : float, optional
+	Repetition time, in seconds.
+
+	Returns
+	-------
+
+	list
+	Lists of the indices of the runs fit jointly.
+	"""
+	basis = basis_function(bases, resolution=basis_resolution)
+	groups = {}
+	for ix, (in_file, session_info) in enumerate(zip(in_files, session_infos)):
+		key = design_key(session_info, basis, image_volumes(in_file), tr, orthogonalization=orthogonalization, resolution=basis_resolution)
+		groups.setdefault(key, []).append(ix)
+	groups = list(groups.values())
+	if max_group_size:
+		groups = [group[start:start+max_group_size] for group in groups for start in range(0, len(group), max_group_size)]
+
+	for group in groups:
+		runs = [_load_timecourses(in_files[ix], mask) for ix in group]
+		names, design = cached_design_matrix(session_infos[group[0]], basis, runs[0][0].shape[1], tr,
+			design_cache=design_cache,
+			orthogonalization=orthogonalization,
+			resolution=basis_resolution,
+			)
+		statistics = fit_glm(np.concatenate([run[0] for run in runs]).T, design, contrast_matrix(contrasts, names),
+			ar1=ar1,
+			n_jobs=n_jobs,
+			)
+		start = 0
+		for ix, (timecourses, run_mask, affine, header) in zip(group, runs):
+			stop = start + timecourses.shape[0]
+			run_statistics = {key:values[:,start:stop] for key, values in statistics.items()}
+			_save_statistics(run_statistics, run_mask, affine, header, out_files[ix])
+			start = stop
+	return groups
+
+def second_level(copes,
+	mask="",
+	mode="ols",
+	out_files={},
+	varcbs=[],
+	):
+	"""Fit a second-level one-sample model to first-level COPEs in-process, as an alternative to merging them and running FLAMEO with a single-group design.
+
+	Only the in-mask voxels of each COPE (and COPE variance) image are read, and stacked into a single (image, voxel) array.
+
+	Parameters
+	----------
+
+	copes : list
+	Paths to the first-level COPE images.
+
+	mask : str, optional
+	Path to a 3D mask of the voxels to model, in the voxel grid of the COPEs.
+	If unspecified, all voxels are modelled.
+
+	mode : {"ols", "fe"}, optional
+	Whether to fit an ordinary least squares model (as the FLAMEO "ols" run mode), or a fixed effects model, weighting each COPE by its inverse variance (as the FLAMEO "fe" run mode, but with the z statistic computed from the normal distribution).
+
+	out_files : dict, optional
+	Dictionary with any of "cope", "varcope", "tstat", "zstat", and "tdof_t" as keys and output paths as values.
+
+	varcbs : list, optional
+	Paths to the first-level COPE variance images, in the order of `copes`. These are required for the "fe" mode.
+
+	Returns
+	-------
+
+	dict
+	Dictionary of (1, voxel) arrays with the keys "cope", "varcope", "tstat", "zstat", and "tdof_t".
+	"""
+	import nibabel as nib
+	from samri.pipelines.masked import _load_mask
+
+	reference = nib.load(copes[0])
+	if mask:
+		mask = _load_mask(mask, reference.shape)
+	else:
+		mask = np.ones(reference.shape[:3], dtype=bool)
+
+	def stack(in_files):
+		values = np.empty((len(in_files), mask.sum()))
+		for ix, in_file in enumerate(in_files):
+			data = np.asanyarray(nib.load(in_file).dataobj)
+			if data.ndim > 3:
+				data = data[...,0]
+			values[ix] = data[mask]
+		return values
+
+	if mode == "ols":
+		statistics = fit_glm(stack(copes), np.ones((len(copes),1)), np.ones((1,1)))
+		statistics = {
+			"cope":statistics["cope"],
+			"varcope":statistics["varcb"],
+			"tstat":statistics["t"],
+			"zstat":statistics["z"],
+			"tdof_t":np.full_like(statistics["cope"], len(copes)-1),
+			}
+	elif mode == "fe":
+		if len(varcbs) != len(copes):
+			raise ValueError("The \"fe\" mode requires a COPE variance image for every COPE.")
+		variances = stack(varcbs)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			weights = np.where(variances > 0, 1/variances, 0)
+			weight_sums = weights.sum(axis=0, keepdims=True)
+			cope = np.where(weight_sums > 0, (weights*stack(copes)).sum(axis=0, keepdims=True)/weight_sums, 0)
+			varcope = np.where(weight_sums > 0, 1/weight_sums, 0)
+			z = np.where(varcope > 0, cope/np.sqrt(varcope), 0)
+		statistics = {
+			"cope":cope,
+			"varcope":varcope,
+			"tstat":z,
+			"zstat":np.clip(z, -8.2, 8.2),
+			"tdof_t":np.full_like(cope, len(copes)-1),
+			}
+	else:
+		raise ValueError("Unsupported mode \"{}\", choose one of \"ols\" or \"fe\".".format(mode))
+
+	_save_statistics(statistics, mask, reference.affine, reference.header, out_files)
+	return statistics
@@ -17,11 +17,136 @@ STIM_PROTOCOL_DICTIONARY={
 	"EPI_CBV_jp_phasic":"jp_phasic",
 	}
 
+INTERMEDIATE_FORMAT="NIFTI"
+INTERMEDIATE_EXTENSIONS={
+	"NIFTI":".nii",
+	"NIFTI_GZ":".nii.gz",
+	}
+
+def set_intermediate_format(workflow,
+	output_type=INTERMEDIATE_FORMAT,
+	exclude=[],
+	):
+	"""Set the output type of all AFNI and FSL nodes of a workflow (including those of its sub-workflows), i.e. the format in which intermediate images are written to the work directory.
+
+	Only the nodes of the given workflow are modified, and not the class-wide interface defaults, so that other workflows are unaffected.
+	Uncompressed NIfTI ("NIFTI") avoids compressing and decompressing every intermediate image, at the cost of disk space.
+	Final outputs should be compressed explicitly before being passed to the datasink (see `compress_image()`).
+
+	Parameters
+	----------
+
+	workflow : nipype.pipeline.engine.Workflow
+	Workflow whose nodes to modify.
+
+	output_type : {"NIFTI", "NIFTI_GZ"}, optional
+	Intermediate image format.
+
+	exclude : list, optional
+	Names of nodes which write final outputs in a fixed format, and should thus not be modified.
+
+	Returns
+	-------
+
+	str
+	The file extension corresponding to the intermediate image format.
+	"""
+	from nipype.interfaces import afni, fsl
+
+	for node_name in workflow.list_node_names():
+		if node_name.split(".")[-1] in exclude:
+			continue
+		interface = workflow.get_node(node_name).interface
+		if isinstance(interface, fsl.FSLCommand):
+			interface.inputs.output_type = output_type
+		elif isinstance(interface, afni.base.AFNICommand):
+			interface.inputs.outputtype = output_type
+	return INTERMEDIATE_EXTENSIONS[output_type]
+
+def compress_image(in_file,
+	out_file="",
+	compresslevel=6,
+	num_threads=1,
+	):
+	"""Gzip-compress an image, using the fastest compressor available.
+
+	Multithreaded `pigz` is preferred, followed by `igzip` (which only supports compression levels up to 3), and the Python `gzip` module as a fallback.
+	The output is a regular gzip stream, readable by all NIfTI readers.
+
+	Parameters
+	----------
+
+	in_file : str
+	Path to the image to compress. If this is already compressed, it is copied.
+
+	out_file : str, optional
+	Path of the compressed image. Defaults to the base name of `in_file` with ".gz" appended, in the current directory.
+
+	compresslevel : int, optional
+	Gzip compression level.
+
+	num_threads : int, optional
+	Number of threads to use, if the compressor supports multithreading.
+	"""
+	import gzip
+	import shutil
+	import subprocess
+	from os import path
+
+	if not out_file:
+		out_file = path.basename(in_file)
+		if not out_file.endswith(".gz"):
+			out_file += ".gz"
+	out_file = path.abspath(out_file)
+
+	if in_file.endswith(".gz"):
+		if path.abspath(in_file) != out_file:
+			shutil.copyfile(in_file, out_file)
+		return out_file
+
+	pigz = shutil.which("pigz")
+	igzip = shutil.which("igzip")
+	if pigz:
+		command = [pigz, "-c", "-{}".format(compresslevel), "-p", str(num_threads), in_file]
+	elif igzip:
+		command = [igzip, "-c", "-{}".format(min(compresslevel, 3)), in_file]
+	else:
+		command = None
+
+	if command:
+		with open(out_file, "wb") as f:
+			subprocess.check_call(command, stdout=f)
+	else:
+		with open(in_file, "rb") as f_in, gzip.open(out_file, "wb", compresslevel=compresslevel) as f_out:
+			shutil.copyfileobj(f_in, f_out, 16*1024*1024)
+	return out_file
+
 def fslmaths_invert_values(img_path):
 	"""Calculates the op_string required to make an fsl.ImageMaths() node invert an image"""
 	op_string = "-sub {0} -sub {0}".format(img_path)
 	return op_string
 
+def fslmaths_bandpass(highpass_sigma, lowpass_sigma, invert=False):
+	"""Calculates the op_string required to make an fsl.ImageMaths() node temporally bandpass filter (and optionally invert) an image in a single pass.
+
+	Parameters
+	----------
+
+	highpass_sigma : float
+	Highpass filter sigma, in volumes (negative values disable the filter).
+
+	lowpass_sigma : float
+	Lowpass filter sigma, in volumes (negative values disable the filter).
+
+	invert : bool, optional
+	Whether to invert the filtered image values (e.g. for negative contrast agent measurements).
+	As both operations are linear, this is equivalent to inverting before filtering, but avoids writing an additional intermediate image.
+	"""
+	op_string = "-bptf {:.6f} {:.6f}".format(highpass_sigma, lowpass_sigma)
+	if invert:
+		op_string += " -mul -1"
+	return op_string
+
 def iterfield_selector(iterfields, selector, action):
 	"""Include or exclude entries from iterfields based on a selector dictionary
 
@@ -94,6 +219,14 @@ def ss_to_path(subject_session):
 	session = "ses-" + subject_session[1]
 	return "/".join([subject,session])
 
+def s_to_path(subject):
+	"""Convert a subject identifier to a BIDS-style path"""
+	return "sub-" + subject
+
+def dictionary_value(key, dictionary):
+	"""Return the value of a key in a dictionary (for use as a connection function)"""
+	return dictionary[key]
+
 def sss_to_source(source_format, subject=False, session=False, scan=False, subject_session_scan=False, base_directory=False, groupby=False):
 	from os import path
 
@@ -137,3 +270,72 @@ def sss_filename(subject_session, scan, scan_prefix="trial", suffix="", extensio
 		scan = "".join([scan,suffix,extension])
 	subject_session.append(scan)
 	return "_".join(subject_session)
+
+def write_volumes(volumes, header, out_file,
+	chunk_volumes=50,
+	compresslevel=1,
+	first_volume=0,
+	scaled=False,
+	):
+	"""Write a (3D or 4D) array-like to a NIfTI file, a chunk of volumes at a time, so that the full series never has to be held in memory.
+
+	Parameters
+	----------
+
+	volumes : array-like
+	Array, memory map, or `nibabel` array proxy to write.
+	Unless `scaled` is True, the values are written as they are, with the scaling recorded in the header applied by readers.
+
+	header : nibabel.Nifti1Header
+	Header to write the data with. This is copied, and the data shape is updated to that of `volumes`.
+
+	out_file : str
+	Path to write to, compressed if this ends in ".gz".
+
+	chunk_volumes : int, optional
+	Number of volumes to write at a time.
+
+	compresslevel : int, optional
+	Gzip compression level, if `out_file` is compressed.
+
+	first_volume : int, optional
+	Index of the first volume of (4D) `volumes` to write; preceding volumes are skipped without being read.
+	This allows cropping `nibabel` array proxies, which read the data as soon as they are sliced.
+
+	scaled : bool, optional
+	Whether the header scaling has already been applied to the values of `volumes` (as is the case when slicing `nibabel` array proxies).
+	If so, the scaling is reversed on writing, so that the data is stored with the header data type.
+	"""
+	import numpy as np
+	from nibabel.openers import ImageOpener
+	from nibabel.volumeutils import array_to_file
+
+	shape = volumes.shape
+	if len(shape) == 4:
+		shape = shape[:3] + (shape[3] - first_volume,)
+	header = header.copy()
+	header.set_data_shape(shape)
+	out_dtype = header.get_data_dtype()
+
+	intercept, divslope = 0., 1.
+	if scaled:
+		slope, inter = header.get_slope_inter()
+		if slope is not None:
+			divslope = slope
+		if inter is not None:
+			intercept = inter
+
+	opener_kwargs = {}
+	if out_file.endswith(".gz"):
+		opener_kwargs["compresslevel"] = compresslevel
+	with ImageOpener(out_file, "wb", **opener_kwargs) as fileobj:
+		header.write_to(fileobj)
+		offset = header.get_data_offset()
+		if len(volumes.shape) < 4:
+			array_to_file(np.asanyarray(volumes[...]), fileobj, out_dtype, offset=offset, intercept=intercept, divslope=divslope, order="F")
+		else:
+			for start in range(first_volume, volumes.shape[3], chunk_volumes):
+				chunk = np.asanyarray(volumes[:,:,:,start:start+chunk_volumes])
+				array_to_file(chunk, fileobj, out_dtype, offset=offset, intercept=intercept, divslope=divslope, order="F")
+				offset = None
+	return out_file
@@ -1 +1 @@
-__all__ = ["aggregate","roi"]
+__all__ = ["aggregate","profiling","roi"]
@@ -0,0 +1,91 @@
+from os import path, walk
+
+import pandas as pd
+
+def load_profiles(profiles):
+	"""Load and concatenate per-node workflow profiles, as written by `samri.pipelines.execution.NodeProfiler`.
+
+	Parameters
+	----------
+
+	profiles : str or list of str
+	Paths to "profile.csv" files, or to directories which are searched recursively for these files.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+	One row per node run, with an additional "profile" column containing the path of the file the row was read from.
+	"""
+	if not isinstance(profiles, (list, tuple)):
+		profiles = [profiles]
+	profile_files = []
+	for profile in profiles:
+		profile = path.abspath(path.expanduser(profile))
+		if path.isdir(profile):
+			for root, _, files in walk(profile):
+				if "profile.csv" in files:
+					profile_files.append(path.join(root, "profile.csv"))
+		else:
+			profile_files.append(profile)
+
+	dfs = []
+	for profile_file in sorted(profile_files):
+		df = pd.read_csv(profile_file)
+		df["profile"] = profile_file
+		dfs.append(df)
+	if not dfs:
+		raise ValueError("No profiles were found in: {}".format(", ".join(profiles)))
+	return pd.concat(dfs, ignore_index=True)
+
+def summarize_profiles(profiles,
+	groupby="node",
+	sort="wall_time_total",
+	save_as="",
+	):
+	"""Rank workflow nodes by their resource usage, aggregated across subjects, sessions, scans (i.e. iterables), and workflow runs.
+
+	Parameters
+	----------
+
+	profiles : str or list of str or pandas.DataFrame
+	Paths to "profile.csv" files or to directories containing them (see `load_profiles()`), or an already loaded profile dataframe.
+
+	groupby : str or list of str, optional
+	Profile column(s) by which to aggregate the node runs.
+
+	sort : str, optional
+	Summary column by which to rank the groups, in descending order.
+
+	save_as : str, optional
+	Path to which to save the summary as CSV.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+	With one row per group, and the number of runs, the total, mean, and maximal wall time, the total CPU time, the share of the total wall time, and the maximal peak RSS and thread count as columns.
+	"""
+	if isinstance(profiles, pd.DataFrame):
+		df = profiles
+	else:
+		df = load_profiles(profiles)
+
+	grouped = df.groupby(groupby)
+	summary = pd.DataFrame({
+		"runs":grouped["wall_time"].size(),
+		"failed":grouped["status"].apply(lambda x: (x != "end").sum()),
+		"wall_time_total":grouped["wall_time"].sum(),
+		"wall_time_mean":grouped["wall_time"].mean(),
+		"wall_time_max":grouped["wall_time"].max(),
+		"cpu_time_total":grouped["cpu_time"].sum(),
+		"peak_rss_gb_max":grouped["peak_rss_gb"].max(),
+		"threads_max":grouped["threads"].max(),
+		})
+	summary["wall_time_share"] = summary["wall_time_total"]/summary["wall_time_total"].sum()
+	summary = summary.sort_values(sort, ascending=False)
+
+	if save_as:
+		summary.to_csv(path.abspath(path.expanduser(save_as)))
+
+	return summary
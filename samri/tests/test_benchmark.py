@@ -0,0 +1,22 @@
+from os import path
+
+import nibabel as nib
+
+from samri.optimization.benchmark import synthetic_bruker_scan, time_stage
+from samri.pipelines.bruker import bruker_to_nifti
+
+def test_synthetic_conversion(tmpdir):
+	scan_dir = synthetic_bruker_scan(path.join(str(tmpdir),"5"), matrix=(16,16,4), volumes=30, dummy_scans=2)
+	out_file = bruker_to_nifti(scan_dir, path.join(str(tmpdir),"functional.nii"), desired_dummy_scans=10)
+	img = nib.load(out_file)
+	assert img.shape == (16,16,4,22)
+	assert img.header.get_zooms()[3] == 1
+
+def crashing_stage(context):
+	import os
+	os._exit(3)
+
+def test_time_stage_crash():
+	result = time_stage(crashing_stage, {"work_dir":""})
+	assert result["status"] == "failed: the stage process exited with code 3"
+	assert result["context"] == {"work_dir":""}
@@ -0,0 +1,30 @@
+from os import path
+
+from samri.pipelines.bruker import read_parameters
+
+METHOD = """##TITLE=Parameter List, ParaVision 6.0.1
+##$$ @vis= PVM_DummyScans
+##$PVM_DummyScans=10
+##$PVM_DummyScansDur=10000
+##$PVM_SPackArrNSlices=( 1 )
+20
+##$PVM_ObjOrderList=( 6 )
+@3*(0) 2 4 1
+##$PVM_ScanTimeStr=( 64 )
+<0h25m0s0ms>
+##END=
+"""
+
+def test_read_parameters(tmpdir):
+	method_file = path.join(str(tmpdir),"method")
+	with open(method_file, "w") as f:
+		f.write(METHOD)
+
+	parameters = read_parameters(method_file)
+	assert parameters["PVM_DummyScans"] == 10
+	assert parameters["PVM_SPackArrNSlices"] == [20]
+	assert parameters["PVM_ObjOrderList"] == [0, 0, 0, 2, 4, 1]
+	assert parameters["PVM_ScanTimeStr"] == "0h25m0s0ms"
+
+	parameters = read_parameters(method_file, ["PVM_DummyScansDur", "NotAParameter"])
+	assert parameters == {"PVM_DummyScansDur": 10000}
@@ -0,0 +1,23 @@
+from os import makedirs, path
+
+from samri.pipelines.catalog import catalog_measurements
+
+def write_measurement(measurement_dir, subject, session):
+	makedirs(measurement_dir)
+	with open(path.join(measurement_dir,"subject"), "w") as subject_file:
+		subject_file.write("##$SUBJECT_name_string=( 64 )\n<{}>\n##$SUBJECT_study_name=( 64 )\n<{}>\n##END=\n".format(subject, session))
+	with open(path.join(measurement_dir,"ScanProgram.scanProgram"), "w") as scan_program_file:
+		scan_program_file.write("<displayName>T2_TurboRARE (E3)</displayName>\n<displayName>EPI_CBV_jb_long (E5)</displayName>\n")
+
+def test_catalog(tmpdir):
+	measurement_dir = path.join(str(tmpdir),"20170101_120000_4001_1_1")
+	catalog_path = path.join(str(tmpdir),"catalog.sqlite")
+	write_measurement(measurement_dir, "4001", "ofM")
+
+	records = catalog_measurements([measurement_dir], catalog_path=catalog_path)
+	assert records[measurement_dir]["subject"] == "4001"
+	assert records[measurement_dir]["session"] == "ofM"
+	assert records[measurement_dir]["scans"] == [("T2_TurboRARE","3","program"),("EPI_CBV_jb_long","5","program")]
+
+	cached_records = catalog_measurements([measurement_dir], catalog_path=catalog_path)
+	assert cached_records == records
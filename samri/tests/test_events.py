@@ -0,0 +1,23 @@
+from os import path
+
+from samri.pipelines.extra_interfaces import gen_info, load_events
+
+def write_events(tmpdir):
+	events_file = path.join(str(tmpdir),"events.tsv")
+	with open(events_file, "w") as f:
+		f.write("onset\tduration\tstimulation_frequency\n172.6\t20\t20\n272.6\t20\t20\n372.6\t20\t20\n")
+	return events_file
+
+def test_load_events(tmpdir):
+	events_file = write_events(tmpdir)
+	events = load_events([events_file, events_file], habituation_regressor=True)
+	assert list(events.columns) == ["run", "condition", "onset", "duration", "amplitude"]
+	assert events["run"].tolist() == [0]*6 + [1]*6
+	habituation = events[(events["run"] == 1) & (events["condition"] == "e1")]
+	assert habituation["amplitude"].tolist() == [3, 2, 1]
+	assert habituation["onset"].tolist() == [173, 273, 373]
+
+	info = gen_info([events_file], False, False)
+	assert info[0].conditions == ["e0", "e1", "e2"]
+	assert info[0].onsets == [[173], [273], [373]]
+	assert info[0].amplitudes == [[20], [20], [20]]
@@ -0,0 +1,39 @@
+from os import makedirs, path
+
+from samri.pipelines.execution import restore_cached_nodes, store_cached_nodes
+
+def write_node(node_dir, node_hash):
+	makedirs(node_dir)
+	open(path.join(node_dir,"_0x{}.json".format(node_hash)), "w").close()
+	open(path.join(node_dir,"result_bandpass.pklz"), "w").close()
+	with open(path.join(node_dir,"bandpassed.nii"), "w") as out_file:
+		out_file.write("data")
+
+def test_node_cache(tmpdir):
+	work_dir = path.join(str(tmpdir),"generic_work")
+	node_cache = path.join(str(tmpdir),"node_cache")
+	node_dir = path.join(work_dir,"_subject_session_4001.ofM","bandpass")
+	write_node(node_dir, "abc123")
+
+	stored = store_cached_nodes(work_dir, node_names=["bandpass"], node_cache=node_cache, move=True)
+	assert stored == ["abc123"]
+	assert not path.exists(node_dir)
+
+	restored = restore_cached_nodes(work_dir, node_cache=node_cache)
+	assert restored == [node_dir]
+	with open(path.join(node_dir,"bandpassed.nii")) as restored_file:
+		assert restored_file.read() == "data"
+
+	store_cached_nodes(work_dir, node_names=["bandpass"], node_cache=node_cache, node_cache_size_gb=0)
+	assert restore_cached_nodes(path.join(str(tmpdir),"other_work"), node_cache=node_cache) == []
+	assert not path.exists(path.join(node_cache,"abc123"))
+
+def test_shared_node_cache(tmpdir):
+	work_dir = path.join(str(tmpdir),"generic_work")
+	node_cache = path.join(str(tmpdir),"node_cache")
+	write_node(path.join(work_dir,"structural","_subject_session_4001.ofM","s_register"), "def456")
+	store_cached_nodes(work_dir, node_names=["s_register"], node_cache=node_cache)
+
+	other_work_dir = path.join(str(tmpdir),"composite_work")
+	restored = restore_cached_nodes(other_work_dir, node_cache=node_cache)
+	assert restored == [path.join(other_work_dir,"structural","_subject_session_4001.ofM","s_register")]
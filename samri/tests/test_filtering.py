@@ -0,0 +1,49 @@
+import numpy as np
+
+from samri.pipelines.filtering import bandpass_timecourses
+
+def _fsl_bptf(timecourse, highpass_sigma, lowpass_sigma):
+	#direct transcription of the per-voxel loops of `fslmaths -bptf`
+	timepoints = len(timecourse)
+	array = np.array(timecourse, dtype=np.float64)
+	if highpass_sigma > 0:
+		half_width = int(highpass_sigma*3)
+		filtered = np.empty(timepoints)
+		for t in range(timepoints):
+			a = b = c = d = n = 0
+			for tt in range(max(t-half_width,0), min(t+half_width,timepoints-1)+1):
+				dt = tt-t
+				w = np.exp(-0.5*dt*dt/highpass_sigma**2)
+				a += w*dt
+				b += w*array[tt]
+				c += w*dt*dt
+				d += w*dt*array[tt]
+				n += w
+			denominator = c*n-a*a
+			if denominator != 0:
+				filtered[t] = array[t] - (b*c-a*d)/denominator
+			else:
+				filtered[t] = array[t]
+		array = filtered
+	if lowpass_sigma > 0:
+		half_width = int(lowpass_sigma*20)+2
+		filtered = np.empty(timepoints)
+		for t in range(timepoints):
+			total = weights = 0
+			for tt in range(max(t-half_width,0), min(t+half_width,timepoints-1)+1):
+				w = np.exp(-0.5*(tt-t)**2/lowpass_sigma**2)
+				total += w*array[tt]
+				weights += w
+			filtered[t] = total/weights
+		array = filtered
+	return array
+
+def test_bandpass_reproduces_fsl():
+	random = np.random.RandomState(0)
+	timepoints = 120
+	data = random.normal(size=(timepoints,5)) + np.linspace(0, 10, timepoints)[:,np.newaxis] + 100
+	original = data.copy()
+	filtered = bandpass_timecourses(data, 25, 1.5, chunk_voxels=2, n_jobs=2)
+	assert np.array_equal(data, original)
+	for voxel in range(data.shape[1]):
+		assert np.allclose(filtered[:,voxel], _fsl_bptf(data[:,voxel], 25, 1.5), atol=1e-6)
@@ -0,0 +1,28 @@
+from os import path
+
+import nibabel as nib
+import numpy as np
+
+from samri.pipelines.masked import load_masked, mask_image, unmask_image
+
+def test_masked_roundtrip(tmpdir):
+	data = np.random.RandomState(0).normal(size=(6,5,4,10)).astype(np.float32)
+	mask = np.zeros((6,5,4), dtype=np.uint8)
+	mask[1:4,1:4,1:3] = 1
+	affine = np.diag([.2,.2,.2,1])
+	in_file = path.join(str(tmpdir),"functional.nii")
+	mask_file = path.join(str(tmpdir),"mask.nii")
+	nib.save(nib.Nifti1Image(data, affine), in_file)
+	nib.save(nib.Nifti1Image(mask, affine), mask_file)
+
+	masked_file = mask_image(in_file, mask_file, out_file=path.join(str(tmpdir),"functional.npz"))
+	masked_data, masked_mask, masked_affine, _ = load_masked(masked_file)
+	assert masked_data.shape == (mask.sum(),10)
+	assert np.allclose(masked_affine, affine)
+
+	out_file = unmask_image(masked_file, out_file=path.join(str(tmpdir),"unmasked.nii"))
+	img = nib.load(out_file)
+	assert img.shape == data.shape
+	unmasked = np.asanyarray(img.dataobj)
+	assert np.allclose(unmasked[mask.astype(bool)], data[mask.astype(bool)])
+	assert not unmasked[~mask.astype(bool)].any()
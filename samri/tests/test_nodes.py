@@ -0,0 +1,17 @@
+import nibabel as nib
+import numpy as np
+
+from samri.pipelines.nodes import biascorrect_node, estimate_mem_gb, structural_registration, DEFAULT_VOXELS, N4_BYTES_PER_VOXEL
+
+def test_set_resources(tmpdir):
+	biascorrect = biascorrect_node("s_biascorrect", "real_size", num_threads=2)
+	assert biascorrect.n_procs == 2
+	assert biascorrect.mem_gb == estimate_mem_gb(DEFAULT_VOXELS, N4_BYTES_PER_VOXEL)
+
+	template = str(tmpdir.join("template.nii"))
+	nib.save(nib.Nifti1Image(np.ones((20,30,10), dtype=np.float32), np.eye(4)), template)
+	for registration_preset in ["default", "fast"]:
+		s_register, s_warp, f_warp = structural_registration(template, num_threads=3, registration_preset=registration_preset, template_cache=False)
+		assert s_register.n_procs == 3
+		assert s_register.inputs.num_threads == 3
+		assert f_warp.mem_gb > s_warp.mem_gb
@@ -0,0 +1,94 @@
+from os import listdir, path
+
+import numpy as np
+
+from samri.pipelines import regression
+from samri.pipelines.regression import cached_design_matrix, design_matrix, first_level, fit_glm, second_level
+
+def test_fit_glm():
+	random = np.random.RandomState(0)
+	basis = np.exp(-np.arange(0, 10, 0.05))
+	session_info = {"cond":[
+		{"name":"e0", "onset":[10, 60, 110], "duration":[5], "amplitudes":[1, 1, 1]},
+		{"name":"e1", "onset":[10, 60, 110], "duration":[5], "amplitudes":[3, 2, 1]},
+		]}
+	names, design = design_matrix(session_info, basis, 150, 1., orthogonalization={2:{0:1, 1:1, 2:0}})
+	assert names == ["e0", "e1"]
+	assert np.allclose(design.mean(axis=0), 0)
+	assert np.isclose(np.dot(design[:,0], design[:,1]), 0)
+
+	data = np.dot(design, random.normal(size=(2,20))) + random.normal(size=(150,20))
+	statistics = fit_glm(data, design, np.array([[1, 0]]))
+	for voxel in range(data.shape[1]):
+		betas, residuals, _, _ = np.linalg.lstsq(design, data[:,voxel], rcond=None)
+		varcb = residuals[0] / (150-2) * np.linalg.inv(np.dot(design.T, design))[0,0]
+		assert np.isclose(statistics["cope"][0,voxel], betas[0])
+		assert np.isclose(statistics["varcb"][0,voxel], varcb)
+		assert np.isclose(statistics["t"][0,voxel], betas[0]/np.sqrt(varcb))
+
+	prewhitened = fit_glm(data, design, np.array([[1, 0]]), ar1=True, chunk_voxels=3, n_jobs=2)
+	assert prewhitened["cope"].shape == (1,20)
+	assert np.all(np.isfinite(prewhitened["z"]))
+
+def test_cached_design_matrix(tmpdir):
+	basis = np.exp(-np.arange(0, 10, 0.05))
+	session_info = {"cond":[{"name":"e0", "onset":[10, 60], "duration":[5]}], "hpf":100}
+	names, design = cached_design_matrix(session_info, basis, 100, 1., design_cache=str(tmpdir))
+	assert len(listdir(str(tmpdir))) == 1
+
+	regression._designs.clear()
+	cached_names, cached_design = cached_design_matrix(session_info, basis, 100, 1., design_cache=str(tmpdir))
+	assert cached_names == names == ["e0"]
+	assert np.array_equal(cached_design, design)
+	assert np.allclose(design, design_matrix(session_info, basis, 100, 1.)[1])
+
+	cached_design_matrix(session_info, basis, 120, 1., design_cache=str(tmpdir))
+	assert len(listdir(str(tmpdir))) == 2
+
+def test_first_level_batch(tmpdir):
+	import nibabel as nib
+
+	random = np.random.RandomState(1)
+	basis_file = path.join(str(tmpdir),"basis.txt")
+	np.savetxt(basis_file, np.exp(-np.arange(0, 10, 0.05)))
+	bases = {"custom": {"bfcustompath":basis_file}}
+	contrasts = [("allStim","T",["e0"],[1])]
+	in_files = []
+	session_infos = []
+	for ix, onsets in enumerate([[10, 60], [10, 60], [20, 70]]):
+		in_file = path.join(str(tmpdir),"run{}.nii".format(ix))
+		nib.save(nib.Nifti1Image(random.normal(size=(3,3,2,100)).astype(np.float32)+10, np.eye(4)), in_file)
+		in_files.append(in_file)
+		session_infos.append({"cond":[{"name":"e0", "onset":onsets, "duration":[5]}], "hpf":100})
+
+	out_files = [{"cope":path.join(str(tmpdir),"batch_cope{}.nii".format(ix))} for ix in range(3)]
+	groups = first_level(in_files, session_infos, contrasts, bases, design_cache="", out_files=out_files)
+	assert sorted(groups) == [[0, 1], [2]]
+	for ix in range(3):
+		single_file = path.join(str(tmpdir),"single_cope{}.nii".format(ix))
+		first_level([in_files[ix]], [session_infos[ix]], contrasts, bases, design_cache="", out_files=[{"cope":single_file}])
+		assert np.allclose(nib.load(out_files[ix]["cope"]).get_fdata(), nib.load(single_file).get_fdata(), atol=1e-6)
+
+def test_second_level(tmpdir):
+	import nibabel as nib
+
+	random = np.random.RandomState(2)
+	copes = []
+	varcbs = []
+	values = random.normal(size=(5,4,3,2))
+	for ix in range(5):
+		copes.append(path.join(str(tmpdir),"run{}_cope.nii".format(ix)))
+		varcbs.append(path.join(str(tmpdir),"run{}_varcb.nii".format(ix)))
+		nib.save(nib.Nifti1Image(values[ix].astype(np.float32), np.eye(4)), copes[-1])
+		nib.save(nib.Nifti1Image(np.full((4,3,2), ix+1, dtype=np.float32), np.eye(4)), varcbs[-1])
+
+	out_file = path.join(str(tmpdir),"tstat1.nii")
+	second_level(copes, out_files={"tstat":out_file})
+	values = values.astype(np.float32).astype(np.float64)
+	t = values.mean(axis=0) / (values.std(axis=0, ddof=1)/np.sqrt(5))
+	assert np.allclose(nib.load(out_file).get_fdata(), t, atol=1e-4)
+
+	statistics = second_level(copes, mode="fe", varcbs=varcbs)
+	weights = 1/np.arange(1, 6, dtype=np.float64)
+	assert np.allclose(statistics["cope"][0], np.tensordot(weights, values, axes=1).flatten()/weights.sum())
+	assert np.allclose(statistics["varcope"], 1/weights.sum())